@@ -1,18 +1,167 @@
+import asyncio
 import binascii
 import io
+import math
+import mmap
+import multiprocessing
+import os
+import ssl
 import sys
 import struct
-from threading import Thread
-from time import sleep
+from heapq import heappop, heappush
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bisect import bisect_right
+from queue import Empty, SimpleQueue
+from threading import BoundedSemaphore, Lock, Thread
+from time import monotonic, monotonic_ns, perf_counter, perf_counter_ns, sleep, time_ns
 import paho.mqtt.client as mqtt
 import argparse
 import json
 import datetime
+import random
+from array import array
+from collections import deque
+
+# A.S.T.R.A. packets are packed with the struct plan of the XTCE converter's
+# decoders, which lives next to this script
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "xtce-converter")
+)
+from structplan import container_plan, is_padding  # noqa: E402
 
 AOS_FRAME_LENGTH = 1115
 SPACECRAFT_ID = 29
 VCID = 1
 IDLE_APID = 0x7FF
+# Frame Error Control Field: CRC-16-CCITT (poly 0x1021, init 0xFFFF) over the
+# rest of the frame, in its last two bytes
+FECF_LENGTH = 2
+FECF_STRUCT = struct.Struct(">H")
+# CCSDS primary header: packet id, sequence control, data length
+CCSDS_HEADER_STRUCT = struct.Struct(">HHH")
+# CCSDS Unsegmented Time Code at the start of the secondary header:
+# 4 bytes of seconds and 2 bytes of 1/65536 second fractions
+CUC_TIME_STRUCT = struct.Struct(">IH")
+
+# How AOS frames are encoded on a frame topic:
+# - leaf: Leaf JSON message, for LeafMqttToFrameConverter
+# - binary: the raw frame, for DefaultMqttToFrameConverter
+# - binary-ts: the raw frame behind FRAME_TIMESTAMP_STRUCT, for latency measurements
+FRAME_ENCODINGS = ("leaf", "binary", "binary-ts")
+# Send time in nanoseconds since the Unix epoch, big endian
+FRAME_TIMESTAMP_STRUCT = struct.Struct(">Q")
+
+LOAD_PROFILES = ("steady", "ramp", "spike")
+# How much unused rate the token bucket may bank, in seconds of traffic.
+# This lets the pacer catch up after an oversleep without bursting too hard.
+TOKEN_BUCKET_WINDOW = 0.05
+# Lowest rate a profile will ever ask for, so the pacer never divides by zero.
+MIN_RATE = 1.0
+# Default time a partially filled frame may wait for more packets when packing
+DEFAULT_FLUSH_TIMEOUT = 0.1
+# M_PDU first header pointer when no packet starts in the frame
+FHP_NO_PACKET_START = 0x7FF
+# Frequency announced in the metadata of simulated radios
+VIRTUAL_SOURCE_FREQUENCY = 433.0
+# Sources listed one by one on the status line, the rest are summarized
+MAX_STATUS_SOURCES = 8
+# Latency probe packets: a CCSDS packet on PROBE_APID whose data field holds
+# PROBE_MAGIC, the probe id and the monotonic send time in nanoseconds.
+# Replies are recognised by the marker wherever it appears in a TC message.
+PROBE_APID = 0x7F0
+PROBE_MAGIC = b"MRTP"
+PROBE_STRUCT = struct.Struct(">4sIQ")
+# Probes without a reply after this many seconds are counted as lost
+PROBE_TIMEOUT = 10.0
+# Sub-bucket bits of the latency histogram: 2**(bits-1) buckets per power of
+# two, i.e. values are recorded with better than 1% precision
+HISTOGRAM_SUB_BUCKET_BITS = 8
+# Default bound on publishes not yet acknowledged by the broker (or, at QoS 0,
+# not yet written to the socket), so paho's outgoing queue cannot grow unbounded
+DEFAULT_MAX_INFLIGHT = 1000
+# Space for the hex encoded last TC a worker hands over for the aggregated status line
+MAX_SHARED_TC_LENGTH = 512
+# Size of the sample packet framed by the --benchmark micro-benchmarks
+BENCHMARK_PACKET_LENGTH = 64
+# Frames per call in the batch encoding benchmarks
+BENCHMARK_BATCH_SIZE = 64
+# How synthetic A.S.T.R.A. parameter values evolve from packet to packet
+ASTRA_VALUE_MODES = ("random", "sine", "ramp")
+# Synthetic A.S.T.R.A. packets generated per batch
+ASTRA_BATCH_SIZE = 256
+# Packets per period of the sine and ramp value modes
+ASTRA_WAVEFORM_PERIOD = 200
+# Capture journal: JOURNAL_MAGIC followed by records of JOURNAL_RECORD_STRUCT
+# (monotonic time in ns, journal sequence number, sequence number on the topic,
+# kind, topic id, payload length) each followed by its payload. A topic's name
+# is written once, in a JOURNAL_TOPIC record, before the first record using it.
+JOURNAL_MAGIC = b"SIMJRNL1"
+JOURNAL_RECORD_STRUCT = struct.Struct("<QQIBHI")
+(
+    JOURNAL_TOPIC,
+    JOURNAL_TM_PACKET,
+    JOURNAL_TM_FRAME,
+    JOURNAL_TC_PACKET,
+    JOURNAL_TC_FRAME,
+    JOURNAL_METADATA,
+) = range(6)
+JOURNAL_KIND_NAMES = (
+    "topic",
+    "tm-packet",
+    "tm-frame",
+    "tc-packet",
+    "tc-frame",
+    "metadata",
+)
+# Records published again when a journal is replayed
+JOURNAL_SENT_KINDS = (JOURNAL_TM_PACKET, JOURNAL_TM_FRAME, JOURNAL_METADATA)
+# The <journal>.idx index has an entry of JOURNAL_INDEX_STRUCT (record kind,
+# time, journal sequence number, file offset) for every JOURNAL_INDEX_INTERVAL-th
+# record and for every JOURNAL_TOPIC record
+JOURNAL_INDEX_STRUCT = struct.Struct("<BQQQ")
+JOURNAL_INDEX_INTERVAL = 256
+# Seconds the journal writer waits for more records before flushing to disk
+JOURNAL_FLUSH_INTERVAL = 0.2
+# TC frames arrive as CLTUs (a start sequence, BCH codeblocks of 7 data bytes
+# and a parity byte, a tail sequence) or as bare frames
+CLTU_START = b"\xeb\x90"
+CLTU_TAIL = b"\xc5\xc5\xc5\xc5\xc5\xc5\xc5\x79"
+CLTU_CODEBLOCK_LENGTH = 8
+# TC transfer frame primary header: version, flags and spacecraft ID; VCID and
+# frame length minus one; frame sequence number
+TC_FRAME_HEADER_STRUCT = struct.Struct(">HHB")
+# The TC responder acknowledges every TC with a TM packet on TC_ACK_APID whose
+# data field is TC_ACK_STRUCT: source (packet or frame), status (accepted or
+# rejected), APID and sequence count of the TC packet, frame sequence number,
+# TC length, receive time in ns since the Unix epoch and time spent in the
+# simulator in microseconds
+TC_ACK_APID = 0x7E0
+TC_ACK_STRUCT = struct.Struct(">BBHHBHQI")
+TC_ACK_PACKET, TC_ACK_FRAME = 1, 2
+TC_ACK_ACCEPTED, TC_ACK_REJECTED = 0, 1
+# Distributions of the simulated command processing time, with the number of
+# parameters (in milliseconds) each takes: fixed:TIME, uniform:MIN,MAX,
+# exponential:MEAN and lognormal:MEDIAN,SIGMA (sigma of the underlying normal)
+TC_LATENCY_DISTRIBUTIONS = {"fixed": 1, "uniform": 2, "exponential": 1, "lognormal": 2}
+# Where the simulator's messages go: an MQTT broker, nowhere, an in-memory
+# queue or a journal file
+TRANSPORTS = ("mqtt", "null", "memory", "file")
+# Messages the memory transport keeps (the most recent ones) when run from the
+# command line
+DEFAULT_MEMORY_TRANSPORT_MESSAGES = 100_000
+# Frame batching: the frames of a topic are coalesced into one message of at
+# most DEFAULT_BATCH_MAX_BYTES, sent at the latest DEFAULT_BATCH_LINGER seconds
+# after its first frame. Binary payloads are each preceded by their length in
+# BATCH_LENGTH_STRUCT, Leaf messages are sent as a JSON array.
+DEFAULT_BATCH_MAX_BYTES = 65536
+DEFAULT_BATCH_LINGER = 0.01
+BATCH_LENGTH_STRUCT = struct.Struct(">H")
+# Rate of the --batch-compare runs without --rate, i.e. as fast as possible
+UNTHROTTLED_RATE = 1e9
+# Quantiles of the duration summaries in the metrics
+METRIC_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+# Seconds between two JSON lines of the metrics file
+DEFAULT_METRICS_INTERVAL = 1.0
 
 
 def make_idle_ccsds_packet(length):
@@ -90,131 +239,3478 @@ def build_aos_frame(packet, seq_count):
     return aos_frame
 
 
-def send_tm(simulator):
-    with io.open("testdata.ccsds", "rb") as f:
-        header = bytearray(6)
-        while f.readinto(header) == 6:
-            (pkt_len,) = struct.unpack_from(">H", header, 4)
+def frame_crc(data):
+    """CRC-16-CCITT of ``data`` as used by the AOS Frame Error Control Field."""
+    return binascii.crc_hqx(data, 0xFFFF)
 
-            packet = bytearray(pkt_len + 7)
-            f.seek(-6, io.SEEK_CUR)
-            f.readinto(packet)
 
-            simulator.client.publish(simulator.tm_packet_topic, packet)
-            simulator.tm_packet_counter += 1
+def write_fecf(frame, frame_length):
+    """Writes the FECF over the first ``frame_length - 2`` bytes into the last two."""
+    crc = frame_crc(frame[: frame_length - FECF_LENGTH])
+    FECF_STRUCT.pack_into(frame, frame_length - FECF_LENGTH, crc)
 
-            aos_frame = build_aos_frame(packet, simulator.tm_frame_counter)
-            if aos_frame:
-                # send the frame in json Leaf format
-                payload_str = " ".join(f"0x{byte:02x}" for byte in aos_frame)
-                data = {
-                    "timestamp": datetime.datetime.now().isoformat(),
-                    "payload": payload_str,
-                }
-                json_data = json.dumps(data)
-                print(f"Sending data {json_data}")
-                simulator.client.publish(simulator.tm_frame_topic, json_data)
-                simulator.tm_frame_counter += 1
 
-            sleep(1)
+def check_fecf(frame):
+    """Returns True if the frame's FECF matches its content."""
+    (fecf,) = FECF_STRUCT.unpack_from(frame, len(frame) - FECF_LENGTH)
+    return frame_crc(memoryview(frame)[:-FECF_LENGTH]) == fecf
 
 
-def on_tc_packet(client, userdata, message):
-    simulator = userdata
-    simulator.last_tc = message.payload
-    simulator.tc_packet_counter += 1
+def frame_crc_batch(frames):
+    """Returns the CRC of every frame's data (everything but the FECF)."""
+    crc_hqx = binascii.crc_hqx
+    return [crc_hqx(memoryview(frame)[:-FECF_LENGTH], 0xFFFF) for frame in frames]
 
 
-def on_tc_frame(client, userdata, message):
-    simulator = userdata
-    simulator.last_tc = message.payload
-    simulator.tc_frame_counter += 1
+def check_fecf_batch(frames):
+    """Returns the ``check_fecf`` result of every frame."""
+    unpack = FECF_STRUCT.unpack_from
+    return [
+        crc == unpack(frame, len(frame) - FECF_LENGTH)[0]
+        for crc, frame in zip(frame_crc_batch(frames), frames)
+    ]
 
 
-class Simulator:
-    def __init__(self, broker):
-        self.tm_packet_counter = 0
-        self.tc_packet_counter = 0
-        self.tm_frame_counter = 0
-        self.tc_frame_counter = 0
-        self.tm_thread = None
-        self.last_tc = None
-        self.tm_packet_topic = "yamcs-tm-packets"
-        self.tc_packet_topic = "yamcs-tc-packets"
-        self.tm_frame_topic = "yamcs-tm-frames"
-        self.tc_frame_topic = "yamcs-tc-frames"
-        self.client = mqtt.Client(userdata=self)
+class BitErrorInjector:
+    """
+    Flips random bits in frames at a given bit error rate.
 
-        if broker.startswith("tcp://"):
-            broker = broker[6:]
-            use_tls = False
-        elif broker.startswith("ssl://") or broker.startswith("tls://"):
-            broker = broker[6:]
-            use_tls = True
+    Instead of drawing a random number per bit, the distance to the next
+    flipped bit is drawn from the geometric distribution, so the cost is per
+    flip and low error rates are nearly free.
+    """
+
+    def __init__(self, bit_error_rate, seed=None):
+        if not 0 < bit_error_rate < 1:
+            raise ValueError("Bit error rate must be between 0 and 1")
+        self.bit_error_rate = bit_error_rate
+        self._log_keep = math.log1p(-bit_error_rate)
+        self._random = random.Random(seed)
+        self._next = self._gap()
+        self.frames = 0
+        self.corrupted = 0
+        self.flips = 0
+
+    def _gap(self):
+        # bits to skip before the next flip
+        return int(math.log(1.0 - self._random.random()) / self._log_keep)
+
+    def inject(self, frame):
+        """
+        Returns the frame with bits flipped, as a new bytearray if any bit was
+        flipped or as the same object otherwise.
+        """
+        self.frames += 1
+        bits = len(frame) * 8
+        if self._next >= bits:
+            self._next -= bits
+            return frame
+        frame = bytearray(frame)
+        position = self._next
+        while position < bits:
+            frame[position >> 3] ^= 0x80 >> (position & 7)
+            self.flips += 1
+            position += 1 + self._gap()
+        self._next = position - bits
+        self.corrupted += 1
+        return frame
+
+    def status(self):
+        return "Errors: {} bits flipped in {} of {} frames".format(
+            self.flips, self.corrupted, self.frames
+        )
+
+
+class AosFrameBuilder:
+    """
+    Builds the same frames as ``build_aos_frame`` without allocating per frame.
+
+    The static part of the header and one idle packet per fill length are
+    computed once. Each frame is assembled in a reusable buffer through a
+    ``memoryview``, so the only allocation left is the output itself in
+    ``build``; ``build_view`` avoids even that. With ``fecf`` the last two
+    bytes of the frame hold its CRC instead of idle data.
+    """
+
+    # Frame sequence number (24 bits) followed by the signaling field (8 bits, always 0)
+    _SEQ_STRUCT = struct.Struct(">I")
+
+    def __init__(
+        self,
+        spacecraft_id=SPACECRAFT_ID,
+        vcid=VCID,
+        frame_length=AOS_FRAME_LENGTH,
+        fecf=False,
+    ):
+        self.frame_length = frame_length
+        self.fecf = fecf
+        # end of the data zone
+        self.data_end = frame_length - FECF_LENGTH if fecf else frame_length
+        # Version (2 bits) + SCID (8 bits) and VCID (6 bits), zero sequence
+        # number and signaling field, zero M_PDU header
+        self.header = struct.pack(">HIH", (1 << 14) | (spacecraft_id << 6) | vcid, 0, 0)
+        self._buffer = bytearray(frame_length)
+        self._view = memoryview(self._buffer)
+        self._idle_templates = {}
+
+    def idle_packet(self, length):
+        """Returns the cached idle packet filling ``length`` bytes."""
+        template = self._idle_templates.get(length)
+        if template is None:
+            template = bytes(make_idle_ccsds_packet(length))
+            self._idle_templates[length] = template
+        return template
+
+    def build_into(self, buffer, packet, seq_count):
+        """
+        Writes the frame for ``packet`` into ``buffer`` (at least ``frame_length`` bytes).
+
+        Returns:
+            bool: False if the packet is too large to fit with an idle packet.
+        """
+        pkt_len = len(packet)
+        if pkt_len + 15 > self.data_end:
+            print(
+                "Packet {} too large - cannot fit it in a frame together with an idle packet".format(
+                    pkt_len
+                )
+            )
+            return False
+
+        view = buffer if isinstance(buffer, memoryview) else memoryview(buffer)
+        view[:8] = self.header
+        self._SEQ_STRUCT.pack_into(view, 2, (seq_count & 0xFFFFFF) << 8)
+        end = 8 + pkt_len
+        view[8:end] = packet
+        view[end : self.data_end] = self.idle_packet(self.data_end - end)
+        if self.fecf:
+            write_fecf(view, self.frame_length)
+        return True
+
+    def build_view(self, packet, seq_count):
+        """
+        Builds the frame in the internal buffer and returns a view on it.
+
+        The view is only valid until the next call, use ``build`` to keep the frame.
+        """
+        if not self.build_into(self._view, packet, seq_count):
+            return None
+        return self._view
+
+    def build(self, packet, seq_count):
+        """Returns the frame as ``bytes``, or None if the packet is too large."""
+        if not self.build_into(self._view, packet, seq_count):
+            return None
+        return bytes(self._view)
+
+
+class CcsdsReplaySource:
+    """
+    Memory-mapped CCSDS capture file with an index of every packet.
+
+    The file is scanned once when the source is opened, recording the offset,
+    length, APID and sequence count of each packet. Packets are then handed out
+    as ``memoryview`` slices of the mapping, without syscalls or copies, so they
+    must not be kept beyond the lifetime of the source.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = io.open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        if size:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
         else:
-            raise ValueError("Broker must start with tcp://, ssl://, or tls://")
+            # mmap refuses empty files
+            self._mmap = None
+            self._view = memoryview(b"")
 
-        self.broker, self.port = broker.split(":")
-        self.port = int(self.port)
+        self.offsets = array("Q")
+        self.lengths = array("I")
+        self.apids = array("H")
+        self.seq_counts = array("H")
 
-        if use_tls:
-            self.client.tls_set(cert_reqs=ssl.CERT_NONE)
-            self.client.tls_insecure_set(True)
+        offset = 0
+        unpack_header = CCSDS_HEADER_STRUCT.unpack_from
+        while offset + 6 <= size:
+            packet_id, seq_ctrl, data_length = unpack_header(self._view, offset)
+            pkt_len = data_length + 7
+            if offset + pkt_len > size:
+                print(
+                    "Ignoring truncated packet at offset {} of {}".format(offset, path)
+                )
+                break
+            self.offsets.append(offset)
+            self.lengths.append(pkt_len)
+            self.apids.append(packet_id & 0x7FF)
+            self.seq_counts.append(seq_ctrl & 0x3FFF)
+            offset += pkt_len
 
-        print(
-            f"Connecting to broker: {self.broker} on port: {self.port} (TLS: {use_tls})"
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        offset = self.offsets[index]
+        return self._view[offset : offset + self.lengths[index]]
+
+    def indices(self, apids=None, loop=False, start=0):
+        """
+        Yields packet indices in file order.
+
+        Args:
+            apids: only yield packets with one of these APIDs (default: all).
+            loop: start over at the beginning of the file when reaching its end.
+            start: index of the first packet to yield.
+        """
+        if apids is None:
+            indices = range(len(self))
+        else:
+            apids = set(apids)
+            indices = [i for i, apid in enumerate(self.apids) if apid in apids]
+        if not indices:
+            return
+
+        first = 0
+        if start:
+            first = next((n for n, i in enumerate(indices) if i >= start), len(indices))
+        while True:
+            for n in range(first, len(indices)):
+                yield indices[n]
+            if not loop:
+                return
+            first = 0
+
+    def packets(self, apids=None, loop=False, start=0):
+        """Yields the packets selected as in ``indices`` as ``memoryview`` slices."""
+        view = self._view
+        offsets = self.offsets
+        lengths = self.lengths
+        for i in self.indices(apids, loop, start):
+            offset = offsets[i]
+            yield view[offset : offset + lengths[i]]
+
+    def header_times(self):
+        """
+        Returns the time of every packet from its secondary header CUC time code.
+
+        Packets without a secondary header get the time of the previous packet.
+        """
+        times = array("d")
+        last = 0.0
+        for offset, length in zip(self.offsets, self.lengths):
+            (packet_id,) = struct.unpack_from(">H", self._view, offset)
+            if packet_id & 0x0800 and length >= 6 + CUC_TIME_STRUCT.size:
+                coarse, fine = CUC_TIME_STRUCT.unpack_from(self._view, offset + 6)
+                last = coarse + fine / 65536
+            times.append(last)
+        return times
+
+    def close(self):
+        self._view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_sidecar_times(path, count):
+    """
+    Reads packet times from a sidecar index file.
+
+    The file has one time in seconds per line, in capture order, for each of the
+    ``count`` packets. Blank lines and lines starting with '#' are ignored.
+    """
+    times = array("d")
+    with io.open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                times.append(float(line))
+    if len(times) != count:
+        raise ValueError(
+            "{} has {} timestamps but the capture has {} packets".format(
+                path, len(times), count
+            )
         )
-        self.client.connect(self.broker, self.port)
-        self.client.subscribe(self.tc_packet_topic)
-        self.client.message_callback_add(self.tc_packet_topic, on_tc_packet)
+    return times
 
-        self.client.subscribe(self.tc_frame_topic)
-        self.client.message_callback_add(self.tc_frame_topic, on_tc_frame)
 
-    def start(self):
-        self.tm_thread = Thread(target=send_tm, args=(self,))
-        self.tm_thread.daemon = True
-        self.tm_thread.start()
-        self.client.loop_start()
+class ReplayTiming:
+    """
+    Schedules packets at their original capture times, scaled by ``speed``.
 
-    def print_status(self):
-        cmdhex = None
-        if self.last_tc:
-            cmdhex = binascii.hexlify(self.last_tc).decode("ascii")
-        return "Sent: {} TM packets and {} TM frames. Received: {} TC packets and {} TC frames. Last TC: {}".format(
-            self.tm_packet_counter,
-            self.tm_frame_counter,
-            self.tc_packet_counter,
-            self.tc_frame_counter,
-            cmdhex,
+    Each send time is computed from a fixed monotonic origin rather than from
+    the previous packet, so sleep overshoot never accumulates over a long
+    capture. A ``speed`` of None replays as fast as possible.
+    """
+
+    def __init__(self, times, speed=1.0):
+        if speed is not None and speed <= 0:
+            raise ValueError("Speed must be positive")
+        self.times = times
+        self.speed = speed
+        self.origin = None  # (monotonic time, capture time) of the first packet
+        self.offset = 0.0  # added to capture times after the capture looped
+        self.last_index = None
+        self.max_lag = 0.0
+
+    def wait(self, index):
+        """Blocks until packet ``index`` is due."""
+        if self.last_index is not None and index <= self.last_index:
+            # the capture looped, continue the timeline where the last pass ended
+            self.offset += self.times[self.last_index] - self.times[index]
+        self.last_index = index
+        t = self.times[index] + self.offset
+        now = monotonic()
+        if self.origin is None:
+            self.origin = (now, t)
+            return
+        if self.speed is None:
+            return
+        delay = self.origin[0] + (t - self.origin[1]) / self.speed - now
+        if delay > 0:
+            sleep(delay)
+        elif -delay > self.max_lag:
+            self.max_lag = -delay
+
+    def status(self):
+        if self.origin is None:
+            return "Replay: not started"
+        position = self.times[self.last_index] + self.offset - self.origin[1]
+        return "Replay: {:.1f}s of capture at {}, max lag {:.1f} ms".format(
+            position,
+            "max speed" if self.speed is None else f"{self.speed:g}x",
+            self.max_lag * 1000,
         )
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="MQTT Simulator")
-    parser.add_argument(
-        "--broker",
-        type=str,
-        default="tcp://mrt.leomindlin.com:1883",
-        help="MQTT broker address",
-    )
+class TokenBucket:
+    """
+    Paces a sender to a target rate.
 
-    args = parser.parse_args()
+    Tokens accumulate at ``rate`` per second up to ``capacity`` and each
+    message consumes one. Sleeps are derived from the bucket level rather
+    than a fixed per-message delay, so loop overhead and oversleeping are
+    absorbed by banked tokens instead of turning into drift.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate * TOKEN_BUCKET_WINDOW)
+        self.tokens = 1.0
+        self.last = monotonic()
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = rate
+        self.capacity = max(1.0, rate * TOKEN_BUCKET_WINDOW)
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self, n=1):
+        """Blocks until ``n`` tokens are available and consumes them."""
+        while True:
+            self._refill()
+            if self.tokens >= n:
+                self.tokens -= n
+                return
+            sleep((n - self.tokens) / self.rate)
+
+
+class LoadProfile:
+    """
+    Target rate as a function of time since the load run started.
+
+    - steady: ``rate`` for the whole run.
+    - ramp: rises linearly from zero to ``rate`` over ``ramp_seconds``, then
+      holds. A ramp of zero seconds steps straight to ``rate``.
+    - spike: ``rate``, except for the last ``spike_seconds`` of every
+      ``spike_period`` where it is multiplied by ``spike_factor``.
+    """
+
+    def __init__(
+        self,
+        kind,
+        rate,
+        ramp_seconds=60.0,
+        spike_period=30.0,
+        spike_seconds=5.0,
+        spike_factor=5.0,
+    ):
+        if kind not in LOAD_PROFILES:
+            raise ValueError(
+                "Unknown load profile '{}', expected one of {}".format(
+                    kind, ", ".join(LOAD_PROFILES)
+                )
+            )
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+        if spike_period <= 0 or spike_seconds < 0 or spike_factor <= 0:
+            raise ValueError("Spike period and factor must be positive")
+        self.kind = kind
+        self.rate = rate
+        self.ramp_seconds = ramp_seconds
+        self.spike_period = spike_period
+        self.spike_seconds = spike_seconds
+        self.spike_factor = spike_factor
+
+    def rate_at(self, elapsed):
+        if self.kind == "ramp" and self.ramp_seconds > 0:
+            rate = self.rate * min(1.0, elapsed / self.ramp_seconds)
+        elif self.kind == "spike":
+            in_spike = elapsed % self.spike_period >= (
+                self.spike_period - self.spike_seconds
+            )
+            rate = self.rate * self.spike_factor if in_spike else self.rate
+        else:
+            rate = self.rate
+        return max(MIN_RATE, rate)
+
+
+class LoadGenerator:
+    """
+    Drives ``send_tm`` at the rate given by a ``LoadProfile`` and keeps track
+    of the rate actually achieved, so the two can be compared while looking
+    for the point where the backend saturates.
+    """
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.bucket = TokenBucket(profile.rate_at(0))
+        self.start_time = None
+        self.sent = 0
+        # (time, sent) at the start of the current measurement window
+        self.window = None
+        self.window_rate = 0.0
+
+    def wait(self):
+        """Blocks until the next message may be sent according to the profile."""
+        now = monotonic()
+        if self.start_time is None:
+            self.start_time = now
+            self.window = (now, 0)
+        rate = self.profile.rate_at(now - self.start_time)
+        if rate != self.bucket.rate:
+            self.bucket.set_rate(rate)
+        self.bucket.acquire()
+        self.sent += 1
+
+    def requested_rate(self):
+        if self.start_time is None:
+            return self.profile.rate_at(0)
+        return self.profile.rate_at(monotonic() - self.start_time)
+
+    def average_rate(self):
+        if self.start_time is None:
+            return 0.0
+        elapsed = monotonic() - self.start_time
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+    def achieved_rate(self):
+        """Rate over the last measurement window of at least one second."""
+        if self.window is None:
+            return 0.0
+        now = monotonic()
+        window_start, window_sent = self.window
+        if now - window_start >= 1.0:
+            self.window_rate = (self.sent - window_sent) / (now - window_start)
+            self.window = (now, self.sent)
+        return self.window_rate
+
+    def status(self):
+        return (
+            "Rate: {:.1f}/s achieved, {:.1f}/s requested ({}), {:.1f}/s average".format(
+                self.achieved_rate(),
+                self.requested_rate(),
+                self.profile.kind,
+                self.average_rate(),
+            )
+        )
+
+
+class AosFramePacker:
+    """
+    Packs CCSDS packets back to back into AOS frames.
+
+    Packets may span frame boundaries and the M_PDU header of every frame
+    carries the first header pointer: the offset of the first packet starting
+    in the frame's data zone, or FHP_NO_PACKET_START if the frame only holds
+    the continuation of a packet. A partial frame is only completed with an
+    idle packet by ``flush``, e.g. once ``poll`` sees it waited ``flush_timeout``.
+    With ``fecf`` every frame ends with its CRC.
+
+    Callers sharing a packer between threads hold ``lock`` around its use.
+    """
+
+    def __init__(
+        self,
+        spacecraft_id=SPACECRAFT_ID,
+        vcid=VCID,
+        frame_length=AOS_FRAME_LENGTH,
+        flush_timeout=DEFAULT_FLUSH_TIMEOUT,
+        fecf=False,
+    ):
+        self.frame_length = frame_length
+        self.flush_timeout = flush_timeout
+        self.fecf = fecf
+        self.lock = Lock()
+        self.header = struct.pack(">HIH", (1 << 14) | (spacecraft_id << 6) | vcid, 0, 0)
+        self.data_length = frame_length - len(self.header)
+        if fecf:
+            self.data_length -= FECF_LENGTH
+        self._frame = bytearray(frame_length)
+        self._frame[: len(self.header)] = self.header
+        self._view = memoryview(self._frame)
+        self._fill = 0
+        self._first_header = None
+        self._oldest = None
+        self.seq_count = 0
+        self.frames = 0
+        self.packets = 0
+        self.packet_bytes = 0
+        self.idle_bytes = 0
+
+    def _append(self, data, frames):
+        """Copies data into the current frame, emitting every frame that gets full."""
+        header_length = len(self.header)
+        pos = 0
+        while pos < len(data):
+            take = min(len(data) - pos, self.data_length - self._fill)
+            start = header_length + self._fill
+            self._view[start : start + take] = data[pos : pos + take]
+            self._fill += take
+            pos += take
+            if self._fill == self.data_length:
+                frames.append(self._emit())
+        if self._fill and self._oldest is None:
+            # the tail of a packet spanning frames starts the next frame's wait
+            self._oldest = monotonic()
+
+    def _emit(self):
+        fhp = FHP_NO_PACKET_START if self._first_header is None else self._first_header
+        AosFrameBuilder._SEQ_STRUCT.pack_into(
+            self._view, 2, (self.seq_count & 0xFFFFFF) << 8
+        )
+        struct.pack_into(">H", self._view, 6, fhp)
+        if self.fecf:
+            write_fecf(self._view, self.frame_length)
+        self.seq_count += 1
+        self.frames += 1
+        self._fill = 0
+        self._first_header = None
+        self._oldest = None
+        return bytes(self._view)
+
+    def add(self, packet):
+        """Adds a packet, returning the list of frames it completed (possibly empty)."""
+        frames = []
+        if self._first_header is None:
+            self._first_header = self._fill
+        if self._oldest is None:
+            self._oldest = monotonic()
+        self._append(packet, frames)
+        self.packets += 1
+        self.packet_bytes += len(packet)
+        return frames
+
+    def flush(self):
+        """
+        Completes the partial frame with an idle packet.
+
+        An idle packet is at least 7 bytes; if less is left it spills into one
+        more frame, so this returns a list of zero, one or two frames.
+        """
+        frames = []
+        if self._fill == 0:
+            return frames
+        remaining = self.data_length - self._fill
+        length = remaining if remaining >= 7 else remaining + self.data_length
+        if self._first_header is None:
+            self._first_header = self._fill
+        self._append(make_idle_ccsds_packet(length), frames)
+        self.idle_bytes += length
+        return frames
+
+    def poll(self):
+        """Flushes the partial frame if it has waited longer than ``flush_timeout``."""
+        if (
+            self._oldest is not None
+            and monotonic() - self._oldest >= self.flush_timeout
+        ):
+            return self.flush()
+        return []
+
+    def status(self):
+        # only the packet bytes of emitted frames, not those of the partial one
+        utilization = (
+            (self.packet_bytes - self._fill) / (self.frames * self.data_length)
+            if self.frames
+            else 0.0
+        )
+        return "Packing: {} packets in {} frames, {:.1f}% utilization, {} idle bytes".format(
+            self.packets, self.frames, 100 * utilization, self.idle_bytes
+        )
+
+
+_leaf_hex_templates = {}
+
+
+def _leaf_hex_template(length):
+    template = _leaf_hex_templates.get(length)
+    if template is None:
+        template = (b"0x00 " * length)[:-1]
+        _leaf_hex_templates[length] = template
+    return template
+
+
+def leaf_hex(data):
+    """
+    Encodes binary data as the hex string of a Leaf message payload.
+
+    Produces exactly the same text as ``" ".join(f"0x{byte:02x}" for byte in data)``.
+    The digits from ``bytes.hex`` are scattered into a cached "0x00 0x00 ..."
+    template with extended slice assignments, so no Python code runs per byte.
+    """
+    if not data:
+        return ""
+    out = bytearray(_leaf_hex_template(len(data)))
+    digits = data.hex().encode("ascii")
+    out[2::5] = digits[0::2]
+    out[3::5] = digits[1::2]
+    return out.decode("ascii")
+
+
+def leaf_hex_batch(frames):
+    """
+    Encodes several frames, returning one ``leaf_hex`` string per frame.
+
+    Encoding frame by frame keeps the working set in cache and measured
+    faster than one pass over the concatenated frames.
+    """
+    return [leaf_hex(frame) for frame in frames]
+
+
+def leaf_json(payload_hex, timestamp):
+    """
+    Builds the Leaf JSON message for an already encoded payload.
+
+    Byte-identical to ``json.dumps({"timestamp": timestamp, "payload": payload_hex})``;
+    neither an ISO 8601 timestamp nor the hex string needs escaping.
+    """
+    return '{"timestamp": "' + timestamp + '", "payload": "' + payload_hex + '"}'
+
+
+def encode_frame(frame, encoding):
+    """Returns the MQTT payload for ``frame`` in one of the ``FRAME_ENCODINGS``."""
+    if encoding == "leaf":
+        return leaf_json(leaf_hex(frame), datetime.datetime.now().isoformat())
+    if encoding == "binary-ts":
+        return FRAME_TIMESTAMP_STRUCT.pack(time_ns()) + frame
+    return frame
+
+
+def parse_frame_topic(spec):
+    """Parses a TOPIC=ENCODING command line argument."""
+    topic, _, encoding = spec.rpartition("=")
+    if not topic or encoding not in FRAME_ENCODINGS:
+        raise argparse.ArgumentTypeError(
+            "expected TOPIC=ENCODING with ENCODING one of {}".format(
+                ", ".join(FRAME_ENCODINGS)
+            )
+        )
+    return topic, encoding
+
+
+def parse_speed(value):
+    """Parses the --speed argument, 'max' meaning as fast as possible."""
+    if value == "max":
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+
+def parse_positive(value):
+    """Parses a rate or duration argument that must be above zero."""
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError("must be positive")
+    return number
+
+
+def parse_non_negative(value):
+    """Parses a duration argument that may be zero."""
+    number = float(value)
+    if not number >= 0:
+        raise argparse.ArgumentTypeError("must not be negative")
+    return number
+
+
+def parse_bit_error_rate(value):
+    """Parses the --bit-error-rate argument, a probability below one."""
+    number = float(value)
+    if not 0 <= number < 1:
+        raise argparse.ArgumentTypeError("must be at least 0 and below 1")
+    return number
+
+
+def publish_frame(simulator, aos_frame, verbose=False):
+    """Publishes a frame on every frame topic in that topic's encoding."""
+    if simulator.injector:
+        aos_frame = simulator.injector.inject(aos_frame)
+    for topic, encoding in simulator.frame_topics.items():
+        start = perf_counter_ns()
+        payload = encode_frame(aos_frame, encoding)
+        simulator.frame_encode_time.observe(perf_counter_ns() - start, (encoding,))
+        if verbose:
+            if encoding == "leaf":
+                print(f"Sending data {payload}")
+            else:
+                print(f"Sending {len(payload)} bytes to {topic}")
+        if simulator.batcher:
+            publish_batches(simulator, simulator.batcher.add(topic, encoding, payload))
+        else:
+            simulator.publish(topic, payload, kind=JOURNAL_TM_FRAME)
+        simulator.tm_frame_bytes[topic] += len(payload)
+    simulator.tm_frame_counter += 1
 
-    simulator = Simulator(args.broker)
-    simulator.start()
 
+class FrameBatcher:
+    """
+    Coalesces the frames published on each frame topic into fewer, larger
+    MQTT messages, to cut the per-message cost of the broker, paho and the
+    Yamcs link.
+
+    A batch is closed when the next frame would take it over ``max_bytes``
+    or, through ``poll``, once its first frame has waited ``linger`` seconds.
+    Binary payloads are bundled each behind its length in BATCH_LENGTH_STRUCT,
+    Leaf messages as a JSON array. Batches are kept per topic and connection,
+    so every frame still goes out on the connection of its source.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_BATCH_MAX_BYTES, linger=DEFAULT_BATCH_LINGER):
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.lock = Lock()
+        # (topic, client) -> [encoding, payloads, size, time of the first frame]
+        self._batches = {}
+        self.messages = 0
+        self.frames = 0
+        self.full = 0
+        self.lingered = 0
+
+    def add(self, topic, encoding, payload, client=None):
+        """
+        Adds a frame's payload to the batch of its topic. Returns the batches
+        ready to be sent, as ``(topic, client, message, frames)``.
+        """
+        if encoding == "leaf":
+            # and a comma
+            size = len(payload) + 1
+        elif len(payload) > 0xFFFF:
+            raise ValueError(f"{len(payload)} byte payload is too large to batch")
+        else:
+            size = len(payload) + BATCH_LENGTH_STRUCT.size
+        key = (topic, client)
+        ready = []
+        with self.lock:
+            batch = self._batches.get(key)
+            if batch and batch[2] + size > self.max_bytes:
+                ready.append(self._close(key))
+                self.full += 1
+                batch = None
+            if batch is None:
+                # the brackets of the JSON array, minus the last comma
+                batch = [encoding, [], 1 if encoding == "leaf" else 0, monotonic()]
+                self._batches[key] = batch
+            batch[1].append(payload)
+            batch[2] += size
+            if batch[2] >= self.max_bytes:
+                ready.append(self._close(key))
+                self.full += 1
+        return ready
+
+    def _close(self, key):
+        encoding, payloads, _, _ = self._batches.pop(key)
+        if encoding == "leaf":
+            message = "[" + ",".join(payloads) + "]"
+        else:
+            pack = BATCH_LENGTH_STRUCT.pack
+            message = b"".join(
+                part for payload in payloads for part in (pack(len(payload)), payload)
+            )
+        self.messages += 1
+        self.frames += len(payloads)
+        return key[0], key[1], message, len(payloads)
+
+    def poll(self):
+        """Closes the batches whose first frame has waited ``linger`` seconds."""
+        deadline = monotonic() - self.linger
+        with self.lock:
+            expired = [
+                key for key, batch in self._batches.items() if batch[3] <= deadline
+            ]
+            self.lingered += len(expired)
+            return [self._close(key) for key in expired]
+
+    def flush(self):
+        """Closes every batch."""
+        with self.lock:
+            return [self._close(key) for key in list(self._batches)]
+
+    def status(self):
+        return "Batching: {} frames in {} messages, {:.1f} frames/message, {} closed full, {} on linger".format(
+            self.frames,
+            self.messages,
+            self.frames / max(self.messages, 1),
+            self.full,
+            self.lingered,
+        )
+
+
+def publish_batches(simulator, batches):
+    for topic, client, message, _ in batches:
+        simulator.publish(topic, message, client=client, kind=JOURNAL_TM_FRAME)
+
+
+def flush_batches(simulator):
+    """Publishes the batches whose linger time expired."""
+    batcher = simulator.batcher
+    while True:
+        sleep(batcher.linger / 2)
+        publish_batches(simulator, batcher.poll())
+
+
+def flush_frames(simulator):
+    """Publishes the packer's partial frame whenever its flush timeout expires."""
+    packer = simulator.packer
+    verbose = simulator.load is None and simulator.timing is None
+    while True:
+        sleep(packer.flush_timeout / 2)
+        with packer.lock:
+            for aos_frame in packer.poll():
+                publish_frame(simulator, aos_frame, verbose)
+
+
+def send_packet_frames(simulator, packet, verbose=False):
+    """
+    Publishes ``packet`` in AOS frames on the simulator's virtual channel:
+    packed with the other packets when packing, else in a frame of its own.
+    The TM thread and the TC responder both send on it, so the frame count
+    is allocated under the packer's lock or ``frame_lock``.
+    """
+    if simulator.packer:
+        with simulator.packer.lock:
+            start = perf_counter_ns()
+            aos_frames = simulator.packer.add(packet)
+            simulator.frame_build_time.observe(perf_counter_ns() - start)
+            for aos_frame in aos_frames:
+                publish_frame(simulator, aos_frame, verbose)
+    else:
+        with simulator.frame_lock:
+            start = perf_counter_ns()
+            aos_frame = simulator.frame_builder.build(
+                packet, simulator.tm_frame_counter
+            )
+            simulator.frame_build_time.observe(perf_counter_ns() - start)
+            if aos_frame:
+                publish_frame(simulator, aos_frame, verbose)
+
+
+def send_tm(simulator):
+    load = simulator.load
+    timing = simulator.timing
+    verbose = load is None and timing is None
+    # in load mode the capture is replayed until the simulator is stopped
+    loop = simulator.loop or load is not None
+    replay = simulator.replay
+    for index in replay.indices(apids=simulator.apids, loop=loop):
+        if load:
+            load.wait()
+        elif timing:
+            timing.wait(index)
+        packet = replay[index]
+
+        # paho only accepts bytes-like payloads it can own, hence the one copy
+        simulator.publish(simulator.tm_packet_topic, bytes(packet))
+        simulator.tm_packet_counter += 1
+        send_packet_frames(simulator, packet, verbose)
+
+        if verbose:
+            sleep(1)
+
+
+class AstraContainer:
+    """
+    Packs one container of the A.S.T.R.A. layout (the header or an atomic)
+    with a single ``struct.Struct``, planned by the converter's structplan
+    so packets match what its decoders read. Bit fields are OR-ed into the
+    bytes they share, padding is left zero.
+    """
+
+    def __init__(self, entries, kinds):
+        fmt, self.size, self.slots = container_plan(entries, kinds)
+        self.struct = struct.Struct(fmt)
+        self.params = [
+            name
+            for name, _, _ in sorted(entries, key=lambda entry: entry[1])
+            if not is_padding(name)
+        ]
+
+    def pack_into(self, buffer, pos, values):
+        args = []
+        for slot in self.slots:
+            if isinstance(slot, str):
+                args.append(values[slot])
+            elif isinstance(slot, tuple):
+                name, length, signed = slot
+                args.append(values[name].to_bytes(length, "little", signed=signed))
+            else:
+                byte = 0
+                for name, low, mask, offset in slot:
+                    byte |= ((int(values[name]) >> offset) & mask) << low
+                args.append(byte)
+        self.struct.pack_into(buffer, pos, *args)
+
+
+class AstraSchema:
+    """
+    The FlightComputer frame layout, read from the ``<output>.layout.json``
+    file the XTCE converter writes next to the MDB it generates.
+    """
+
+    def __init__(self, path):
+        with open(path) as f:
+            manifest = json.load(f)
+        layout = manifest["layout"]
+        self.hash = manifest["hash"]
+        self.parameters = layout["parameters"]
+        self.header = AstraContainer(layout["header"], self.kind)
+        self.atomics = {
+            name: AstraContainer(entries, self.kind)
+            for name, entries in layout["atomics"].items()
+        }
+        self.max_size = self.header.size + sum(
+            atomic.size for atomic in self.atomics.values()
+        )
+
+    def kind(self, name):
+        if name in self.parameters:
+            return self.parameters[name]["encoding"]
+        # header entries are not sheet parameters
+        return "bool" if name.endswith("_flag") else "uint"
+
+
+def parse_flag_mix(spec):
+    """Parses an ATOMIC=PROBABILITY command line argument."""
+    atomic, _, probability = spec.rpartition("=")
     try:
-        prev_status = None
+        probability = float(probability)
+    except ValueError:
+        probability = -1.0
+    if not atomic or not 0.0 <= probability <= 1.0:
+        raise argparse.ArgumentTypeError(
+            "expected ATOMIC=PROBABILITY with PROBABILITY between 0 and 1"
+        )
+    return atomic, probability
+
+
+class AstraGenerator:
+    """
+    Generates synthetic A.S.T.R.A. packets following an AstraSchema.
+
+    Every parameter gets values of its sheet type: booleans, the real choices
+    of enumerated parameters, floats and integers over their bit width and
+    strings of their length. ``values`` picks whether they are random or follow
+    a sine or ramp waveform. ``flag_mix`` maps atomic names to the probability
+    that they are in a packet ("*" sets it for the others, default 1), and
+    ``seq`` increments with every packet. Packets are generated in batches
+    into one buffer.
+    """
+
+    def __init__(self, schema, flag_mix=None, values="random", seed=None):
+        self.schema = schema
+        self.rng = random.Random(seed)
+        mix = dict(flag_mix or {})
+        default = mix.pop("*", 1.0)
+        unknown = set(mix) - set(schema.atomics)
+        if unknown:
+            raise ValueError("unknown atomics: " + ", ".join(sorted(unknown)))
+        self.presence = [(name, mix.get(name, default)) for name in schema.atomics]
+        self.sources = {
+            name: self._value_source(name, encoding, index, values)
+            for index, (name, encoding) in enumerate(schema.parameters.items())
+        }
+        self.seq = 0
+        self.packet_counter = 0
+        self.bytes_generated = 0
+
+    def _value_source(self, name, encoding, index, mode):
+        """A function of the packet number giving the raw value of a parameter."""
+        rng = self.rng
+        kind, bits = encoding["encoding"], encoding["bits"]
+        # parameters are out of phase with each other so plots are told apart
+        phase = index / 7
+
+        if mode == "sine":
+
+            def wave(t):
+                return math.sin(2 * math.pi * (t / ASTRA_WAVEFORM_PERIOD + phase))
+
+        else:
+
+            def wave(t):
+                return 2 * ((t / ASTRA_WAVEFORM_PERIOD + phase) % 1.0) - 1
+
+        if kind == "bool":
+            if mode == "random":
+                return lambda t: rng.getrandbits(1)
+            return lambda t: int(wave(t) >= 0)
+        if encoding["choices"]:
+            choices = [value for value, _ in encoding["choices"]]
+            if mode == "random":
+                return lambda t: rng.choice(choices)
+            last = len(choices) - 1
+            return lambda t: choices[round((wave(t) + 1) / 2 * last)]
+        if kind == "float":
+            if mode == "random":
+                return lambda t: rng.uniform(-1000.0, 1000.0)
+            return lambda t: 1000.0 * wave(t)
+        if kind == "string":
+            length = bits // 8
+            if mode == "random":
+                letters = b"ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+                return lambda t: bytes(rng.choices(letters, k=length))
+            text = name.encode()[:length]
+            return lambda t: text
+
+        low = -(1 << (bits - 1)) if kind == "int" else 0
+        if mode == "random":
+            return lambda t: low + rng.getrandbits(bits)
+        middle = low + ((1 << bits) - 1) / 2
+        amplitude = 0.45 * ((1 << bits) - 1)
+        return lambda t: int(middle + amplitude * wave(t))
+
+    def generate(self, count=ASTRA_BATCH_SIZE):
+        """
+        Generates ``count`` packets back to back in one buffer. Returns the
+        buffer and the offsets of the packets, followed by the end offset.
+        """
+        schema = self.schema
+        sources = self.sources
+        chance = self.rng.random
+        buffer = bytearray(count * schema.max_size)
+        offsets = [0]
+        pos = 0
+        for _ in range(count):
+            t = self.packet_counter
+            values = {"seq": self.seq, "flags": 0}
+            present = []
+            for name, probability in self.presence:
+                included = probability >= 1.0 or chance() < probability
+                values[name + "_flag"] = included
+                if included:
+                    present.append(schema.atomics[name])
+            schema.header.pack_into(buffer, pos, values)
+            pos += schema.header.size
+            for atomic in present:
+                for param in atomic.params:
+                    values[param] = sources[param](t)
+                atomic.pack_into(buffer, pos, values)
+                pos += atomic.size
+            offsets.append(pos)
+            self.seq = (self.seq + 1) & 0xFFFF
+            self.packet_counter += 1
+        self.bytes_generated += pos
+        return buffer, offsets
+
+    def packets(self):
+        """Endless stream of packets, generated a batch at a time."""
         while True:
-            status = simulator.print_status()
-            if status != prev_status:
-                sys.stdout.write("\r")
-                sys.stdout.write(status)
-                sys.stdout.flush()
-                prev_status = status
-            sleep(0.5)
+            buffer, offsets = self.generate()
+            view = memoryview(buffer)
+            for start, end in zip(offsets, offsets[1:]):
+                yield view[start:end]
+
+    def status(self):
+        return "A.S.T.R.A.: generated {} packets, {:.1f} bytes/packet".format(
+            self.packet_counter,
+            self.bytes_generated / max(self.packet_counter, 1),
+        )
+
+
+class VirtualSource:
+    """
+    One simulated vehicle or radio hosted by the asyncio engine.
+
+    Each source replays the capture from its own starting point at its own
+    rate, with its own spacecraft ID/VCID and frame counter, or sends the
+    synthetic A.S.T.R.A. packets of its ``generator``. Packets are
+    published on ``<device>/telemetry`` the way an A.S.T.R.A. radio does, after
+    announcing the device on ``<device>/metadata``, and frames on ``frame_topic``.
+    """
+
+    def __init__(
+        self,
+        name,
+        device=None,
+        frame_topic=None,
+        encoding="leaf",
+        spacecraft_id=SPACECRAFT_ID,
+        vcid=VCID,
+        rate=1.0,
+        position=0.0,
+        fecf=False,
+        generator=None,
+    ):
+        self.name = name
+        self.device = device
+        self.frame_topic = frame_topic
+        self.encoding = encoding
+        self.spacecraft_id = spacecraft_id
+        self.vcid = vcid
+        self.rate = rate
+        # where in the capture the source starts, as a fraction of its length
+        self.position = position
+        self.frame_builder = AosFrameBuilder(spacecraft_id, vcid, fecf=fecf)
+        self.generator = generator
+        self.client = None
+        self.packet_counter = 0
+        self.frame_counter = 0
+        self.bytes_sent = 0
+
+    def announce(self, simulator):
+        if self.device:
+            metadata = {
+                "frequency": VIRTUAL_SOURCE_FREQUENCY,
+                "status": "OK",
+                "long_status": f"Simulated by {self.name}",
+            }
+            simulator.publish(
+                f"{self.device}/metadata",
+                json.dumps(metadata),
+                client=self.client,
+                retain=True,
+                kind=JOURNAL_METADATA,
+            )
+
+    def retire(self, simulator):
+        # an empty retained metadata message tells the backend the device is gone
+        if self.device:
+            simulator.publish(
+                f"{self.device}/metadata",
+                b"",
+                client=self.client,
+                retain=True,
+                kind=JOURNAL_METADATA,
+            )
+
+    async def publish(self, simulator, topic, payload, kind=JOURNAL_TM_PACKET):
+        # a full window holds up this source only, the others keep their schedule
+        await simulator.window.acquire_async()
+        simulator.publish(topic, payload, client=self.client, kind=kind, acquired=True)
+
+    async def send(self, simulator, packet):
+        if self.device:
+            data = bytes(packet)
+            await self.publish(simulator, f"{self.device}/telemetry", data)
+            self.packet_counter += 1
+            self.bytes_sent += len(data)
+            simulator.tm_packet_counter += 1
+
+        if self.frame_topic:
+            start = perf_counter_ns()
+            aos_frame = self.frame_builder.build(packet, self.frame_counter)
+            simulator.frame_build_time.observe(perf_counter_ns() - start)
+            if aos_frame:
+                if simulator.injector:
+                    aos_frame = simulator.injector.inject(aos_frame)
+                start = perf_counter_ns()
+                payload = encode_frame(aos_frame, self.encoding)
+                simulator.frame_encode_time.observe(
+                    perf_counter_ns() - start, (self.encoding,)
+                )
+                if simulator.batcher:
+                    batches = simulator.batcher.add(
+                        self.frame_topic, self.encoding, payload, self.client
+                    )
+                    for topic, _, message, _ in batches:
+                        await self.publish(simulator, topic, message, JOURNAL_TM_FRAME)
+                else:
+                    await self.publish(
+                        simulator, self.frame_topic, payload, JOURNAL_TM_FRAME
+                    )
+                self.frame_counter += 1
+                self.bytes_sent += len(payload)
+                simulator.tm_frame_counter += 1
+
+    async def run(self, simulator):
+        self.announce(simulator)
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.rate
+        next_time = loop.time()
+        if self.generator:
+            packets = self.generator.packets()
+        else:
+            start = int(self.position * len(simulator.replay))
+            packets = simulator.replay.packets(
+                apids=simulator.apids, loop=True, start=start
+            )
+        for packet in packets:
+            # sleeping even when late gives the other sources a turn
+            await asyncio.sleep(max(0.0, next_time - loop.time()))
+            await self.send(simulator, packet)
+            # absolute schedule, so the rate does not drift with the send cost
+            next_time += interval
+
+    def status(self):
+        status = "{} (SCID {} VCID {}): sent {} TM packets and {} TM frames, {} bytes".format(
+            self.name,
+            self.spacecraft_id,
+            self.vcid,
+            self.packet_counter,
+            self.frame_counter,
+            self.bytes_sent,
+        )
+        if self.generator:
+            status += ". " + self.generator.status()
+        return status
+
+
+def virtual_channel(n):
+    """
+    (spacecraft ID, VCID) of the ``n``-th virtual channel, counting from
+    SPACECRAFT_ID/VCID and moving to the next spacecraft ID every 64 channels.
+    """
+    channel = VCID + n
+    return (SPACECRAFT_ID + channel // 64) % 256, channel % 64
+
+
+def make_virtual_sources(
+    count,
+    rate,
+    device="radio-sim-{n}",
+    frame_topic=None,
+    encoding="leaf",
+    shard=None,
+    fecf=False,
+    schema=None,
+    flag_mix=None,
+    values="random",
+):
+    """
+    Creates ``count`` sources with consecutive virtual channels, starting at
+    SPACECRAFT_ID/VCID and moving to the next spacecraft ID every 64 channels.
+    Their starting points are spread evenly over the capture. With an
+    AstraSchema, each source generates synthetic packets instead, with
+    ``flag_mix`` and ``values`` as in AstraGenerator.
+
+    ``device`` and ``frame_topic`` are templates formatted with the source
+    number ``n``. With ``shard=(worker, workers)`` only every ``workers``-th
+    source starting at ``worker`` is created, so that each virtual channel and
+    its frame counter belong to exactly one worker.
+    """
+    numbers = range(count) if shard is None else range(shard[0], count, shard[1])
+    sources = []
+    for n in numbers:
+        spacecraft_id, vcid = virtual_channel(n)
+        sources.append(
+            VirtualSource(
+                f"source-{n}",
+                device=device.format(n=n) if device else None,
+                frame_topic=frame_topic.format(n=n) if frame_topic else None,
+                encoding=encoding,
+                spacecraft_id=spacecraft_id,
+                vcid=vcid,
+                rate=rate,
+                position=n / count,
+                fecf=fecf,
+                generator=(
+                    AstraGenerator(schema, flag_mix, values, seed=n) if schema else None
+                ),
+            )
+        )
+    return sources
+
+
+async def run_sources(simulator):
+    await asyncio.gather(*(source.run(simulator) for source in simulator.sources))
+
+
+def run_engine(simulator):
+    asyncio.run(run_sources(simulator))
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of integer values (microseconds here).
+
+    Values below ``2**bits`` have their own bucket; above that every power of
+    two is split into ``2**(bits-1)`` buckets, so the relative error stays
+    constant over the whole range while memory grows only logarithmically.
+    Values may be recorded and read from several threads.
+    """
+
+    def __init__(self, bits=HISTOGRAM_SUB_BUCKET_BITS):
+        self.bits = bits
+        self.half = 1 << (bits - 1)
+        self.lock = Lock()
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - self.bits
+        if shift <= 0:
+            return value
+        return shift * self.half + (value >> shift)
+
+    def _highest_equivalent(self, index):
+        if index < 2 * self.half:
+            return index
+        shift = index // self.half - 1
+        return ((index - shift * self.half + 1) << shift) - 1
+
+    def record(self, value):
+        index = self._index(value)
+        with self.lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        with self.lock:
+            if not self.count:
+                return 0
+            target = max(1, self.count * p / 100)
+            seen = 0
+            for index in sorted(self.counts):
+                seen += self.counts[index]
+                if seen >= target:
+                    return min(self._highest_equivalent(index), self.max)
+            return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def distribution(self):
+        """Yields (value, percentile, cumulative count) for every non-empty bucket."""
+        with self.lock:
+            counts = sorted(self.counts.items())
+            count, highest = self.count, self.max
+        seen = 0
+        for index, n in counts:
+            seen += n
+            value = min(self._highest_equivalent(index), highest)
+            yield value, 100 * seen / count, seen
+
+
+class LatencyProbe:
+    """
+    Measures the round trip from the simulator's TM through the backend and back.
+
+    Probe packets carrying an id and the monotonic send time are published as
+    TM packets. Any TC message (or message on ``echo_topic``) containing a
+    probe marker completes that probe and its latency is added to the histogram.
+    """
+
+    def __init__(self, rate=1.0, echo_topic=None, report_path=None):
+        self.rate = rate
+        self.echo_topic = echo_topic
+        self.report_path = report_path
+        self.histogram = LatencyHistogram()
+        self.next_id = 0
+        self.pending = {}  # probe id -> send time, for duplicate and loss detection
+        self.lost = 0
+
+    def make_packet(self, probe_id, send_ns):
+        data = PROBE_STRUCT.pack(PROBE_MAGIC, probe_id, send_ns)
+        header = CCSDS_HEADER_STRUCT.pack(
+            PROBE_APID, 0xC000 | (probe_id & 0x3FFF), len(data) - 1
+        )
+        return header + data
+
+    def run(self, simulator):
+        interval = 1 / self.rate
+        next_time = monotonic()
+        while True:
+            delay = next_time - monotonic()
+            if delay > 0:
+                sleep(delay)
+            next_time += interval
+
+            send_ns = monotonic_ns()
+            probe_id = self.next_id
+            self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+            self.pending[probe_id] = send_ns
+            simulator.publish(
+                simulator.tm_packet_topic, self.make_packet(probe_id, send_ns)
+            )
+            self._expire(send_ns)
+
+    def _expire(self, now_ns):
+        deadline = now_ns - int(PROBE_TIMEOUT * 1e9)
+        for probe_id, send_ns in list(self.pending.items()):
+            # pop, the reply may be arriving on the paho thread right now
+            if send_ns < deadline and self.pending.pop(probe_id, None):
+                self.lost += 1
+
+    def on_message(self, payload):
+        now_ns = monotonic_ns()
+        start = payload.find(PROBE_MAGIC)
+        while start >= 0 and start + PROBE_STRUCT.size <= len(payload):
+            _, probe_id, send_ns = PROBE_STRUCT.unpack_from(payload, start)
+            # the send time must match, or the marker was just a coincidence
+            if self.pending.get(probe_id) == send_ns:
+                if self.pending.pop(probe_id, None) is not None:
+                    self.histogram.record((now_ns - send_ns) // 1000)
+            start = payload.find(PROBE_MAGIC, start + 1)
+
+    def status(self):
+        h = self.histogram
+        return "Latency: {} probes, p50 {:.2f} ms, p99 {:.2f} ms, p99.9 {:.2f} ms, max {:.2f} ms, {} lost".format(
+            h.count,
+            h.percentile(50) / 1000,
+            h.percentile(99) / 1000,
+            h.percentile(99.9) / 1000,
+            h.max / 1000,
+            self.lost,
+        )
+
+    def dump(self, path):
+        """Writes the latency distribution in microseconds to ``path``."""
+        with io.open(path, "w") as f:
+            f.write("# {}\n".format(self.status()))
+            f.write("# value_us percentile count\n")
+            for value, percentile, count in self.histogram.distribution():
+                f.write(f"{value} {percentile:.4f} {count}\n")
+        print(f"Wrote latency distribution to {path}")
+
+
+class CaptureJournal:
+    """
+    Append-only binary journal of every message the simulator sends or receives.
+
+    ``record`` only timestamps the message and queues a reference to its
+    payload, so it can be called from ``send_tm`` and the paho callbacks
+    without waiting for the disk. A background thread writes the records in
+    the JOURNAL_RECORD_STRUCT format and the time/sequence index next to the
+    journal. Payloads must not be modified once recorded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = io.open(path, "wb")
+        self._index = io.open(path + ".idx", "wb")
+        self._file.write(JOURNAL_MAGIC)
+        self._offset = len(JOURNAL_MAGIC)
+        # the lock keeps queue order and timestamps consistent between threads
+        self._lock = Lock()
+        self._queue = SimpleQueue()
+        self._topics = {}
+        self._topic_seqs = []
+        self.seq = 0
+        self.bytes_written = 0
+        self.closed = False
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def record(self, kind, topic, payload):
+        with self._lock:
+            if not self.closed:
+                self._queue.put((monotonic_ns(), kind, topic, payload))
+
+    def _run(self):
+        queue = self._queue
+        while True:
+            try:
+                item = queue.get(timeout=JOURNAL_FLUSH_INTERVAL)
+            except Empty:
+                continue
+            while item is not None:
+                self._write(*item)
+                try:
+                    item = queue.get_nowait()
+                except Empty:
+                    break
+            # the index never points past data that is not on disk yet
+            self._file.flush()
+            self._index.flush()
+            if item is None:
+                return
+
+    def _write(self, time_ns, kind, topic, payload):
+        topic_id = self._topics.get(topic)
+        if topic_id is None:
+            topic_id = len(self._topics)
+            self._topics[topic] = topic_id
+            self._topic_seqs.append(0)
+            self._append(time_ns, 0, JOURNAL_TOPIC, topic_id, topic.encode())
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self._append(time_ns, self._topic_seqs[topic_id], kind, topic_id, payload)
+        self._topic_seqs[topic_id] = (self._topic_seqs[topic_id] + 1) & 0xFFFFFFFF
+
+    def _append(self, time_ns, topic_seq, kind, topic_id, payload):
+        if kind == JOURNAL_TOPIC or self.seq % JOURNAL_INDEX_INTERVAL == 0:
+            self._index.write(
+                JOURNAL_INDEX_STRUCT.pack(kind, time_ns, self.seq, self._offset)
+            )
+        header = JOURNAL_RECORD_STRUCT.pack(
+            time_ns, self.seq, topic_seq, kind, topic_id, len(payload)
+        )
+        self._file.write(header)
+        self._file.write(payload)
+        self._offset += len(header) + len(payload)
+        self.seq += 1
+        self.bytes_written += len(header) + len(payload)
+
+    def close(self):
+        """Writes the queued records and closes the journal."""
+        with self._lock:
+            self.closed = True
+            self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        self._index.close()
+
+    def queued(self):
+        """Number of records waiting to be written (approximate)."""
+        return self._queue.qsize()
+
+    def status(self):
+        return "Journal: {} records, {:.1f} MB, {} queued".format(
+            self.seq, self.bytes_written / 1e6, self.queued()
+        )
+
+
+class JournalReader:
+    """
+    Memory-mapped reader of a CaptureJournal.
+
+    The index is loaded when the reader is opened, so ``records`` seeks
+    straight to the checkpoint before the requested time or sequence number
+    and scans from there. Payloads are handed out as ``memoryview`` slices of
+    the mapping and must not be kept beyond the lifetime of the reader. A
+    journal whose index is missing or incomplete (e.g. after a crash) is
+    still read in full, scanning from the last checkpoint.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = io.open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        if size < len(JOURNAL_MAGIC):
+            raise ValueError(f"{path} is not a simulator journal")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        if self._view[: len(JOURNAL_MAGIC)] != JOURNAL_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a simulator journal")
+
+        self.topics = {}
+        self.index_times = array("Q")
+        self.index_seqs = array("Q")
+        self.index_offsets = array("Q")
+        try:
+            with io.open(path + ".idx", "rb") as f:
+                index = f.read()
+        except FileNotFoundError:
+            index = b""
+        entry_size = JOURNAL_INDEX_STRUCT.size
+        for pos in range(0, len(index) - entry_size + 1, entry_size):
+            kind, time_ns, seq, offset = JOURNAL_INDEX_STRUCT.unpack_from(index, pos)
+            if offset + JOURNAL_RECORD_STRUCT.size > size:
+                break
+            if kind == JOURNAL_TOPIC:
+                self._read_topic(offset)
+            else:
+                self.index_times.append(time_ns)
+                self.index_seqs.append(seq)
+                self.index_offsets.append(offset)
+
+        self.start_ns = 0
+        if size >= len(JOURNAL_MAGIC) + JOURNAL_RECORD_STRUCT.size:
+            self.start_ns = JOURNAL_RECORD_STRUCT.unpack_from(
+                self._view, len(JOURNAL_MAGIC)
+            )[0]
+
+    def _read_topic(self, offset):
+        _, _, _, _, topic_id, length = JOURNAL_RECORD_STRUCT.unpack_from(
+            self._view, offset
+        )
+        start = offset + JOURNAL_RECORD_STRUCT.size
+        self.topics[topic_id] = bytes(self._view[start : start + length]).decode()
+
+    def _seek(self, checkpoints, value):
+        """Offset of the last checkpoint at or before ``value``."""
+        n = bisect_right(checkpoints, value) - 1
+        return self.index_offsets[n] if n >= 0 else len(JOURNAL_MAGIC)
+
+    def records(self, start=0.0, end=None, kinds=None, first_seq=None):
+        """
+        Yields ``(time_ns, seq, topic_seq, kind, topic, payload)`` for each
+        record from ``start`` to ``end`` (seconds since the first record) or
+        from journal sequence number ``first_seq``, optionally only of the
+        given kinds.
+        """
+        start_ns = self.start_ns + int(start * 1e9)
+        end_ns = None if end is None else self.start_ns + int(end * 1e9)
+        if first_seq is not None:
+            offset = self._seek(self.index_seqs, first_seq)
+        else:
+            first_seq = 0
+            offset = self._seek(self.index_times, start_ns)
+
+        view = self._view
+        size = len(view)
+        topics = self.topics
+        unpack = JOURNAL_RECORD_STRUCT.unpack_from
+        header_size = JOURNAL_RECORD_STRUCT.size
+        while offset + header_size <= size:
+            time_ns, seq, topic_seq, kind, topic_id, length = unpack(view, offset)
+            data = offset + header_size
+            offset = data + length
+            if offset > size:
+                # the journal was cut short while this record was written
+                return
+            if kind == JOURNAL_TOPIC:
+                topics[topic_id] = bytes(view[data:offset]).decode()
+                continue
+            if end_ns is not None and time_ns >= end_ns:
+                return
+            if time_ns < start_ns or seq < first_seq:
+                continue
+            if kinds is None or kind in kinds:
+                yield time_ns, seq, topic_seq, kind, topics[topic_id], view[data:offset]
+
+    def replay(self, send, start=0.0, end=None, kinds=JOURNAL_SENT_KINDS, speed=1.0):
+        """
+        Calls ``send(topic, payload, kind)`` for each record of a time window
+        with the original spacing between records, divided by ``speed`` (None
+        sends as fast as possible). Like ReplayTiming, every send time is
+        computed from the first record so sleep overshoot does not accumulate.
+
+        Returns the number of records sent.
+        """
+        origin = None
+        count = 0
+        for time_ns, _, _, kind, topic, payload in self.records(start, end, kinds):
+            now = monotonic_ns()
+            if origin is None:
+                origin = (now, time_ns)
+            elif speed is not None:
+                delay = (origin[0] + (time_ns - origin[1]) / speed - now) / 1e9
+                if delay > 0:
+                    sleep(delay)
+            send(topic, bytes(payload), kind)
+            count += 1
+        return count
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def parse_journal_window(spec):
+    """Parses a START:END command line argument, in seconds, END being optional."""
+    start, _, end = spec.partition(":")
+    try:
+        window = (float(start or 0), float(end) if end else None)
+    except ValueError:
+        window = (-1.0, None)
+    if window[0] < 0 or (window[1] is not None and window[1] <= window[0]):
+        raise argparse.ArgumentTypeError(
+            "expected START:END in seconds since the start of the journal, END optional"
+        )
+    return window
+
+
+def replay_journal(simulator):
+    """Publishes the TM recorded in a journal again, within the journal window."""
+
+    def send(topic, payload, kind):
+        simulator.publish(topic, payload, retain=kind == JOURNAL_METADATA, kind=kind)
+        if kind == JOURNAL_TM_PACKET:
+            simulator.tm_packet_counter += 1
+        elif kind == JOURNAL_TM_FRAME:
+            simulator.tm_frame_counter += 1
+
+    start, end = simulator.journal_window
+    simulator.journal_replay.replay(send, start, end, speed=simulator.speed)
+
+
+class TcLatencyModel:
+    """Simulated command processing time, drawn from one of TC_LATENCY_DISTRIBUTIONS."""
+
+    def __init__(self, distribution, params, seed=None):
+        if distribution not in TC_LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution '{distribution}'")
+        if len(params) != TC_LATENCY_DISTRIBUTIONS[distribution]:
+            raise ValueError(
+                "{} takes {} parameters".format(
+                    distribution, TC_LATENCY_DISTRIBUTIONS[distribution]
+                )
+            )
+        if any(param < 0 for param in params):
+            raise ValueError("Latency parameters cannot be negative")
+        self.distribution = distribution
+        self.params = params
+        self._random = random.Random(seed)
+
+    def sample(self):
+        """A processing time in seconds."""
+        p = self.params
+        if self.distribution == "uniform":
+            ms = self._random.uniform(p[0], p[1])
+        elif self.distribution == "exponential":
+            ms = self._random.expovariate(1 / p[0]) if p[0] else 0.0
+        elif self.distribution == "lognormal":
+            ms = p[0] * math.exp(self._random.gauss(0.0, p[1]))
+        else:
+            ms = p[0]
+        return ms / 1000
+
+    def __str__(self):
+        return "{}:{}".format(
+            self.distribution, ",".join(f"{p:g}" for p in self.params)
+        )
+
+
+def parse_tc_latency(spec):
+    """Parses a DISTRIBUTION:PARAMS command line argument into a TcLatencyModel."""
+    distribution, _, params = spec.partition(":")
+    try:
+        return TcLatencyModel(distribution, [float(p) for p in params.split(",") if p])
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(
+            "{}, expected one of fixed:MS, uniform:MIN,MAX, exponential:MEAN, "
+            "lognormal:MEDIAN,SIGMA".format(e)
+        )
+
+
+def strip_cltu(data):
+    """
+    Returns the TC frame carried in a CLTU, or ``data`` itself if it does not
+    start with the CLTU start sequence. The BCH parity is not checked.
+    """
+    if data[: len(CLTU_START)] != CLTU_START:
+        return data
+    frame = bytearray()
+    for pos in range(len(CLTU_START), len(data), CLTU_CODEBLOCK_LENGTH):
+        codeblock = data[pos : pos + CLTU_CODEBLOCK_LENGTH]
+        if codeblock == CLTU_TAIL or len(codeblock) < CLTU_CODEBLOCK_LENGTH:
+            break
+        frame += codeblock[:-1]
+    return bytes(frame)
+
+
+def decode_tc_frame(data):
+    """
+    Decodes a TC transfer frame, bare or in a CLTU.
+
+    Returns the spacecraft ID, VCID, frame sequence number and data field, or
+    None if the frame is truncated. The frame length drops the CLTU fill, a
+    trailing CRC-16 is recognised by matching and a segment header (sequence
+    flags set, which a packet's version number never has) is skipped.
+    """
+    frame = strip_cltu(data)
+    if len(frame) < TC_FRAME_HEADER_STRUCT.size:
+        return None
+    flags_scid, vcid_length, seq = TC_FRAME_HEADER_STRUCT.unpack_from(frame)
+    length = (vcid_length & 0x3FF) + 1
+    if not TC_FRAME_HEADER_STRUCT.size <= length <= len(frame):
+        return None
+    frame = frame[:length]
+    end = length
+    if length >= TC_FRAME_HEADER_STRUCT.size + FECF_LENGTH and check_fecf(frame):
+        end -= FECF_LENGTH
+    data_field = frame[TC_FRAME_HEADER_STRUCT.size : end]
+    if data_field and data_field[0] >> 6 == 0b11:
+        data_field = data_field[1:]
+    return flags_scid & 0x3FF, vcid_length >> 10, seq, data_field
+
+
+class TcResponder:
+    """
+    Acknowledges commands the way a flight computer would.
+
+    The paho callbacks only queue each TC with its arrival time. A worker
+    thread decodes the CCSDS headers (of the TC frame and of the packet it
+    carries), draws a processing time from the latency model and, once it has
+    elapsed, publishes a TC_ACK_APID packet on the TM packet topic and in TM
+    frames. Commands are processed concurrently, so the latency does not
+    limit the command rate. The time each TC spends in the simulator, queue
+    included, goes into a histogram.
+
+    The acks share the frames of the simulator's TM stream, or with a
+    ``frame_builder`` of their own (the virtual sources each own their
+    channel) go in frames on its virtual channel, counted by the responder.
+    """
+
+    def __init__(self, latency, frame_builder=None):
+        self.latency = latency
+        self.frame_builder = frame_builder
+        self.frame_count = 0
+        self._queue = SimpleQueue()
+        # (due time in ns, arrival number, ack fields without the time in the
+        # simulator, arrival time in ns) of the TCs being processed
+        self._due = []
+        self.histogram = LatencyHistogram()
+        self.received = 0
+        self.acked = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.ack_seq_count = 0
+        # (time, received) at the start of the current rate window
+        self.window = None
+        self.window_rate = 0.0
+
+    def submit(self, payload, frame=False):
+        """Queues a TC received on the paho network thread."""
+        self._queue.put((monotonic_ns(), time_ns(), payload, frame))
+        self.received += 1
+
+    def depth(self):
+        """TCs received and not acknowledged yet."""
+        return self._queue.qsize() + len(self._due)
+
+    def _process(self, item, number):
+        arrival_ns, receive_ns, payload, frame = item
+        source = TC_ACK_FRAME if frame else TC_ACK_PACKET
+        status = TC_ACK_ACCEPTED
+        apid = seq_count = frame_seq = 0
+        packet = payload
+        if frame:
+            decoded = decode_tc_frame(payload)
+            if decoded is None:
+                packet = b""
+            else:
+                _, _, frame_seq, packet = decoded
+        if len(packet) >= CCSDS_HEADER_STRUCT.size:
+            packet_id, seq_ctrl, data_length = CCSDS_HEADER_STRUCT.unpack_from(packet)
+            apid = packet_id & 0x7FF
+            seq_count = seq_ctrl & 0x3FFF
+            if data_length + 7 > len(packet):
+                status = TC_ACK_REJECTED
+        else:
+            status = TC_ACK_REJECTED
+        fields = (source, status, apid, seq_count, frame_seq, len(payload), receive_ns)
+        due = arrival_ns + int(self.latency.sample() * 1e9)
+        heappush(self._due, (due, number, fields, arrival_ns))
+
+    def _acknowledge(self, simulator, fields, arrival_ns):
+        in_simulator = (monotonic_ns() - arrival_ns) // 1000
+        data = TC_ACK_STRUCT.pack(*fields, min(in_simulator, 0xFFFFFFFF))
+        header = CCSDS_HEADER_STRUCT.pack(
+            TC_ACK_APID, 0xC000 | self.ack_seq_count, len(data) - 1
+        )
+        self.ack_seq_count = (self.ack_seq_count + 1) & 0x3FFF
+        packet = header + data
+        simulator.publish(simulator.tm_packet_topic, packet)
+        simulator.tm_packet_counter += 1
+        if self.frame_builder is None:
+            send_packet_frames(simulator, packet)
+        else:
+            aos_frame = self.frame_builder.build(packet, self.frame_count)
+            if aos_frame:
+                self.frame_count += 1
+                publish_frame(simulator, aos_frame)
+        self.histogram.record(in_simulator)
+        if fields[1] == TC_ACK_REJECTED:
+            self.rejected += 1
+        else:
+            self.acked += 1
+
+    def run(self, simulator):
+        number = 0
+        while True:
+            timeout = None
+            if self._due:
+                timeout = max(0.0, (self._due[0][0] - monotonic_ns()) / 1e9)
+            try:
+                item = self._queue.get(timeout=timeout)
+                self._process(item, number)
+                number += 1
+            except Empty:
+                pass
+            self.max_depth = max(self.max_depth, self.depth())
+            now = monotonic_ns()
+            while self._due and self._due[0][0] <= now:
+                _, _, fields, arrival_ns = heappop(self._due)
+                self._acknowledge(simulator, fields, arrival_ns)
+
+    def arrival_rate(self):
+        """TC arrival rate over the last window of at least one second."""
+        now = monotonic()
+        if self.window is None:
+            self.window = (now, self.received)
+        window_start, window_received = self.window
+        if now - window_start >= 1.0:
+            self.window_rate = (self.received - window_received) / (now - window_start)
+            self.window = (now, self.received)
+        return self.window_rate
+
+    def status(self):
+        h = self.histogram
+        return (
+            "TC responder ({}): {} received ({:.1f}/s), {} acked, {} rejected, "
+            "{} queued (max {}), in simulator p50 {:.2f} ms p99 {:.2f} ms max {:.2f} ms".format(
+                self.latency,
+                self.received,
+                self.arrival_rate(),
+                self.acked,
+                self.rejected,
+                self.depth(),
+                self.max_depth,
+                h.percentile(50) / 1000,
+                h.percentile(99) / 1000,
+                h.max / 1000,
+            )
+        )
+
+
+def on_tc_packet(client, userdata, message):
+    simulator = userdata
+    simulator.last_tc = message.payload
+    simulator.tc_packet_counter += 1
+    if simulator.journal:
+        simulator.journal.record(JOURNAL_TC_PACKET, message.topic, message.payload)
+    if simulator.responder:
+        simulator.responder.submit(message.payload)
+    if simulator.probe:
+        simulator.probe.on_message(message.payload)
+
+
+def on_tc_frame(client, userdata, message):
+    simulator = userdata
+    simulator.last_tc = message.payload
+    simulator.tc_frame_counter += 1
+    if simulator.journal:
+        simulator.journal.record(JOURNAL_TC_FRAME, message.topic, message.payload)
+    if simulator.responder:
+        simulator.responder.submit(message.payload, frame=True)
+    if simulator.probe:
+        simulator.probe.on_message(message.payload)
+
+
+class PublishWindow:
+    """
+    Limits the number of publishes the broker has not acknowledged yet.
+
+    ``acquire`` blocks once ``max_inflight`` messages are outstanding, which
+    pushes back on the sender instead of letting paho queue without bound.
+    Acknowledgements are paho's ``on_publish``: PUBACK at QoS 1, PUBCOMP at
+    QoS 2, and the write to the socket at QoS 0.
+    """
+
+    def __init__(self, max_inflight=DEFAULT_MAX_INFLIGHT):
+        self.max_inflight = max_inflight
+        self._slots = BoundedSemaphore(max_inflight)
+        self._lock = Lock()
+        # (id of the transport, mid) -> QoS of the publishes awaiting on_publish
+        self._pending = {}
+        # acknowledgements that arrived before publish() returned the mid
+        self._early = set()
+        self.published = 0
+        self.acked = 0
+        self.failed = 0
+        self.blocked_time = 0.0
+
+    def acquire(self):
+        if not self._slots.acquire(blocking=False):
+            start = monotonic()
+            self._slots.acquire()
+            self.blocked_time += monotonic() - start
+
+    async def acquire_async(self):
+        """``acquire`` for the asyncio engine, waiting without blocking the event loop."""
+        if not self._slots.acquire(blocking=False):
+            start = monotonic()
+            await asyncio.get_running_loop().run_in_executor(None, self._slots.acquire)
+            self.blocked_time += monotonic() - start
+
+    def track(self, client, info, qos=0):
+        """
+        Registers the result of ``client.publish``, releasing the slot on
+        failure. paho still queues a QoS 1/2 message it could not send for
+        want of a connection and acknowledges it after reconnecting, so
+        that one keeps its slot until then.
+        """
+        key = (id(client), info.mid)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            with self._lock:
+                self.failed += 1
+                if not (info.rc == mqtt.MQTT_ERR_NO_CONN and qos > 0):
+                    # no acknowledgement will come, nor may a stale one
+                    # release a slot once the mid wraps around
+                    self._early.discard(key)
+                    self._slots.release()
+                    return
+        with self._lock:
+            self.published += 1
+            if key in self._early:
+                self._early.remove(key)
+                self.acked += 1
+                self._slots.release()
+            else:
+                self._pending[key] = qos
+
+    def on_publish(self, client, mid):
+        key = (id(client), mid)
+        with self._lock:
+            if key in self._pending:
+                del self._pending[key]
+                self.acked += 1
+                self._slots.release()
+            else:
+                self._early.add(key)
+
+    def backlog(self, client):
+        """
+        Publishes of ``client`` awaiting on_publish: at QoS 0 not written
+        out yet, at QoS 1/2 not acknowledged yet.
+        """
+        client_id = id(client)
+        unsent = unacked = 0
+        with self._lock:
+            for (owner, _), qos in self._pending.items():
+                if owner == client_id:
+                    if qos:
+                        unacked += 1
+                    else:
+                        unsent += 1
+        return unsent, unacked
+
+    def status(self):
+        return "Publish: {} acked of {}, {} inflight (max {}), {} failed, blocked {:.1f}s".format(
+            self.acked,
+            self.published,
+            len(self._pending),
+            self.max_inflight,
+            self.failed,
+            self.blocked_time,
+        )
+
+
+def parse_topic_qos(spec):
+    """Parses a TOPIC=QOS command line argument."""
+    topic, _, qos = spec.rpartition("=")
+    if not topic or qos not in ("0", "1", "2"):
+        raise argparse.ArgumentTypeError("expected TOPIC=QOS with QOS 0, 1 or 2")
+    return topic, int(qos)
+
+
+class MqttTransport:
+    """
+    Sends the simulator's messages to an MQTT broker through a paho client.
+
+    Transports publish with ``publish(topic, payload, qos, retain, kind)``,
+    returning paho's message info (``rc`` and ``mid``), report every sent
+    message to the simulator's PublishWindow, pass received messages to the
+    callbacks given to ``subscribe`` as paho would and report their
+    ``backlog``: QoS 0 messages not written out yet and QoS 1/2 messages not
+    acknowledged yet.
+    """
+
+    def __init__(self, simulator, host, port, use_tls=False):
+        self.window = simulator.window
+        self.client = mqtt.Client(userdata=simulator)
+        self.client.on_publish = self._on_publish
+        # let paho keep as many QoS 1/2 messages in flight as our own window
+        self.client.max_inflight_messages_set(self.window.max_inflight)
+        if use_tls:
+            self.client.tls_set(cert_reqs=ssl.CERT_NONE)
+            self.client.tls_insecure_set(True)
+
+        print(f"Connecting to broker: {host} on port: {port} (TLS: {use_tls})")
+        self.client.connect(host, port)
+
+    def _on_publish(self, client, userdata, mid):
+        self.window.on_publish(self, mid)
+
+    def publish(self, topic, payload, qos=0, retain=False, kind=JOURNAL_TM_PACKET):
+        return self.client.publish(topic, payload, qos=qos, retain=retain)
+
+    def subscribe(self, topic, callback):
+        self.client.subscribe(topic)
+        self.client.message_callback_add(topic, callback)
+
+    def backlog(self):
+        # paho has no public API for its queues, the window keeps count instead
+        return self.window.backlog(self)
+
+    def start(self):
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.loop_stop()
+
+
+class SinkMessage:
+    """A message delivered by a sink transport, with paho's ``topic`` and ``payload``."""
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class SinkPublishInfo:
+    """The result of publishing to a sink transport: always successful."""
+
+    rc = mqtt.MQTT_ERR_SUCCESS
+
+    def __init__(self, mid):
+        self.mid = mid
+
+
+class NullTransport:
+    """
+    Drops every message, to measure the simulator without any broker.
+
+    Messages count as sent as soon as they are published. ``deliver`` hands
+    a message to the callbacks subscribed to its topic, e.g. to inject TC.
+    """
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.window = simulator.window
+        self.callbacks = {}
+        self._mid = 0
+
+    def publish(self, topic, payload, qos=0, retain=False, kind=JOURNAL_TM_PACKET):
+        self._mid += 1
+        self.sink(topic, payload, qos, retain, kind)
+        # acknowledged before the window tracks it, which PublishWindow handles
+        self.window.on_publish(self, self._mid)
+        return SinkPublishInfo(self._mid)
+
+    def sink(self, topic, payload, qos, retain, kind):
+        pass
+
+    def subscribe(self, topic, callback):
+        self.callbacks[topic] = callback
+
+    def deliver(self, topic, payload):
+        callback = self.callbacks.get(topic)
+        if callback:
+            callback(self, self.simulator, SinkMessage(topic, payload))
+
+    def backlog(self):
+        return 0, 0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class MemoryTransport(NullTransport):
+    """
+    Keeps the ``(topic, payload, qos, retain)`` of the last ``max_messages``
+    messages (all of them if None) in ``messages``, for tests.
+    """
+
+    def __init__(self, simulator, max_messages=None):
+        super().__init__(simulator)
+        self.messages = deque(maxlen=max_messages)
+
+    def sink(self, topic, payload, qos, retain, kind):
+        self.messages.append((topic, payload, qos, retain))
+
+
+class FileTransport(NullTransport):
+    """
+    Writes every message to a CaptureJournal at ``path`` instead of sending
+    it, so it can be read with JournalReader or sent later with
+    --replay-journal.
+    """
+
+    def __init__(self, simulator, path):
+        super().__init__(simulator)
+        self.journal = CaptureJournal(path)
+
+    def sink(self, topic, payload, qos, retain, kind):
+        self.journal.record(kind, topic, payload)
+
+    def backlog(self):
+        return self.journal.queued(), 0
+
+    def stop(self):
+        self.journal.close()
+
+
+def on_probe_echo(client, userdata, message):
+    userdata.probe.on_message(message.payload)
+
+
+def _measure(label, func, count, unit="frames", per_call=1):
+    start = perf_counter()
+    for i in range(count // per_call):
+        func(i)
+    elapsed = perf_counter() - start
+    rate = (count // per_call) * per_call / elapsed
+    print(f"  {label:<36} {rate:>14,.0f} {unit}/s")
+    return rate
+
+
+def run_benchmarks(count):
+    """Micro-benchmarks of the per-frame code paths, no broker needed."""
+    packet = bytes(make_idle_ccsds_packet(BENCHMARK_PACKET_LENGTH))
+    builder = AosFrameBuilder()
+    print(
+        f"Framing {count} packets of {len(packet)} bytes into {AOS_FRAME_LENGTH} byte AOS frames"
+    )
+    before = _measure("build_aos_frame", lambda i: build_aos_frame(packet, i), count)
+    after = _measure("AosFrameBuilder.build", lambda i: builder.build(packet, i), count)
+    _measure(
+        "AosFrameBuilder.build_view",
+        lambda i: builder.build_view(packet, i),
+        count,
+    )
+    print(f"  frame builder speedup: {after / before:.1f}x")
+
+    frame = builder.build(packet, 0)
+    frames = [frame] * BENCHMARK_BATCH_SIZE
+    print(f"Leaf hex encoding of {AOS_FRAME_LENGTH} byte frames")
+    before = _measure(
+        "generator join",
+        lambda i: " ".join(f"0x{byte:02x}" for byte in frame),
+        count,
+    )
+    after = _measure("leaf_hex", lambda i: leaf_hex(frame), count)
+    _measure(
+        f"leaf_hex_batch ({BENCHMARK_BATCH_SIZE} frames)",
+        lambda i: leaf_hex_batch(frames),
+        count,
+        per_call=BENCHMARK_BATCH_SIZE,
+    )
+    print(f"  hex encoding speedup: {after / before:.1f}x")
+
+    print(f"Frame error control over {AOS_FRAME_LENGTH} byte frames")
+    _measure("frame_crc", lambda i: frame_crc(frame), count)
+    _measure(
+        f"check_fecf_batch ({BENCHMARK_BATCH_SIZE} frames)",
+        lambda i: check_fecf_batch(frames),
+        count,
+        per_call=BENCHMARK_BATCH_SIZE,
+    )
+    injector = BitErrorInjector(1e-5, seed=0)
+    _measure("BitErrorInjector.inject (1e-5)", lambda i: injector.inject(frame), count)
+
+    packer = AosFramePacker()
+    print(f"Dense packing of {len(packet)} byte packets")
+    _measure("AosFramePacker.add", lambda i: packer.add(packet), count, unit="packets")
+    print(f"  {packer.status()}")
+
+
+def format_status(counters, last_tc):
+    """Formats (TM packets, TM frames, TC packets, TC frames) counters and the last TC."""
+    cmdhex = None
+    if last_tc:
+        cmdhex = binascii.hexlify(last_tc).decode("ascii")
+    return "Sent: {} TM packets and {} TM frames. Received: {} TC packets and {} TC frames. Last TC: {}".format(
+        *counters, cmdhex
+    )
+
+
+def show_status(get_status):
+    """Rewrites the status line whenever it changes, until interrupted."""
+    prev_status = None
+    while True:
+        status = get_status()
+        if status != prev_status:
+            sys.stdout.write("\r")
+            sys.stdout.write(status)
+            sys.stdout.flush()
+            prev_status = status
+        sleep(0.5)
+
+
+class Metric:
+    """
+    A counter, gauge or summary of a MetricsRegistry, with a value for each
+    combination of label values (a tuple in the order of ``labels``).
+
+    Summaries record durations in nanoseconds in a LatencyHistogram and are
+    exported in seconds. If ``func`` is given the metric is read from it when
+    collected instead, as a single value or a dict of values by label values.
+    The TM, TC responder and batch threads all update metrics, hence the lock.
+    """
+
+    def __init__(self, name, kind, help, labels=(), func=None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = labels
+        self.func = func
+        self.lock = Lock()
+        self.values = {}
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+    def observe(self, duration_ns, labels=()):
+        with self.lock:
+            histogram = self.values.get(labels)
+            if histogram is None:
+                histogram = self.values[labels] = LatencyHistogram()
+        histogram.record(duration_ns)
+
+    def samples(self):
+        if self.func is None:
+            with self.lock:
+                return list(self.values.items())
+        value = self.func()
+        return list(value.items()) if isinstance(value, dict) else [((), value)]
+
+    def key(self, label_values, suffix="", extra=()):
+        """The sample name with its labels, as in the Prometheus text format."""
+        pairs = list(zip(self.labels, label_values)) + list(extra)
+        if not pairs:
+            return self.name + suffix
+        escaped = (
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            for _, value in pairs
+        )
+        return "{}{}{{{}}}".format(
+            self.name,
+            suffix,
+            ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)),
+        )
+
+
+class MetricsRegistry:
+    """
+    The simulator's counters, gauges and duration summaries, exported in the
+    Prometheus text format or as a snapshot for the JSON-lines metrics file.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, name, kind, help, labels, func):
+        metric = Metric(name, kind, help, labels, func)
+        self.metrics[name] = metric
+        return metric
+
+    def counter(self, name, help, labels=(), func=None):
+        return self._add(name, "counter", help, labels, func)
+
+    def gauge(self, name, help, labels=(), func=None):
+        return self._add(name, "gauge", help, labels, func)
+
+    def summary(self, name, help, labels=()):
+        return self._add(name, "summary", help, labels, None)
+
+    def prometheus(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for label_values, value in metric.samples():
+                if metric.kind != "summary":
+                    lines.append(f"{metric.key(label_values)} {value}")
+                    continue
+                for q in METRIC_QUANTILES:
+                    key = metric.key(label_values, extra=[("quantile", q)])
+                    lines.append(f"{key} {value.percentile(100 * q) / 1e9}")
+                lines.append(f"{metric.key(label_values, '_sum')} {value.total / 1e9}")
+                lines.append(f"{metric.key(label_values, '_count')} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Current values, by kind and sample name; summaries in seconds."""
+        snapshot = {"counter": {}, "gauge": {}, "summary": {}}
+        for metric in self.metrics.values():
+            values = snapshot[metric.kind]
+            for label_values, value in metric.samples():
+                key = metric.key(label_values)
+                if metric.kind != "summary":
+                    values[key] = value
+                    continue
+                values[key] = {
+                    "count": value.count,
+                    "mean": value.mean() / 1e9,
+                    "max": value.max / 1e9,
+                    **{
+                        f"p{100 * q:g}": value.percentile(100 * q) / 1e9
+                        for q in METRIC_QUANTILES
+                    },
+                }
+        return snapshot
+
+
+def serve_metrics(registry, address):
+    """Serves the metrics in the Prometheus text format on http://<address>/metrics."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.partition("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            # requests would scramble the status line
+            pass
+
+    server = ThreadingHTTPServer(address, MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    print("Serving metrics on http://{}:{}/metrics".format(*server.server_address))
+    return server
+
+
+def write_metrics(registry, path, interval=DEFAULT_METRICS_INTERVAL):
+    """
+    Appends a JSON line with a snapshot of the metrics to ``path`` every
+    ``interval`` seconds, with the per second rate of every counter since the
+    previous line.
+    """
+    previous = None
+    with io.open(path, "a") as f:
+        while True:
+            sleep(interval)
+            now = monotonic()
+            snapshot = registry.snapshot()
+            rates = {}
+            if previous:
+                elapsed = now - previous[0]
+                rates = {
+                    key: (value - previous[1].get(key, 0)) / elapsed
+                    for key, value in snapshot["counter"].items()
+                }
+            line = {
+                "time": datetime.datetime.now().isoformat(),
+                "counters": snapshot["counter"],
+                "rates": rates,
+                "gauges": snapshot["gauge"],
+                "summaries": snapshot["summary"],
+            }
+            f.write(json.dumps(line) + "\n")
+            f.flush()
+            previous = (now, snapshot["counter"])
+
+
+def parse_listen_address(spec):
+    """Parses a [HOST:]PORT command line argument, HOST defaulting to localhost."""
+    host, _, port = spec.rpartition(":")
+    if not port.isdigit():
+        raise argparse.ArgumentTypeError("expected [HOST:]PORT")
+    return host or "127.0.0.1", int(port)
+
+
+def make_simulator(args, load=None, probe=None, shard=None):
+    """Creates the Simulator described by the command line arguments."""
+    frame_topics = dict(args.frame_topic) if args.frame_topic else None
+    journal = args.journal
+    if journal and shard is not None:
+        # one journal per worker process
+        journal = f"{journal}.{shard[0]}"
+    metrics_address = args.metrics_listen
+    metrics_file = args.metrics_file
+    if shard is not None:
+        # and one metrics endpoint and file
+        if metrics_address:
+            metrics_address = (metrics_address[0], metrics_address[1] + shard[0])
+        if metrics_file:
+            metrics_file = f"{metrics_file}.{shard[0]}"
+    transport_file = args.transport_file
+    if transport_file and shard is not None:
+        transport_file = f"{transport_file}.{shard[0]}"
+    schema = AstraSchema(args.astra_layout) if args.astra_layout else None
+    responder = None
+    if args.tc_latency:
+        ack_frames = None
+        if args.sources:
+            # the channel after the last source's
+            ack_frames = AosFrameBuilder(*virtual_channel(args.sources), fecf=args.fecf)
+        responder = TcResponder(args.tc_latency, ack_frames)
+    sources = make_virtual_sources(
+        args.sources,
+        args.source_rate,
+        device=args.source_device,
+        # A.S.T.R.A. packets are not CCSDS packets, so they are not framed
+        frame_topic=None if schema else args.source_frame_topic,
+        encoding=args.source_encoding,
+        shard=shard,
+        fecf=args.fecf,
+        schema=schema,
+        flag_mix=dict(args.astra_flags) if args.astra_flags else None,
+        values=args.astra_values,
+    )
+    return Simulator(
+        args.broker,
+        load=load,
+        probe=probe,
+        qos=args.qos,
+        topic_qos=dict(args.topic_qos) if args.topic_qos else None,
+        max_inflight=args.max_inflight,
+        flush_timeout=args.flush_timeout if args.pack else None,
+        fecf=args.fecf,
+        bit_error_rate=args.bit_error_rate,
+        frame_topics=frame_topics,
+        capture=None if schema or args.replay_journal else args.capture,
+        apids=args.apid,
+        loop=args.loop,
+        timestamps=args.timestamps,
+        speed=args.speed,
+        sources=sources,
+        connections=args.connections,
+        # only one worker listens to TC so that commands are counted once
+        subscribe_tc=shard is None or shard[0] == 0,
+        journal=journal,
+        replay_journal=args.replay_journal,
+        journal_window=args.journal_window,
+        responder=responder,
+        metrics_address=metrics_address,
+        metrics_file=metrics_file,
+        metrics_interval=args.metrics_interval,
+        transport=args.transport,
+        transport_file=transport_file,
+        max_messages=DEFAULT_MEMORY_TRANSPORT_MESSAGES,
+        batch_max_bytes=args.batch_max_bytes if args.batch else None,
+        batch_linger=args.batch_linger,
+    )
+
+
+def measure_batching(args, batch, seconds, results):
+    """
+    Entry point of a --batch-compare run: sends TM for ``seconds`` with or
+    without batching and puts the frames/s, and the messages/s and bytes/s on
+    the frame topics, on the ``results`` queue.
+    """
+    args.batch = batch
+    load = LoadGenerator(LoadProfile("steady", args.rate or UNTHROTTLED_RATE))
+    simulator = make_simulator(args, load=load)
+    simulator.start()
+    sleep(seconds)
+    frames = simulator.tm_frame_counter
+    messages = sent_bytes = 0
+    for (topic,), count in simulator.topic_messages.samples():
+        if topic in simulator.frame_topics:
+            messages += count
+    for (topic,), count in simulator.topic_bytes.samples():
+        if topic in simulator.frame_topics:
+            sent_bytes += count
+    results.put((frames / seconds, messages / seconds, sent_bytes / seconds))
+    simulator.stop()
+
+
+def compare_batching(args):
+    """Measures the simulator with batching off and on, one process each."""
+    results = multiprocessing.Queue()
+    rows = []
+    for batch in (False, True):
+        process = multiprocessing.Process(
+            target=measure_batching, args=(args, batch, args.batch_compare, results)
+        )
+        process.start()
+        rows.append((batch, results.get()))
+        process.join()
+
+    print(
+        "Sending {} for {:g}s, {}:".format(
+            (
+                "at {:g} packets/s".format(args.rate)
+                if args.rate
+                else "as fast as possible"
+            ),
+            args.batch_compare,
+            (
+                ", ".join(f"{topic}={encoding}" for topic, encoding in args.frame_topic)
+                if args.frame_topic
+                else "yamcs-tm-frames=leaf"
+            ),
+        )
+    )
+    for batch, (frames, messages, sent_bytes) in rows:
+        label = (
+            "batched ({} bytes, {:g} ms)".format(
+                args.batch_max_bytes, args.batch_linger * 1000
+            )
+            if batch
+            else "one frame per message"
+        )
+        print(
+            f"  {label:<32} {frames:>10,.0f} frames/s {messages:>10,.0f} messages/s "
+            f"{frames / max(messages, 1e-9):>6.1f} frames/message {sent_bytes / 1e6:>8.1f} MB/s"
+        )
+
+
+def run_worker(worker, args, counters, last_tc):
+    """
+    Entry point of a --workers process: runs its shard of the virtual sources
+    on its own MQTT connections and publishes its counters to the parent.
+    """
+    simulator = make_simulator(args, shard=(worker, args.workers))
+    simulator.start()
+    try:
+        while True:
+            counters[worker * 4 : worker * 4 + 4] = simulator.counters()
+            if simulator.last_tc:
+                # whole bytes, so that the hex always decodes
+                cmdhex = binascii.hexlify(
+                    simulator.last_tc[: (MAX_SHARED_TC_LENGTH - 1) // 2]
+                )
+                with last_tc.get_lock():
+                    last_tc.value = cmdhex
+            sleep(0.25)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+def run_workers(args):
+    """Runs the virtual sources sharded over ``args.workers`` processes."""
+    counters = multiprocessing.Array("q", args.workers * 4, lock=False)
+    last_tc = multiprocessing.Array("c", MAX_SHARED_TC_LENGTH)
+    workers = [
+        multiprocessing.Process(
+            target=run_worker, args=(worker, args, counters, last_tc), daemon=True
+        )
+        for worker in range(args.workers)
+    ]
+    for process in workers:
+        process.start()
+
+    def aggregated_status():
+        totals = [sum(counters[i::4]) for i in range(4)]
+        with last_tc.get_lock():
+            cmdhex = last_tc.value
+        return format_status(totals, binascii.unhexlify(cmdhex))
+
+    try:
+        show_status(aggregated_status)
+    except KeyboardInterrupt:
+        for process in workers:
+            process.join()
+        sys.stdout.write("\n" + aggregated_status() + "\n")
+        sys.stdout.flush()
+
+
+class Simulator:
+    def __init__(
+        self,
+        broker,
+        load=None,
+        frame_topics=None,
+        capture="testdata.ccsds",
+        apids=None,
+        loop=False,
+        timestamps=None,
+        speed=1.0,
+        sources=None,
+        connections=1,
+        subscribe_tc=True,
+        probe=None,
+        qos=0,
+        topic_qos=None,
+        max_inflight=DEFAULT_MAX_INFLIGHT,
+        flush_timeout=None,
+        fecf=False,
+        bit_error_rate=0.0,
+        journal=None,
+        replay_journal=None,
+        journal_window=(0.0, None),
+        responder=None,
+        metrics_address=None,
+        metrics_file=None,
+        metrics_interval=DEFAULT_METRICS_INTERVAL,
+        transport="mqtt",
+        transport_file=None,
+        max_messages=None,
+        batch_max_bytes=None,
+        batch_linger=DEFAULT_BATCH_LINGER,
+    ):
+        self.tm_packet_counter = 0
+        self.tc_packet_counter = 0
+        self.tm_frame_counter = 0
+        self.tc_frame_counter = 0
+        self.tm_thread = None
+        self.last_tc = None
+        self.load = load
+        self.qos = qos
+        self.topic_qos = topic_qos or {}
+        self.window = PublishWindow(max_inflight)
+        self.probe = probe
+        self.probe_thread = None
+        self.responder = responder
+        self.responder_thread = None
+        # sources generating their own packets do not need a capture
+        self.replay = CcsdsReplaySource(capture) if capture else None
+        self.apids = apids
+        self.loop = loop
+        self.speed = speed
+        # everything sent and received is recorded in this journal, and the
+        # TM of a previously recorded journal can be sent instead of the capture
+        self.journal = CaptureJournal(journal) if journal else None
+        self.journal_replay = JournalReader(replay_journal) if replay_journal else None
+        self.journal_window = journal_window
+        # packets are sent at their capture times if these come from the
+        # secondary header ("header") or from a sidecar index file (its path)
+        self.timing = None
+        if timestamps == "header":
+            self.timing = ReplayTiming(self.replay.header_times(), speed)
+        elif timestamps:
+            times = load_sidecar_times(timestamps, len(self.replay))
+            self.timing = ReplayTiming(times, speed)
+        self.frame_builder = AosFrameBuilder(fecf=fecf)
+        # held while a frame is built and published with tm_frame_counter
+        self.frame_lock = Lock()
+        self.injector = None
+        if bit_error_rate:
+            self.injector = BitErrorInjector(bit_error_rate)
+        # with a flush timeout, packets are packed densely into frames instead
+        # of one packet and an idle packet per frame
+        self.packer = None
+        self.flush_thread = None
+        if flush_timeout is not None:
+            self.packer = AosFramePacker(flush_timeout=flush_timeout, fecf=fecf)
+        # with a size limit, frames are sent in batches of several per message
+        self.batcher = None
+        self.batch_thread = None
+        if batch_max_bytes:
+            self.batcher = FrameBatcher(batch_max_bytes, batch_linger)
+        self.tm_packet_topic = "yamcs-tm-packets"
+        self.tc_packet_topic = "yamcs-tc-packets"
+        self.tm_frame_topic = "yamcs-tm-frames"
+        # every frame is published once on each of these topics, in the given encoding
+        self.frame_topics = frame_topics or {self.tm_frame_topic: "leaf"}
+        self.tm_frame_bytes = {topic: 0 for topic in self.frame_topics}
+        self.tc_frame_topic = "yamcs-tc-frames"
+
+        if broker.startswith("tcp://"):
+            broker = broker[6:]
+            self.use_tls = False
+        elif broker.startswith("ssl://") or broker.startswith("tls://"):
+            broker = broker[6:]
+            self.use_tls = True
+        else:
+            raise ValueError("Broker must start with tcp://, ssl://, or tls://")
+
+        self.broker, self.port = broker.split(":")
+        self.port = int(self.port)
+
+        if transport not in TRANSPORTS:
+            raise ValueError(
+                "Unknown transport '{}', expected one of {}".format(
+                    transport, ", ".join(TRANSPORTS)
+                )
+            )
+        self.transport = transport
+        self.transport_file = transport_file
+        self.max_messages = max_messages
+        self.client = self._connect()
+        if subscribe_tc:
+            self.client.subscribe(self.tc_packet_topic, on_tc_packet)
+            self.client.subscribe(self.tc_frame_topic, on_tc_frame)
+
+        if self.probe and self.probe.echo_topic:
+            self.client.subscribe(self.probe.echo_topic, on_probe_echo)
+
+        # virtual sources run on the asyncio engine and share a pool of
+        # connections, the first one being the connection receiving TC.
+        # The other transports are shared by all sources.
+        self.sources = sources or []
+        self.clients = [self.client]
+        if transport == "mqtt":
+            for _ in range(1, min(connections, len(self.sources))):
+                self.clients.append(self._connect())
+        for n, source in enumerate(self.sources):
+            source.client = self.clients[n % len(self.clients)]
+
+        self.metrics = MetricsRegistry()
+        self._register_metrics()
+        self.metrics_address = metrics_address
+        self.metrics_server = None
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+
+    def _register_metrics(self):
+        metrics = self.metrics
+        # updated on the publishing paths
+        self.topic_messages = metrics.counter(
+            "simulator_messages_total", "Messages published", ("topic",)
+        )
+        self.topic_bytes = metrics.counter(
+            "simulator_bytes_total", "Payload bytes published", ("topic",)
+        )
+        self.publish_time = metrics.summary(
+            "simulator_publish_seconds", "Duration of the paho publish call"
+        )
+        self.frame_build_time = metrics.summary(
+            "simulator_frame_build_seconds",
+            "Time to build (or pack) the AOS frames of a packet",
+        )
+        self.frame_encode_time = metrics.summary(
+            "simulator_frame_encode_seconds",
+            "Time to encode a frame for a frame topic (hex and Leaf JSON for leaf)",
+            ("encoding",),
+        )
+        # read from the simulator's own counters when collected
+        metrics.counter(
+            "simulator_tm_packets_total",
+            "TM packets sent",
+            func=lambda: self.tm_packet_counter,
+        )
+        metrics.counter(
+            "simulator_tm_frames_total",
+            "TM frames sent",
+            func=lambda: self.tm_frame_counter,
+        )
+        metrics.counter(
+            "simulator_tc_received_total",
+            "TC messages received",
+            ("kind",),
+            func=lambda: {
+                ("packet",): self.tc_packet_counter,
+                ("frame",): self.tc_frame_counter,
+            },
+        )
+        metrics.gauge(
+            "simulator_transport_out_packets",
+            "QoS 0 messages the transport has not written out yet",
+            func=lambda: sum(client.backlog()[0] for client in self.clients),
+        )
+        metrics.gauge(
+            "simulator_transport_out_messages",
+            "QoS 1 and 2 messages the transport holds until they are acknowledged",
+            func=lambda: sum(client.backlog()[1] for client in self.clients),
+        )
+        metrics.gauge(
+            "simulator_publish_inflight",
+            "Publishes not acknowledged by the broker yet",
+            func=lambda: len(self.window._pending),
+        )
+        metrics.counter(
+            "simulator_publish_blocked_seconds_total",
+            "Time spent waiting for room in the inflight window",
+            func=lambda: self.window.blocked_time,
+        )
+        metrics.counter(
+            "simulator_publish_failed_total",
+            "Publishes paho refused",
+            func=lambda: self.window.failed,
+        )
+        if self.responder:
+            metrics.gauge(
+                "simulator_tc_queue_depth",
+                "TCs received and not acknowledged yet",
+                func=self.responder.depth,
+            )
+            metrics.counter(
+                "simulator_tc_acks_total",
+                "TC acknowledgements sent",
+                ("status",),
+                func=lambda: {
+                    ("accepted",): self.responder.acked,
+                    ("rejected",): self.responder.rejected,
+                },
+            )
+        if self.sources:
+            metrics.counter(
+                "simulator_source_tm_packets_total",
+                "TM packets sent by each virtual source",
+                labels=("source",),
+                func=lambda: {(s.name,): s.packet_counter for s in self.sources},
+            )
+            metrics.counter(
+                "simulator_source_tm_frames_total",
+                "TM frames sent by each virtual source",
+                labels=("source",),
+                func=lambda: {(s.name,): s.frame_counter for s in self.sources},
+            )
+            metrics.counter(
+                "simulator_source_bytes_total",
+                "Bytes sent by each virtual source",
+                labels=("source",),
+                func=lambda: {(s.name,): s.bytes_sent for s in self.sources},
+            )
+        if self.batcher:
+            metrics.counter(
+                "simulator_batch_messages_total",
+                "Messages carrying batched frames",
+                func=lambda: self.batcher.messages,
+            )
+            metrics.counter(
+                "simulator_batch_frames_total",
+                "Frames sent in batches",
+                func=lambda: self.batcher.frames,
+            )
+        if self.journal:
+            metrics.gauge(
+                "simulator_journal_queued",
+                "Records waiting for the journal writer",
+                func=self.journal.queued,
+            )
+
+    def _connect(self):
+        if self.transport == "null":
+            return NullTransport(self)
+        if self.transport == "memory":
+            return MemoryTransport(self, self.max_messages)
+        if self.transport == "file":
+            return FileTransport(self, self.transport_file)
+        return MqttTransport(self, self.broker, self.port, self.use_tls)
+
+    def publish(
+        self,
+        topic,
+        payload,
+        client=None,
+        retain=False,
+        kind=JOURNAL_TM_PACKET,
+        acquired=False,
+    ):
+        """
+        Publishes with the QoS configured for ``topic``, waiting for room in
+        the inflight window first unless the caller ``acquired`` a slot
+        already. ``kind`` is what the message is recorded as in the journal.
+        """
+        client = client or self.client
+        if self.journal:
+            self.journal.record(kind, topic, payload)
+        if not acquired:
+            self.window.acquire()
+        qos = self.topic_qos.get(topic, self.qos)
+        start = perf_counter_ns()
+        info = client.publish(topic, payload, qos=qos, retain=retain, kind=kind)
+        self.publish_time.observe(perf_counter_ns() - start)
+        self.topic_messages.inc(1, (topic,))
+        self.topic_bytes.inc(len(payload), (topic,))
+        self.window.track(client, info, qos)
+        return info
+
+    def start(self):
+        if self.sources:
+            target = run_engine
+        elif self.journal_replay:
+            target = replay_journal
+        else:
+            target = send_tm
+        self.tm_thread = Thread(target=target, args=(self,))
+        self.tm_thread.daemon = True
+        self.tm_thread.start()
+        if self.packer and not self.sources:
+            self.flush_thread = Thread(target=flush_frames, args=(self,))
+            self.flush_thread.daemon = True
+            self.flush_thread.start()
+        if self.probe:
+            self.probe_thread = Thread(target=self.probe.run, args=(self,))
+            self.probe_thread.daemon = True
+            self.probe_thread.start()
+        if self.batcher:
+            self.batch_thread = Thread(target=flush_batches, args=(self,))
+            self.batch_thread.daemon = True
+            self.batch_thread.start()
+        if self.responder:
+            self.responder_thread = Thread(target=self.responder.run, args=(self,))
+            self.responder_thread.daemon = True
+            self.responder_thread.start()
+        if self.metrics_address:
+            self.metrics_server = serve_metrics(self.metrics, self.metrics_address)
+        if self.metrics_file:
+            Thread(
+                target=write_metrics,
+                args=(self.metrics, self.metrics_file, self.metrics_interval),
+                daemon=True,
+            ).start()
+        for client in self.clients:
+            client.start()
+
+    def stop(self):
+        for source in self.sources:
+            source.retire(self)
+        if self.batcher:
+            publish_batches(self, self.batcher.flush())
+        for client in self.clients:
+            client.stop()
+        if self.probe and self.probe.report_path:
+            self.probe.dump(self.probe.report_path)
+        if self.journal:
+            self.journal.close()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+
+    def source_status(self):
+        return "\n".join(source.status() for source in self.sources)
+
+    def source_summary(self):
+        """Packets/frames sent by each source, for the status line."""
+        shown = self.sources[:MAX_STATUS_SOURCES]
+        summary = ", ".join(
+            f"{source.name} {source.packet_counter}/{source.frame_counter}"
+            for source in shown
+        )
+        rest = self.sources[len(shown) :]
+        if rest:
+            summary += " and {} more sending {}-{} packets/source".format(
+                len(rest),
+                min(source.packet_counter for source in rest),
+                max(source.packet_counter for source in rest),
+            )
+        return "Sources (packets/frames): " + summary
+
+    def counters(self):
+        return (
+            self.tm_packet_counter,
+            self.tm_frame_counter,
+            self.tc_packet_counter,
+            self.tc_frame_counter,
+        )
+
+    def print_status(self):
+        status = format_status(self.counters(), self.last_tc)
+        if len(self.frame_topics) > 1 and self.tm_frame_counter:
+            status += ". Bytes/frame: " + ", ".join(
+                "{} {:.0f}".format(topic, n / self.tm_frame_counter)
+                for topic, n in self.tm_frame_bytes.items()
+            )
+        if self.sources:
+            status += ". " + self.source_summary()
+        if self.load:
+            status += ". " + self.load.status()
+        if self.timing:
+            status += ". " + self.timing.status()
+        if self.probe:
+            status += ". " + self.probe.status()
+        if self.responder:
+            status += ". " + self.responder.status()
+        if self.packer:
+            status += ". " + self.packer.status()
+        if self.batcher:
+            status += ". " + self.batcher.status()
+        if self.injector:
+            status += ". " + self.injector.status()
+        if self.qos or self.topic_qos or self.window.failed:
+            status += ". " + self.window.status()
+        if self.journal:
+            status += ". " + self.journal.status()
+        return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MQTT Simulator")
+    parser.add_argument(
+        "--broker",
+        type=str,
+        default="tcp://mrt.leomindlin.com:1883",
+        help="MQTT broker address",
+    )
+    parser.add_argument(
+        "--transport",
+        choices=TRANSPORTS,
+        default="mqtt",
+        help="Send to the MQTT broker, or without any broker: drop every message (null), keep "
+        "the last {} in memory (memory) or write them to --transport-file (file)".format(
+            DEFAULT_MEMORY_TRANSPORT_MESSAGES
+        ),
+    )
+    parser.add_argument(
+        "--transport-file",
+        metavar="PATH",
+        default=None,
+        help="Journal the file transport writes to (PATH.<n> per worker), "
+        "readable like a --journal",
+    )
+    parser.add_argument(
+        "--qos",
+        type=int,
+        choices=(0, 1, 2),
+        default=0,
+        help="MQTT QoS of the published messages",
+    )
+    parser.add_argument(
+        "--topic-qos",
+        type=parse_topic_qos,
+        action="append",
+        metavar="TOPIC=QOS",
+        help="QoS for one topic, overriding --qos (can be repeated)",
+    )
+    parser.add_argument(
+        "--max-inflight",
+        type=int,
+        default=DEFAULT_MAX_INFLIGHT,
+        help="Maximum number of publishes not yet acknowledged before the simulator waits",
+    )
+    parser.add_argument(
+        "--capture",
+        default="testdata.ccsds",
+        help="CCSDS packet capture replayed as TM",
+    )
+    parser.add_argument(
+        "--apid",
+        type=int,
+        action="append",
+        help="Only replay packets with this APID (can be repeated)",
+    )
+    parser.add_argument(
+        "--loop",
+        action="store_true",
+        help="Restart the capture when reaching its end (always on in load generator mode)",
+    )
+    parser.add_argument(
+        "--timestamps",
+        metavar="header|PATH",
+        default=None,
+        help="Replay packets at their capture times, taken from the CUC time in the "
+        "secondary header ('header') or from a sidecar file with one time in seconds per packet",
+    )
+    parser.add_argument(
+        "--speed",
+        type=parse_speed,
+        default=1.0,
+        help="Timestamp and journal replay speed multiplier (e.g. 0.5, 10, 100) or 'max' for as fast as possible",
+    )
+    parser.add_argument(
+        "--rate",
+        type=parse_positive,
+        default=None,
+        help="Load generator mode: target TM packets/s (each packet is also sent as one AOS frame). "
+        "Without it the simulator sends one packet per second and stops at the end of the capture",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=LOAD_PROFILES,
+        default="steady",
+        help="Load generator burst profile",
+    )
+    parser.add_argument(
+        "--ramp-seconds",
+        type=parse_non_negative,
+        default=60.0,
+        help="Time for the ramp profile to reach the target rate",
+    )
+    parser.add_argument(
+        "--spike-period",
+        type=parse_positive,
+        default=30.0,
+        help="Spike profile: seconds between the start of two spikes",
+    )
+    parser.add_argument(
+        "--spike-seconds",
+        type=parse_non_negative,
+        default=5.0,
+        help="Spike profile: duration of each spike",
+    )
+    parser.add_argument(
+        "--spike-factor",
+        type=parse_positive,
+        default=5.0,
+        help="Spike profile: rate multiplier during a spike",
+    )
+    parser.add_argument(
+        "--frame-topic",
+        type=parse_frame_topic,
+        action="append",
+        metavar="TOPIC=ENCODING",
+        help="Publish TM frames on TOPIC encoded as one of {}. Can be repeated to send "
+        "several encodings side by side (default: yamcs-tm-frames=leaf)".format(
+            ", ".join(FRAME_ENCODINGS)
+        ),
+    )
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="Pack as many packets as fit into each frame, spanning frame boundaries, "
+        "instead of one packet and an idle packet per frame",
+    )
+    parser.add_argument(
+        "--flush-timeout",
+        type=parse_positive,
+        default=DEFAULT_FLUSH_TIMEOUT,
+        help="With --pack, seconds a partially filled frame waits before being completed with idle data",
+    )
+    parser.add_argument(
+        "--fecf",
+        action="store_true",
+        help="End every frame with a CRC-16 Frame Error Control Field "
+        "(the frame link then needs errorDetection: CRC16)",
+    )
+    parser.add_argument(
+        "--bit-error-rate",
+        type=parse_bit_error_rate,
+        default=0.0,
+        help="Flip random bits of the sent frames with this probability per bit",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Send several frames per MQTT message: binary frames as a bundle of payloads each "
+        "behind its 16-bit big-endian length, Leaf messages as a JSON array",
+    )
+    parser.add_argument(
+        "--batch-max-bytes",
+        type=int,
+        default=DEFAULT_BATCH_MAX_BYTES,
+        help="With --batch, largest message sent",
+    )
+    parser.add_argument(
+        "--batch-linger",
+        type=float,
+        default=DEFAULT_BATCH_LINGER,
+        help="With --batch, seconds a frame may wait for more frames to share its message",
+    )
+    parser.add_argument(
+        "--batch-compare",
+        type=float,
+        metavar="SECONDS",
+        default=None,
+        help="Send TM for SECONDS without and then with batching (at --rate, or as fast as "
+        "possible), print the frames/s and messages/s of both and exit",
+    )
+    parser.add_argument(
+        "--sources",
+        type=int,
+        default=0,
+        help="Run N virtual sources concurrently on the asyncio engine instead of the single TM stream",
+    )
+    parser.add_argument(
+        "--source-rate",
+        type=parse_positive,
+        default=1.0,
+        help="Packets/s sent by each virtual source",
+    )
+    parser.add_argument(
+        "--source-device",
+        default="radio-sim-{n}",
+        help="Device name template of the virtual sources, their packets go to <device>/telemetry "
+        "(empty to send no packets)",
+    )
+    parser.add_argument(
+        "--source-frame-topic",
+        default="yamcs-tm-frames",
+        help="Frame topic template of the virtual sources (empty to send no frames)",
+    )
+    parser.add_argument(
+        "--source-encoding",
+        choices=FRAME_ENCODINGS,
+        default="leaf",
+        help="Frame encoding of the virtual sources",
+    )
+    parser.add_argument(
+        "--astra-layout",
+        metavar="PATH",
+        default=None,
+        help="Make the virtual sources send synthetic A.S.T.R.A. packets following the layout "
+        "written by the XTCE converter (e.g. xtce-converter/output.layout.json); --sources defaults to 1",
+    )
+    parser.add_argument(
+        "--astra-flags",
+        type=parse_flag_mix,
+        action="append",
+        metavar="ATOMIC=PROBABILITY",
+        help="Probability that ATOMIC is in a synthetic packet ('*' for all others, default 1). "
+        "Can be repeated",
+    )
+    parser.add_argument(
+        "--astra-values",
+        choices=ASTRA_VALUE_MODES,
+        default="random",
+        help="Synthetic parameter values: random, or following a sine or ramp waveform",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=1,
+        help="Number of MQTT connections shared by the virtual sources",
+    )
+    parser.add_argument(
+        "--probe-rate",
+        type=parse_positive,
+        default=None,
+        help="Send latency probes at this rate (probes/s) and report the TM to TC round trip",
+    )
+    parser.add_argument(
+        "--probe-echo-topic",
+        default=None,
+        help="Also look for probe replies on this topic, besides the TC topics",
+    )
+    parser.add_argument(
+        "--latency-file",
+        default=None,
+        help="Write the latency distribution to this file on exit",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Shard the virtual sources over N processes, each with its own MQTT connections "
+        "(--sources defaults to N)",
+    )
+    parser.add_argument(
+        "--tc-latency",
+        type=parse_tc_latency,
+        metavar="DISTRIBUTION:MS",
+        default=None,
+        help="Acknowledge every TC packet and frame with a TM packet (APID 0x{:x}) after a "
+        "processing time drawn from fixed:MS, uniform:MIN,MAX, exponential:MEAN or "
+        "lognormal:MEDIAN,SIGMA (milliseconds)".format(TC_ACK_APID),
+    )
+    parser.add_argument(
+        "--metrics-listen",
+        type=parse_listen_address,
+        metavar="[HOST:]PORT",
+        default=None,
+        help="Serve the simulator metrics in the Prometheus text format on "
+        "http://HOST:PORT/metrics (HOST defaults to 127.0.0.1, worker n uses PORT+n)",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        metavar="PATH",
+        default=None,
+        help="Append a JSON line with the metrics and the rate of every counter to PATH "
+        "every --metrics-interval seconds (PATH.<n> per worker)",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=DEFAULT_METRICS_INTERVAL,
+        help="Seconds between two lines of the metrics file",
+    )
+    parser.add_argument(
+        "--journal",
+        metavar="PATH",
+        default=None,
+        help="Record every TM packet, TM frame and TC message sent or received to this journal "
+        "(with its index in PATH.idx, and PATH.<n> per worker)",
+    )
+    parser.add_argument(
+        "--replay-journal",
+        metavar="PATH",
+        default=None,
+        help="Send the TM packets, TM frames and metadata recorded in a journal again, "
+        "byte for byte, instead of replaying the capture",
+    )
+    parser.add_argument(
+        "--journal-window",
+        type=parse_journal_window,
+        metavar="START:END",
+        default=(0.0, None),
+        help="With --replay-journal, only send what was recorded from START to END seconds "
+        "after the start of the journal (END optional)",
+    )
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        metavar="N",
+        default=None,
+        help="Run the frame generation micro-benchmarks over N frames and exit",
+    )
+
+    args = parser.parse_args()
+
+    if args.transport == "file" and not args.transport_file:
+        parser.error("--transport file needs --transport-file")
+
+    if args.rate is not None and args.timestamps:
+        parser.error("--rate and --timestamps cannot be used together")
+
+    if args.astra_layout:
+        args.sources = args.sources or 1
+
+    if args.sources and (args.rate is not None or args.timestamps):
+        parser.error("--sources cannot be combined with --rate or --timestamps")
+
+    if args.sources and (args.pack or args.frame_topic):
+        # the sources frame one packet per frame, on --source-frame-topic
+        parser.error(
+            "--sources cannot be combined with --pack or --frame-topic, "
+            "use --source-frame-topic and --source-encoding"
+        )
+
+    if args.replay_journal and (
+        args.sources or args.rate is not None or args.timestamps or args.workers > 1
+    ):
+        parser.error(
+            "--replay-journal cannot be combined with --sources, --rate, --timestamps or --workers"
+        )
+
+    if args.workers > 1:
+        if args.rate is not None or args.timestamps or args.probe_rate:
+            parser.error(
+                "--workers cannot be combined with --rate, --timestamps or --probe-rate"
+            )
+        args.sources = args.sources or args.workers
+
+    if args.benchmark:
+        run_benchmarks(args.benchmark)
+        sys.exit(0)
+
+    if args.batch_compare:
+        if args.sources or args.timestamps or args.replay_journal or args.workers > 1:
+            parser.error(
+                "--batch-compare cannot be combined with --sources, --timestamps, "
+                "--replay-journal or --workers"
+            )
+        compare_batching(args)
+        sys.exit(0)
+
+    load = None
+    if args.rate is not None:
+        load = LoadGenerator(
+            LoadProfile(
+                args.profile,
+                args.rate,
+                ramp_seconds=args.ramp_seconds,
+                spike_period=args.spike_period,
+                spike_seconds=args.spike_seconds,
+                spike_factor=args.spike_factor,
+            )
+        )
+
+    if args.workers > 1:
+        run_workers(args)
+        sys.exit(0)
+
+    probe = None
+    if args.probe_rate:
+        probe = LatencyProbe(
+            args.probe_rate,
+            echo_topic=args.probe_echo_topic,
+            report_path=args.latency_file,
+        )
+
+    simulator = make_simulator(args, load=load, probe=probe)
+    simulator.start()
+
+    try:
+        show_status(simulator.print_status)
     except KeyboardInterrupt:
         sys.stdout.write("\n")
+        if simulator.sources:
+            sys.stdout.write(simulator.source_status() + "\n")
         sys.stdout.flush()
-        simulator.client.loop_stop()
+        simulator.stop()
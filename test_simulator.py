@@ -0,0 +1,24 @@
+import struct
+import simulator
+
+
+def test_packer_flushes_tail_of_spanning_packet(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(simulator, "monotonic", lambda: now[0])
+    packer = simulator.AosFramePacker(frame_length=40, flush_timeout=1.0)
+    packet = bytes(range(50))
+
+    frames = packer.add(packet)
+    assert len(frames) == 1
+    assert frames[0][8:40] == packet[:32]
+    assert packer.poll() == []
+
+    now[0] += 1.5
+    frames = packer.poll()
+    assert len(frames) == 1
+    tail = len(packet) - packer.data_length
+    (fhp,) = struct.unpack_from(">H", frames[0], 6)
+    # the idle packet completing the frame starts right after the tail
+    assert fhp == tail
+    assert frames[0][8 : 8 + tail] == packet[32:]
+    assert packer.poll() == []
@@ -0,0 +1,258 @@
+"""
+Decodes a whole capture of back to back A.S.T.R.A. packets into NumPy columns.
+
+Packets are walked once to find their offsets. Where each atomic starts in
+every packet then follows from the flags of the atomics before it, so each
+atomic is decoded for all the packets carrying it at once through a
+structured dtype, however many distinct bitmaps the capture has. The result
+is one array per parameter (``<atomic>.<parameter>``) plus
+``<atomic>.index``, the packet number of each row, saved as an .npz file.
+"""
+
+from typing import Any
+import argparse
+import json
+import numpy as np
+from calibration import compile_calibration
+from layout import container_bits, field_kind
+from structplan import bit_segments, is_padding
+
+# NumPy dtype letters for the little-endian field encodings
+DTYPE_KINDS = {"uint": "u", "int": "i", "float": "f"}
+
+
+def field_plan(
+    entries: list[tuple[str, int, int]], encodings: dict[str, dict[str, Any]]
+) -> tuple[np.dtype, list[tuple]]:
+    """
+    Build the structured dtype of a container and the steps turning its fields
+    into parameter values.
+
+    Each step is ``(name, field, low, mask, kind, signed)``: sub-byte values
+    are ``(field >> low) & mask``, other values are read from ``field`` as is.
+    Integers split over several bytes have a tuple of ``(field, low, mask)``
+    parts as their ``field``, least significant part first.
+    """
+    size_bits = container_bits(entries)
+    if size_bits % 8:
+        raise ValueError(f"Container is {size_bits} bits, not a whole number of bytes")
+
+    names, formats, offsets = [], [], []
+    steps = []
+
+    def byte_field(byte: int) -> str:
+        field = f"_byte{byte}"
+        if field not in names:
+            names.append(field)
+            formats.append("u1")
+            offsets.append(byte)
+        return field
+
+    for name, bitpos, bits in sorted(entries, key=lambda entry: entry[1]):
+        if is_padding(name):
+            continue
+        kind, signed = field_kind(name, encodings)
+        byte, shift = divmod(bitpos, 8)
+
+        if bits < 8 and shift + bits <= 8:
+            low = 8 - shift - bits
+            steps.append((name, byte_field(byte), low, (1 << bits) - 1, kind, signed))
+            continue
+
+        if shift or bits % 8:
+            if kind not in ("uint", "int"):
+                raise ValueError(
+                    f"'{name}' ({bits} bits at bit {bitpos}) is not byte aligned"
+                )
+            parts = tuple(
+                (byte_field(part_byte), low, (1 << width) - 1)
+                for part_byte, low, width in bit_segments(bitpos, bits)
+            )
+            steps.append((name, parts, None, None, kind, signed))
+            continue
+        size = bits // 8
+        if kind == "string":
+            fmt = f"S{size}"
+        elif kind in DTYPE_KINDS and size in (1, 2, 4, 8):
+            if kind == "float" and size == 1:
+                raise ValueError(f"No decoder for 8-bit float field '{name}'")
+            fmt = f"<{DTYPE_KINDS[kind]}{size}"
+        elif kind in ("uint", "int") and size < 8:
+            # Odd widths (24, 40 bits...) are assembled from their bytes
+            fmt = f"({size},)u1"
+        else:
+            raise ValueError(f"No decoder for {bits}-bit {kind} field '{name}'")
+        names.append(name)
+        formats.append(fmt)
+        offsets.append(byte)
+        steps.append((name, name, 0, None, kind, signed))
+
+    dtype = np.dtype(
+        {
+            "names": names,
+            "formats": formats,
+            "offsets": offsets,
+            "itemsize": size_bits // 8,
+        }
+    )
+    return dtype, steps
+
+
+def _values(records: np.ndarray, step: tuple) -> np.ndarray:
+    name, field, low, mask, kind, signed = step
+    if isinstance(field, tuple):
+        # Little endian by byte: the first part holds the lowest bits. Built
+        # unsigned so that 64-bit fields do not overflow
+        value = np.zeros(len(records), dtype=np.uint64)
+        done = 0
+        for part, part_low, part_mask in field:
+            bits = (records[part] >> part_low) & part_mask
+            value |= bits.astype(np.uint64) << np.uint64(done)
+            done += part_mask.bit_length()
+        if signed:
+            sign = np.uint64(1 << (done - 1))
+            return ((value ^ sign) - sign).view(np.int64)
+        return value
+    column = records[field]
+    if mask is not None:
+        column = (column >> low) & mask
+        if kind == "bool":
+            return column != 0
+        if signed:
+            sign = 1 << (mask.bit_length() - 1)
+            return (column.astype(np.int8) ^ sign) - sign
+        return column
+    if column.ndim == 2:
+        # Little-endian bytes of an odd width integer
+        weights = np.left_shift(1, 8 * np.arange(column.shape[1], dtype=np.int64))
+        value = (column.astype(np.int64) * weights).sum(axis=1)
+        if signed:
+            sign = 1 << (8 * column.shape[1] - 1)
+            value = np.where(value & sign, value - 2 * sign, value)
+        return value
+    return column
+
+
+def _gather(buffer: np.ndarray, offsets: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """Read a record of ``dtype`` at each byte offset of the buffer."""
+    count = len(buffer) - dtype.itemsize + 1
+    if count <= 0:
+        return np.zeros(0, dtype=dtype)
+    # A record starting at every byte, so fancy indexing copies only the
+    # records that are needed
+    records = np.ndarray((count,), dtype=dtype, buffer=buffer, strides=(1,))
+    return records[offsets]
+
+
+def scan_packets(buffer: np.ndarray, layout: dict[str, Any]) -> tuple[np.ndarray, int]:
+    """
+    Walk the packets of a capture.
+
+    Returns each packet's offset and the number of trailing bytes left over.
+    """
+    header = layout["header"]
+    header_size = container_bits(header) // 8
+    flags = [(name, bitpos) for name, bitpos, _ in header if name.endswith("_flag")]
+    first = min(bitpos // 8 for _, bitpos in flags)
+    last = max(bitpos // 8 for _, bitpos in flags) + 1
+    # Size of the atomics flagged by each value of each byte of the bitmap,
+    # so a packet's size takes one lookup per byte
+    tables = [[0] * 256 for _ in range(first, last)]
+    for name, bitpos in flags:
+        size = container_bits(layout["atomics"][name[: -len("_flag")]]) // 8
+        table = tables[bitpos // 8 - first]
+        mask = 0x80 >> (bitpos % 8)
+        for value in range(256):
+            if value & mask:
+                table[value] += size
+
+    data = buffer.tobytes()
+    sizes: dict[bytes, int] = {}
+    offsets = []
+    pos, end = 0, len(data)
+    while pos + header_size <= end:
+        bitmap = data[pos + first : pos + last]
+        size = sizes.get(bitmap)
+        if size is None:
+            size = sizes[bitmap] = header_size + sum(
+                table[value] for table, value in zip(tables, bitmap)
+            )
+        if pos + size > end:
+            break
+        offsets.append(pos)
+        pos += size
+
+    return np.array(offsets, dtype=np.int64), end - pos
+
+
+def decode_capture(
+    buffer: bytes, layout: dict[str, Any], calibrate: bool = True
+) -> dict[str, np.ndarray]:
+    """
+    Decode every packet in ``buffer`` into per-parameter columns.
+    """
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    offsets, leftover = scan_packets(raw, layout)
+    if leftover:
+        print(f"Ignoring {leftover} trailing bytes of an incomplete packet")
+    encodings = layout["parameters"]
+
+    header_dtype, header_steps = field_plan(layout["header"], encodings)
+    headers = _gather(raw, offsets, header_dtype)
+    columns = {step[0]: _values(headers, step) for step in header_steps}
+
+    # Where the next atomic would start in each packet
+    position = offsets + header_dtype.itemsize
+    for name, entries in layout["atomics"].items():
+        dtype, steps = field_plan(entries, encodings)
+        present = columns[f"{name}_flag"]
+        rows = np.flatnonzero(present)
+        if len(rows):
+            records = _gather(raw, position[rows], dtype)
+            columns[f"{name}.index"] = rows
+            for step in steps:
+                columns[f"{name}.{step[0]}"] = _values(records, step)
+            position += present * dtype.itemsize
+
+    if calibrate:
+        for column in list(columns):
+            _, _, param = column.rpartition(".")
+            expression = encodings.get(param, {}).get("calibration")
+            if expression and not column.endswith(".index"):
+                columns[column] = compile_calibration(expression)(columns[column])
+
+    return columns
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Decode an A.S.T.R.A. capture into per-parameter NumPy arrays"
+    )
+    parser.add_argument("capture", help="File of back to back A.S.T.R.A. packets")
+    parser.add_argument(
+        "-l",
+        "--layout",
+        default="output.layout.json",
+        help="Layout written by converter.py (default: output.layout.json)",
+    )
+    parser.add_argument(
+        "-o", "--output", help="Output .npz file (default: <capture>.npz)"
+    )
+    parser.add_argument(
+        "--raw", action="store_true", help="Do not apply the calibrations"
+    )
+    args = parser.parse_args()
+
+    with open(args.layout) as f:
+        layout = json.load(f)["layout"]
+    with open(args.capture, "rb") as f:
+        buffer = f.read()
+
+    columns = decode_capture(buffer, layout, calibrate=not args.raw)
+    output_path = args.output or f"{args.capture}.npz"
+    np.savez(output_path, **columns)
+    print(f"✅ Decoded {len(columns['seq'])} packets into {output_path}")
+
+
+if __name__ == "__main__":
+    main()
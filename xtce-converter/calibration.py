@@ -0,0 +1,174 @@
+"""
+Evaluates the sheet's "Calibration Function f(x)" expressions outside Yamcs.
+
+The expression string goes unchanged into the MDB as a pymdb MathOperation,
+so it is checked against what MathOperation understands rather than against
+Python: numbers, ``x``, ``+ - * /``, ``^`` for powers, unary minus,
+parentheses and the FUNCTIONS below with their Yamcs meaning (``log`` is
+base 10, ``ln`` natural). Each expression is parsed once into a Python AST
+and compiled. The compiled function accepts a scalar or a NumPy array, so a
+whole column is calibrated in one call.
+"""
+
+from typing import Callable
+from functools import lru_cache
+import ast
+import re
+import numpy as np
+
+# Functions of one argument a calibration expression may call, as Yamcs
+# MathOperation names them, with their scalar and array implementations
+FUNCTIONS = {
+    "abs": ("abs", np.abs),
+    "ln": ("math.log", np.log),
+    "log": ("math.log10", np.log10),
+    "sin": ("math.sin", np.sin),
+    "cos": ("math.cos", np.cos),
+    "tan": ("math.tan", np.tan),
+}
+
+_BINARY_OPERATORS = {"+": ast.Add, "-": ast.Sub, "*": ast.Mult, "/": ast.Div}
+
+_TOKEN = re.compile(
+    r"\s*(?:(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)"
+    r"|(?P<name>[A-Za-z_]\w*)|(?P<symbol>\S))"
+)
+
+
+class _Parser:
+    """
+    Recursive descent over a calibration expression. ``^`` binds tighter
+    than unary minus and is right associative, so ``-x^2`` is ``-(x^2)``
+    and ``2^-x`` is allowed.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.tokens = []
+        for match in _TOKEN.finditer(expression):
+            if match.lastgroup:
+                self.tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        self.pos = 0
+
+    def error(self, token: str | None = None):
+        if token is None:
+            return ValueError(
+                f"Input Error: Calibration '{self.expression}' ends unexpectedly"
+            )
+        return ValueError(
+            f"Input Error: '{token}' is not allowed in calibration '{self.expression}'"
+        )
+
+    def peek(self) -> str | None:
+        return self.tokens[self.pos][1] if self.pos < len(self.tokens) else None
+
+    def take(self) -> tuple[str, str]:
+        if self.pos >= len(self.tokens):
+            raise self.error()
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def expect(self, symbol: str):
+        _, token = self.take()
+        if token != symbol:
+            raise self.error(token)
+
+    def parse(self) -> ast.Expression:
+        body = self.sum()
+        if self.pos < len(self.tokens):
+            raise self.error(self.peek())
+        return ast.fix_missing_locations(ast.Expression(body))
+
+    def sum(self) -> ast.expr:
+        node = self.product()
+        while self.peek() in ("+", "-"):
+            op = _BINARY_OPERATORS[self.take()[1]]()
+            node = ast.BinOp(node, op, self.product())
+        return node
+
+    def product(self) -> ast.expr:
+        node = self.unary()
+        while self.peek() in ("*", "/"):
+            op = _BINARY_OPERATORS[self.take()[1]]()
+            node = ast.BinOp(node, op, self.unary())
+        return node
+
+    def unary(self) -> ast.expr:
+        if self.peek() == "-":
+            self.take()
+            return ast.UnaryOp(ast.USub(), self.unary())
+        return self.power()
+
+    def power(self) -> ast.expr:
+        node = self.atom()
+        if self.peek() == "^":
+            self.take()
+            node = ast.BinOp(node, ast.Pow(), self.unary())
+        return node
+
+    def atom(self) -> ast.expr:
+        kind, token = self.take()
+        if kind == "number":
+            return ast.Constant(int(token) if token.isdigit() else float(token))
+        if kind == "name" and token == "x":
+            return ast.Name("x", ast.Load())
+        if kind == "name" and token in FUNCTIONS:
+            self.expect("(")
+            argument = self.sum()
+            self.expect(")")
+            return ast.Call(ast.Name(token, ast.Load()), [argument], [])
+        if token == "(":
+            node = self.sum()
+            self.expect(")")
+            return node
+        raise self.error(token)
+
+
+@lru_cache(maxsize=None)
+def parse_calibration(expression: str) -> ast.Expression:
+    """
+    Parse and validate a calibration expression exactly as it goes into the
+    MDB.
+
+    Raises ValueError if it uses anything MathOperation does not support,
+    e.g. ``**``, ``//``, ``%`` or functions other than FUNCTIONS.
+    """
+    return _Parser(expression).parse()
+
+
+@lru_cache(maxsize=None)
+def compile_calibration(expression: str) -> Callable:
+    """
+    Compile a calibration expression into a function of the raw value.
+
+    The function takes a scalar, returning a float, or an array, returning a
+    float64 array. Results are cached by expression text.
+    """
+    code = compile(parse_calibration(expression), f"<calibration {expression}>", "eval")
+    namespace = {
+        "__builtins__": {},
+        **{name: func for name, (_, func) in FUNCTIONS.items()},
+    }
+
+    def calibrate(x):
+        if isinstance(x, np.ndarray):
+            return np.asarray(eval(code, namespace, {"x": x.astype(np.float64)}))
+        return float(eval(code, namespace, {"x": float(x)}))
+
+    return calibrate
+
+
+def calibration_source(expression: str) -> str:
+    """
+    Plain Python source of a validated calibration, using the math module, for
+    code that cannot depend on NumPy.
+    """
+    tree = parse_calibration(expression)
+
+    class ScalarNames(ast.NodeTransformer):
+        def visit_Name(self, node):
+            if node.id in FUNCTIONS:
+                return ast.parse(FUNCTIONS[node.id][0], mode="eval").body
+            return node
+
+    return ast.unparse(ScalarNames().visit(ast.parse(ast.unparse(tree), mode="eval")))
@@ -0,0 +1,182 @@
+"""
+Generates a standalone Python decoder for FCFrame / A.S.T.R.A. packets.
+
+The generated module has no dependencies besides the standard library. Every
+container is read with a single precompiled ``struct.Struct`` and booleans and
+fields that are not whole aligned bytes are pulled out with precomputed masks,
+so recorded frames can be decoded without going through Yamcs.
+"""
+
+from typing import Any
+from calibration import calibration_source
+from layout import field_kind
+from structplan import container_plan
+
+
+def _bits_expression(var: str, low: int, mask: int) -> str:
+    # Bits of an unpacked byte, shifted down to the bottom
+    if mask == 0xFF:
+        return var
+    expression = f"{var} & 0x{mask << low:02x}"
+    return f"({expression}) >> {low}" if low else expression
+
+
+def struct_plan(
+    entries: list[tuple[str, int, int]], encodings: dict[str, dict[str, Any]]
+) -> tuple[str, int, int, list[tuple[str, str]]]:
+    """
+    Turn laid out entries into one struct format.
+
+    Returns the format, the container size in bytes, the number of values it
+    unpacks to and ``(name, expression)`` pairs computing each value from the
+    unpacked ``v<n>`` variables.
+    """
+    fmt, size, slots = container_plan(
+        entries, lambda name: field_kind(name, encodings)[0]
+    )
+    # Expression of each value, or the parts of the bytes holding its bits
+    values: dict[str, str | list[tuple[str, int, int, int]]] = {}
+    for index, slot in enumerate(slots):
+        var = f"v{index}"
+        if isinstance(slot, str):
+            if field_kind(slot, encodings)[0] == "string":
+                values[slot] = f'{var}.rstrip(b"\\0").decode("utf-8", "replace")'
+            else:
+                values[slot] = var
+        elif isinstance(slot, tuple):
+            name, _, signed = slot
+            values[name] = f'int.from_bytes({var}, "little", signed={signed})'
+        else:
+            for name, low, mask, offset in slot:
+                values.setdefault(name, []).append((var, low, mask, offset))
+
+    expressions = []
+    for name, value in values.items():
+        if isinstance(value, list):
+            kind, signed = field_kind(name, encodings)
+            if kind == "bool":
+                var, low, mask, _ = value[0]
+                value = f"({var} & 0x{mask << low:02x}) != 0"
+            elif len(value) == 1:
+                value = _bits_expression(*value[0][:3])
+            else:
+                # Little endian by byte: the first part holds the lowest bits
+                terms = []
+                for var, low, mask, offset in value:
+                    term = _bits_expression(var, low, mask)
+                    if term != var:
+                        term = f"({term})"
+                    terms.append(f"{term} << {offset}" if offset else term)
+                value = " | ".join(terms)
+            if signed:
+                sign = 1 << (sum(part[2].bit_length() for part in values[name]) - 1)
+                value = f"(({value}) ^ 0x{sign:x}) - 0x{sign:x}"
+        expressions.append((name, value))
+    return fmt, size, len(slots), expressions
+
+
+def _struct_name(name: str) -> str:
+    return "_" + name.upper()
+
+
+def _unpack_lines(
+    struct_name: str, values: list[tuple[str, str]], num_vars: int, indent: str
+) -> list[str]:
+    if num_vars == 0:
+        return []
+    targets = ", ".join(f"v{i}" for i in range(num_vars))
+    if num_vars == 1:
+        targets += ","
+    lines = [f"{indent}{targets} = {struct_name}.unpack_from(buffer, pos)"]
+    lines += [f'{indent}values["{name}"] = {expr}' for name, expr in values]
+    return lines
+
+
+def generate_decoder(layout: dict[str, Any], digest: str) -> str:
+    """Source of a decoder module for the given layout."""
+    encodings = layout["parameters"]
+    header_format, header_size, num_vars, header_values = struct_plan(
+        layout["header"], encodings
+    )
+
+    structs = [f"_HEADER = struct.Struct({header_format!r})"]
+    body = _unpack_lines("_HEADER", header_values, num_vars, "    ")
+    body.append(f"    pos += {header_size}")
+
+    atomic_sizes = {}
+    for name, entries in layout["atomics"].items():
+        fmt, size, num_vars, values = struct_plan(entries, encodings)
+        atomic_sizes[name] = size
+        struct_name = _struct_name(name)
+        structs.append(f"{struct_name} = struct.Struct({fmt!r})")
+        body.append(f'    if values["{name}_flag"]:')
+        body += _unpack_lines(struct_name, values, num_vars, "        ")
+        body.append(f"        pos += {size}")
+
+    enums = {
+        name: dict(encoding["choices"])
+        for name, encoding in encodings.items()
+        if encoding["choices"] is not None
+    }
+    calibrations = {
+        name: encoding["calibration"]
+        for name, encoding in encodings.items()
+        if encoding["calibration"]
+    }
+    calibrators = [
+        f'    "{name}": lambda x: {calibration_source(expression)},'
+        for name, expression in calibrations.items()
+    ]
+
+    lines = [
+        '"""',
+        "FCFrame / A.S.T.R.A. decoder generated by xtce-converter. Do not edit.",
+        "",
+        "decode(packet) returns a dict of raw (uncalibrated) values for the header",
+        "and every atomic whose flag is set. decode_from(buffer, pos) also returns",
+        "the offset after the packet, and iter_decode(buffer) walks a buffer of",
+        "back to back packets. calibrate(values) applies the sheet calibrations.",
+        '"""',
+        "",
+        "import math",
+        "import struct",
+        "",
+        f"LAYOUT_HASH = {digest!r}",
+        f"HEADER_SIZE = {header_size}",
+        f"ATOMICS = {tuple(layout['atomics'])!r}",
+        f"ATOMIC_SIZES = {atomic_sizes!r}",
+        f"ENUMS = {enums!r}",
+        f"CALIBRATIONS = {calibrations!r}",
+        "CALIBRATORS = {",
+        *calibrators,
+        "}",
+        "",
+        *structs,
+        "",
+        "",
+        "def decode_from(buffer, pos=0):",
+        "    values = {}",
+        *body,
+        "    return values, pos",
+        "",
+        "",
+        "def decode(packet):",
+        "    return decode_from(packet)[0]",
+        "",
+        "",
+        "def calibrate(values):",
+        "    calibrated = dict(values)",
+        "    for name, calibrator in CALIBRATORS.items():",
+        "        if name in values:",
+        "            calibrated[name] = calibrator(values[name])",
+        "    return calibrated",
+        "",
+        "",
+        "def iter_decode(buffer, pos=0):",
+        "    end = len(buffer)",
+        "    while pos + HEADER_SIZE <= end:",
+        "        values, pos = decode_from(buffer, pos)",
+        "        yield values",
+        "",
+    ]
+    return "\n".join(lines)
@@ -1,42 +1,174 @@
-from typing import Any, Sequence
-import re
+from typing import Any
+from concurrent.futures import ThreadPoolExecutor
 import csv
 import io
+import os
+import json
+import hashlib
 import requests
 import argparse
 import yamcs.pymdb as Y
 from itertools import islice
+from calibration import parse_calibration
+from codegen import generate_decoder
+from layout import (
+    build_layout,
+    diff_layouts,
+    extract_enum_choices,
+    extract_number,
+    layout_hash,
+    optimize_atomic_order,
+)
+from report import layout_report
 
+# Where downloaded sheets are kept, so that unchanged sheets are not downloaded
+# again and the converter can run offline from the last fetch
+DEFAULT_CACHE_DIR = ".sheet-cache"
 
-def _fetch_sheet_data(sheet_id: str, gid: str) -> list[list[str]]:
+
+def _parse_csv(content: bytes) -> list[list[str]]:
+    reader = csv.reader(io.StringIO(content.decode("utf-8")))
+    return list(reader)
+
+
+def _cache_paths(cache_dir: str, sheet_id: str, gid: str) -> tuple[str, str]:
+    base = os.path.join(cache_dir, f"{sheet_id}_{gid}")
+    return (f"{base}.csv", f"{base}.json")
+
+
+def _read_cache(cache_dir: str, sheet_id: str, gid: str) -> tuple[bytes | None, dict]:
+    """
+    Returns the cached CSV content of a sheet and its metadata (ETag, SHA-256),
+    or (None, {}) if the sheet is not cached or the cache is corrupted.
+    """
+    csv_path, meta_path = _cache_paths(cache_dir, sheet_id, gid)
+    try:
+        with open(csv_path, "rb") as f:
+            content = f.read()
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return (None, {})
+    if hashlib.sha256(content).hexdigest() != meta.get("sha256"):
+        print(f"Ignoring corrupted cache entry {csv_path}")
+        return (None, {})
+    return (content, meta)
+
+
+def _write_cache(
+    cache_dir: str, sheet_id: str, gid: str, content: bytes, etag: str | None
+):
+    os.makedirs(cache_dir, exist_ok=True)
+    csv_path, meta_path = _cache_paths(cache_dir, sheet_id, gid)
+    with open(csv_path, "wb") as f:
+        f.write(content)
+    with open(meta_path, "w") as f:
+        json.dump({"etag": etag, "sha256": hashlib.sha256(content).hexdigest()}, f)
+
+
+def _fetch_sheet_data(
+    sheet_id: str,
+    gid: str,
+    cache_dir: str | None = DEFAULT_CACHE_DIR,
+    offline: bool = False,
+) -> list[list[str]]:
     """
     Internal helper: download and parse a Google Sheet as CSV.
 
+    With a cache directory, the request carries the ETag of the cached copy
+    and a 304 answer reuses it. A changed download is compared with the cache
+    by content hash. Offline, only the cached copy is used.
+
     Returns:
         A list of lists (2D array) representing rows of the sheet.
     """
+    if offline and not cache_dir:
+        raise RuntimeError(
+            "Offline mode needs a cache directory to read the sheets from"
+        )
+
+    cached, meta = (None, {})
+    if cache_dir:
+        cached, meta = _read_cache(cache_dir, sheet_id, gid)
+
+    if offline:
+        if cached is None:
+            raise RuntimeError(
+                f"Sheet {sheet_id} (gid {gid}) is not cached in {cache_dir}, cannot run offline"
+            )
+        print(f"Using cached sheet {sheet_id} (gid {gid}) from {cache_dir}")
+        return _parse_csv(cached)
+
     url = (
         f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv&gid={gid}"
     )
     print(f"Fetching sheet data from {url} ...")
 
-    response = requests.get(url)
+    headers = {}
+    if cached is not None and meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    response = requests.get(url, headers=headers)
+    if response.status_code == 304 and cached is not None:
+        print(f"Sheet gid {gid} not modified, using cached copy.")
+        return _parse_csv(cached)
     response.raise_for_status()
-    csv_content = response.content.decode("utf-8")
-    reader = csv.reader(io.StringIO(csv_content))
-    data = list(reader)
 
+    content = response.content
+    etag = response.headers.get("ETag")
+    if cached is not None and hashlib.sha256(content).hexdigest() == meta["sha256"]:
+        print(f"Sheet gid {gid} unchanged since last fetch.")
+        if etag != meta.get("etag"):
+            # so that the next fetch can be answered with a 304
+            _write_cache(cache_dir, sheet_id, gid, content, etag)
+    elif cache_dir:
+        _write_cache(cache_dir, sheet_id, gid, content, etag)
+
+    data = _parse_csv(content)
     print(f"Fetched {len(data)} rows (raw) from sheet.")
     return data
 
 
+def fetch_sheets(
+    sheet_id: str,
+    gids: list[str],
+    cache_dir: str | None = DEFAULT_CACHE_DIR,
+    offline: bool = False,
+) -> list[list[list[str]]]:
+    """
+    Fetch several sheets of the same spreadsheet concurrently.
+
+    Returns:
+        The raw rows of every sheet, in the order of ``gids``.
+    """
+    with ThreadPoolExecutor(max_workers=len(gids)) as executor:
+        futures = [
+            executor.submit(_fetch_sheet_data, sheet_id, gid, cache_dir, offline)
+            for gid in gids
+        ]
+        return [future.result() for future in futures]
+
+
+def read_csv_file(path: str) -> list[list[str]]:
+    """Read a sheet exported as CSV from disk."""
+    with open(path, "rb") as f:
+        data = _parse_csv(f.read())
+    print(f"Read {len(data)} rows (raw) from {path}.")
+    return data
+
+
 def load_sheet_rows(sheet_id: str, gid: str) -> list[dict[str, Any]]:
     """
     Load a Google Sheet (as CSV) into a list of rows (dicts).
 
     Interprets the sheet with *columns as headers* and each data row as an entry.
     """
-    data = _fetch_sheet_data(sheet_id, gid)
+    return parse_sheet_rows(_fetch_sheet_data(sheet_id, gid))
+
+
+def parse_sheet_rows(data: list[list[str]]) -> list[dict[str, Any]]:
+    """
+    Interpret raw sheet rows with *columns as headers* and each data row as an entry.
+    """
     if len(data) < 2:
         raise ValueError("Expected at least two header rows")
 
@@ -51,7 +183,13 @@ def load_sheet_columns(sheet_id: str, gid: str) -> dict[str, list[Any]]:
     """
     Load a Google Sheet (as CSV) organized *by columns*.
     """
-    data = _fetch_sheet_data(sheet_id, gid)
+    return parse_sheet_columns(_fetch_sheet_data(sheet_id, gid))
+
+
+def parse_sheet_columns(data: list[list[str]]) -> dict[str, list[Any]]:
+    """
+    Interpret raw sheet rows organized *by columns*.
+    """
     if len(data) < 2:
         raise ValueError("Expected header and at least one data row")
 
@@ -70,39 +208,11 @@ def load_sheet_columns(sheet_id: str, gid: str) -> dict[str, list[Any]]:
     return columns
 
 
-def extract_enum_choices(s: str) -> Sequence[tuple[int, str]]:
-    result = []
-    for line in s.splitlines():
-        line = line.strip()
-        if not line or "=" not in line:
-            continue  # Skip blank or malformed lines
-        num_str, desc = line.split("=", 1)
-        try:
-            num = int(num_str.strip())
-            result.append((num, desc.strip()))
-        except ValueError:
-            # Skip lines where the number part isn't a valid integer
-            continue
-    return result
-
-
-def extract_number(s: str) -> int | None:
-    """
-    Extracts the numeric part from a given string (e.g., 'float32' → 32).
-
-    Args:
-        s (str): Input string (e.g., 'float32', 'int16', 'uint8').
-
-    Returns:
-        int | None: The extracted number as an integer, or None if no digits found.
-    """
-    match = re.search(r"\d+", s)
-    return int(match.group()) if match else None
-
-
 def set_param_calibrator(row):
     cal = row["Calibration Function f(x)"]
     if cal:
+        # the string MathOperation gets is the one checked
+        parse_calibration(cal)
         return Y.calibrators.MathOperation(expression=cal)
     return None
 
@@ -241,6 +351,7 @@ def process_booleans_group(
     boolean_params: list[Y.BooleanParameter],
     start_bit_pos: int,
     container_name: str,
+    pad_index: int = 0,
 ) -> int:
     if not boolean_params:
         return start_bit_pos
@@ -256,20 +367,20 @@ def process_booleans_group(
         # Padding at higher bits, booleans at lower bits
         if group_size < 8:
             padding_bits = 8 - group_size
+            # Every interrupted run of booleans needs its own padding parameter
+            pad_suffix = f"_{pad_index}" if pad_index else ""
             pad_param = Y.IntegerParameter(
                 system=system,
-                name=f"{container_name}_bool_lead_pad",
+                name=f"{container_name}_bool_lead_pad{pad_suffix}",
                 short_description="Boolean Leading Padding",
                 signed=False,
                 encoding=Y.IntegerEncoding(bits=padding_bits),
             )
-            # Padding goes at higher bits (after the booleans in bit position)
-            # Booleans will be at current_bit_pos to current_bit_pos + group_size - 1
-            # Padding will be at current_bit_pos + group_size to current_bit_pos + 7
+            # Padding goes at the higher bits, which XTCE numbers first
+            # Padding will be at current_bit_pos to current_bit_pos + 7 - group_size
+            # Booleans will be at current_bit_pos + 8 - group_size to current_bit_pos + 7
             container.entries.append(
-                Y.ParameterEntry(
-                    parameter=pad_param, bitpos=current_bit_pos + group_size
-                )
+                Y.ParameterEntry(parameter=pad_param, bitpos=current_bit_pos)
             )
 
         # Place booleans in reverse order within the byte
@@ -304,6 +415,10 @@ def make_atomic_containers(
 
         boolean_buffer: list[Y.BooleanParameter] = []
         current_bit_pos = 0
+        pad_index = 0
+        # Booleans are placed at absolute positions in reverse order, so the
+        # entry after them cannot be placed relative to the last boolean
+        after_booleans = False
 
         for param_name in param_list:
             if param_name == "":
@@ -318,14 +433,27 @@ def make_atomic_containers(
                         system, container, boolean_buffer, current_bit_pos, name
                     )
                     boolean_buffer.clear()
+                    after_booleans = True
             else:
                 if boolean_buffer:
                     current_bit_pos = process_booleans_group(
-                        system, container, boolean_buffer, current_bit_pos, name
+                        system,
+                        container,
+                        boolean_buffer,
+                        current_bit_pos,
+                        name,
+                        pad_index,
                     )
                     boolean_buffer.clear()
-
-                container.entries.append(Y.ParameterEntry(parameter=param, offset=0))
+                    pad_index += 1
+                    after_booleans = True
+
+                if after_booleans:
+                    entry = Y.ParameterEntry(parameter=param, bitpos=current_bit_pos)
+                    after_booleans = False
+                else:
+                    entry = Y.ParameterEntry(parameter=param, offset=0)
+                container.entries.append(entry)
                 if (
                     hasattr(param, "encoding")
                     and param.encoding
@@ -335,7 +463,7 @@ def make_atomic_containers(
 
         if boolean_buffer:
             current_bit_pos = process_booleans_group(
-                system, container, boolean_buffer, current_bit_pos, name
+                system, container, boolean_buffer, current_bit_pos, name, pad_index
             )
 
         containers.append(Y.ContainerEntry(container=container, condition=condition))
@@ -431,42 +559,91 @@ def make_header(system: Y.System, atomic_names: list[str]):
     # │└▶ Flag #7        │└▶ Flag #15
     # └▶ Flag #8         └▶ Flag #16
 
-    if len(atomic_params) < 8:
-        # we need this if there is less than 32 atomic flags
-        pre_pad = Y.IntegerParameter(
-            system=system,
-            name="flags_pre_pad",
-            short_description="Flag Padding",
-            long_description="A.S.T.R.A. Packet Padding",
-            signed=False,
-            encoding=Y.IntegerEncoding(bits=8 - len(atomic_params), little_endian=True),
+    if len(atomic_params) > 32:
+        raise ValueError(
+            f"Input Error: The atomic bitmap holds 32 atomics, but the sheet has {len(atomic_params)}"
         )
-        container.entries.append(Y.ParameterEntry(pre_pad, offset=0))
 
     for group in chunked(atomic_params.values(), 8):
+        if len(group) < 8:
+            # the last byte of flags is filled from its least significant
+            # bit, so its unused high bits come first
+            pre_pad = Y.IntegerParameter(
+                system=system,
+                name="flags_pre_pad",
+                short_description="Flag Padding",
+                long_description="A.S.T.R.A. Packet Padding",
+                signed=False,
+                encoding=Y.IntegerEncoding(bits=8 - len(group), little_endian=True),
+            )
+            container.entries.append(Y.ParameterEntry(pre_pad, offset=0))
+
         for atomic_flag_param in reversed(group):
             entry = Y.ParameterEntry(parameter=atomic_flag_param, offset=0)
             container.entries.append(entry)
 
-    if len(atomic_params) < 32:
-        # we need this if there is less than 32 atomic flags
-        pre_pad = Y.IntegerParameter(
+    flag_bytes = -(-len(atomic_params) // 8)
+    if flag_bytes < 4:
+        # the bytes of the bitmap that hold no flags at all
+        post_pad = Y.IntegerParameter(
             system=system,
             name="flags_post_pad",
             short_description="Flag Padding",
             long_description="A.S.T.R.A. Packet Padding",
             signed=False,
-            encoding=Y.IntegerEncoding(bits=24, little_endian=True),
+            encoding=Y.IntegerEncoding(bits=32 - 8 * flag_bytes, little_endian=True),
         )
-        container.entries.append(Y.ParameterEntry(pre_pad, offset=0))
+        container.entries.append(Y.ParameterEntry(post_pad, offset=0))
 
     return (container, atomic_params)
 
 
-def write_system(system: Y.System, output_path: str):
+def write_system(system: Y.System, output_path: str) -> bool:
+    """
+    Write the system definition, leaving the file untouched if the generated
+    XML is identical to what is already there. Returns whether it was written.
+    """
+    buffer = io.StringIO()
+    system.dump(buffer, indent=" " * 2)
+    xml = buffer.getvalue()
+    if os.path.exists(output_path):
+        with open(output_path) as f:
+            if f.read() == xml:
+                print(f"✅ {output_path} is already up to date")
+                return False
     with open(output_path, "w") as f:
-        system.dump(f, indent=" " * 2)
+        f.write(xml)
     print(f"✅ Wrote system definition to {output_path}")
+    return True
+
+
+def write_decoder(path: str, layout: dict[str, Any], digest: str):
+    source = generate_decoder(layout, digest)
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == source:
+                return
+    with open(path, "w") as f:
+        f.write(source)
+    print(f"✅ Wrote decoder to {path}")
+
+
+def manifest_path(output_path: str) -> str:
+    return os.path.splitext(output_path)[0] + ".layout.json"
+
+
+def read_manifest(path: str) -> dict[str, Any] | None:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(path: str, layout: dict[str, Any], digest: str):
+    with open(path, "w") as f:
+        json.dump({"hash": digest, "layout": layout}, f, indent=1)
+        f.write("\n")
 
 
 def main() -> None:
@@ -479,6 +656,42 @@ def main() -> None:
         help="Path to output XML file (default: output.xml)",
         default="output.xml",
     )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Use the cached copy of the sheets instead of downloading them",
+    )
+    parser.add_argument(
+        "--from-csv",
+        nargs=2,
+        metavar=("PARAMETERS_CSV", "ATOMICS_CSV"),
+        help="Read the parameter and atomic sheets from exported CSV files",
+    )
+    parser.add_argument(
+        "--decoder",
+        metavar="PATH",
+        help="Also generate a standalone Python decoder module for the frame layout",
+    )
+    parser.add_argument(
+        "--optimize-layout",
+        action="store_true",
+        help="Reorder booleans and odd-sized fields within atomics to reduce padding",
+    )
+    parser.add_argument(
+        "--report",
+        metavar="PATH",
+        help="Write a packing report (bits used, padding, frame sizes) to PATH",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Regenerate the output even if the sheets did not change",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=DEFAULT_CACHE_DIR,
+        help=f"Directory caching the downloaded sheets (default: {DEFAULT_CACHE_DIR})",
+    )
     args = parser.parse_args()
 
     output_path = args.output
@@ -487,7 +700,45 @@ def main() -> None:
     parameter_gid = "2042306306"
     atomic_gid = "2140536820"
 
-    param_data = load_sheet_rows(sheet_id, parameter_gid)
+    if args.from_csv:
+        raw_params, raw_atomics = (read_csv_file(path) for path in args.from_csv)
+    else:
+        raw_params, raw_atomics = fetch_sheets(
+            sheet_id, [parameter_gid, atomic_gid], args.cache_dir, args.offline
+        )
+
+    param_data = parse_sheet_rows(raw_params)
+    atomic_data = parse_sheet_columns(raw_atomics)
+
+    # Compare against the layout the current output was generated from, so
+    # that Yamcs only sees a new MDB when the definitions actually changed
+    layout = build_layout(param_data, atomic_data)
+    optimized_data = {
+        name: optimize_atomic_order(params, layout["parameters"])
+        for name, params in atomic_data.items()
+    }
+    if args.optimize_layout:
+        print("⚠️  Reordering atomic fields, the flight software must match")
+        atomic_data = optimized_data
+        layout = build_layout(param_data, atomic_data)
+    layout = json.loads(json.dumps(layout))
+    digest = layout_hash(layout)
+    if args.decoder:
+        write_decoder(args.decoder, layout, digest)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(layout_report(layout, optimized_data))
+        print(f"✅ Wrote packing report to {args.report}")
+    manifest_file = manifest_path(output_path)
+    manifest = read_manifest(manifest_file)
+    if manifest and os.path.exists(output_path) and not args.force:
+        if manifest.get("hash") == digest:
+            print(f"✅ Definitions unchanged ({digest[:12]}), leaving {output_path}")
+            return
+        changes = diff_layouts(manifest["layout"], layout)
+        print(f"Definitions changed ({len(changes)} changes):")
+        for change in changes:
+            print(f"  {change}")
 
     fc = Y.System("FlightComputer")
 
@@ -497,10 +748,9 @@ def main() -> None:
         param_dict[param.name] = param
 
     print("Creating Atomics...")
-    atomic_data = load_sheet_columns(sheet_id, atomic_gid)
 
     frame_container = Y.Container(system=fc, name="FCFrame")
-    (header_container, atomic_header_params) = make_header(
+    header_container, atomic_header_params = make_header(
         system=fc, atomic_names=list(atomic_data.keys())
     )
     frame_container.entries.append(Y.ContainerEntry(header_container))
@@ -516,6 +766,7 @@ def main() -> None:
         frame_container.entries.append(container_entry)
 
     write_system(fc, output_path)
+    write_manifest(manifest_file, layout, digest)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,333 @@
+"""
+Bit layout of the FlightComputer frame, computed straight from the parsed sheets.
+
+This mirrors the decisions made by converter.py when it builds the pymdb system
+(encodings, boolean grouping, header padding) without needing pymdb, so the
+layout can be hashed, diffed and reused by tools that decode frames.
+"""
+
+from typing import Any
+from itertools import islice
+import re
+import json
+import hashlib
+from calibration import parse_calibration
+
+# Width of the atomic bitmap in the A.S.T.R.A. header
+ATOMIC_BITMAP_BITS = 32
+
+
+def _chunked(iterable, n):
+    iterator = iter(iterable)
+    while True:
+        group = list(islice(iterator, n))
+        if not group:
+            break
+        yield group
+
+
+def extract_enum_choices(s: str) -> list[tuple[int, str]]:
+    result = []
+    for line in s.splitlines():
+        line = line.strip()
+        if not line or "=" not in line:
+            continue  # Skip blank or malformed lines
+        num_str, desc = line.split("=", 1)
+        try:
+            num = int(num_str.strip())
+            result.append((num, desc.strip()))
+        except ValueError:
+            # Skip lines where the number part isn't a valid integer
+            continue
+    return result
+
+
+def extract_number(s: str) -> int | None:
+    """
+    Extracts the numeric part from a given string (e.g., 'float32' → 32).
+
+    Args:
+        s (str): Input string (e.g., 'float32', 'int16', 'uint8').
+
+    Returns:
+        int | None: The extracted number as an integer, or None if no digits found.
+    """
+    match = re.search(r"\d+", s)
+    return int(match.group()) if match else None
+
+
+def _encoding_size(row: dict[str, Any]) -> int:
+    encoded_type = str(row["Encoding"])
+    size = extract_number(encoded_type)
+    if size is None:
+        raise ValueError(
+            f"Input Error: Could not find a size in the type '{encoded_type}' "
+            f"of parameter '{row['Variable Name']}'"
+        )
+    return size
+
+
+def param_encoding(row: dict[str, Any]) -> dict[str, Any]:
+    """
+    Describe how a parameter sheet row is encoded on the wire.
+
+    Returns a dict with the parameter ``name``, its ``type`` (GUI type), the
+    wire ``encoding`` (bool, uint, int, float or string), its size in ``bits``,
+    whether it is ``little_endian`` and its ``calibration`` and enum ``choices``.
+    """
+    gui_type = str(row["GUI Type"])
+    name = str(row["Variable Name"])
+    encoded_type = str(row["Encoding"])
+    calibration = str(row["Calibration Function f(x)"])
+    description = {
+        "name": name,
+        "type": gui_type,
+        "ui_name": str(row["UI Name"]),
+        "description": str(row["Description (optional)"]),
+        "units": str(row["Units"]),
+        "calibration": None,
+        "choices": None,
+        "little_endian": True,
+    }
+
+    match gui_type:
+        case "Boolean":
+            description.update(encoding="bool", bits=1, little_endian=False)
+        case "Enumerated":
+            choices = [
+                list(choice)
+                for choice in extract_enum_choices(str(row["Metadata/Notes"]))
+            ]
+            description.update(
+                encoding="uint", bits=_encoding_size(row), choices=choices
+            )
+        case "Float" | "Integer":
+            if gui_type == "Float" and "float" in encoded_type:
+                encoding = "float"
+            elif gui_type == "Float" and "int" not in encoded_type:
+                raise ValueError(
+                    f"Input Error: Float parameter '{name}' has unsupported type '{encoded_type}'"
+                )
+            else:
+                encoding = "uint" if "u" in encoded_type else "int"
+            if calibration:
+                try:
+                    # Fail now rather than when Yamcs loads the MDB
+                    parse_calibration(calibration)
+                except ValueError as e:
+                    raise ValueError(f"{e} (parameter '{name}')") from None
+            description.update(
+                encoding=encoding,
+                bits=_encoding_size(row),
+                calibration=calibration or None,
+            )
+        case "String":
+            description.update(
+                encoding="string", bits=_encoding_size(row) * 8, little_endian=False
+            )
+        case _:
+            raise ValueError(f"Unhandled GUI Type '{gui_type}' for '{name}'")
+
+    return description
+
+
+def header_layout(atomic_names: list[str]) -> list[tuple[str, int, int]]:
+    """
+    Lay out the A.S.T.R.A. header as ``(name, bitpos, bits)`` entries.
+
+    Follows make_header() in converter.py, including the padding of the last
+    incomplete byte of flags and of the unused bytes of the bitmap.
+    """
+    entries = [("seq", 0, 16), ("flags", 16, 8), ("padding", 24, 8)]
+    bitpos = 32
+    for group in _chunked(atomic_names, 8):
+        if len(group) < 8:
+            entries.append(("flags_pre_pad", bitpos, 8 - len(group)))
+            bitpos += 8 - len(group)
+        for name in reversed(group):
+            entries.append((f"{name}_flag", bitpos, 1))
+            bitpos += 1
+    if bitpos < 32 + ATOMIC_BITMAP_BITS:
+        entries.append(("flags_post_pad", bitpos, 32 + ATOMIC_BITMAP_BITS - bitpos))
+    return entries
+
+
+def atomic_layout(
+    name: str, param_names: list[str], encodings: dict[str, dict[str, Any]]
+) -> list[tuple[str, int, int]]:
+    """
+    Lay out one atomic container as ``(name, bitpos, bits)`` entries.
+
+    Consecutive booleans are packed 8 per byte in reverse order, with a
+    ``<atomic>_bool_lead_pad`` entry filling the unused high bits of an
+    incomplete byte, exactly like process_booleans_group() in converter.py.
+    """
+    entries: list[tuple[str, int, int]] = []
+    booleans: list[str] = []
+    bitpos = 0
+    pad_index = 0
+
+    def flush_booleans():
+        nonlocal bitpos, pad_index
+        for group in _chunked(booleans, 8):
+            if len(group) < 8:
+                pad_name = f"{name}_bool_lead_pad"
+                if pad_index:
+                    pad_name += f"_{pad_index}"
+                entries.append((pad_name, bitpos, 8 - len(group)))
+                pad_index += 1
+            for i, bool_name in enumerate(group):
+                entries.append((bool_name, bitpos + 7 - i, 1))
+            bitpos += 8
+        booleans.clear()
+
+    for param_name in param_names:
+        if param_name == "":
+            break
+        encoding = encodings[param_name]
+        if encoding["encoding"] == "bool":
+            booleans.append(param_name)
+            continue
+        flush_booleans()
+        entries.append((param_name, bitpos, encoding["bits"]))
+        bitpos += encoding["bits"]
+    flush_booleans()
+    return entries
+
+
+def optimize_atomic_order(
+    param_names: list[str], encodings: dict[str, dict[str, Any]]
+) -> list[str]:
+    """
+    Reorder an atomic's parameters to waste fewer bits on padding.
+
+    All booleans are gathered where the first one appears, so they share
+    bytes instead of each run being padded to a byte. Fields that are not a
+    whole number of bytes go last, largest first, so they do not push the
+    byte-aligned fields off their byte boundaries. Booleans keep the C++
+    byte-reversed convention since atomic_layout() still places them.
+    """
+    names = []
+    for param_name in param_names:
+        if param_name == "":
+            break
+        names.append(param_name)
+
+    booleans = [n for n in names if encodings[n]["encoding"] == "bool"]
+    odd_sized = [n for n in names if n not in booleans and encodings[n]["bits"] % 8]
+    ordered = []
+    for param_name in names:
+        if booleans and param_name == booleans[0]:
+            ordered += booleans
+        elif param_name not in booleans and param_name not in odd_sized:
+            ordered.append(param_name)
+    odd_sized.sort(key=lambda n: encodings[n]["bits"], reverse=True)
+    return ordered + odd_sized
+
+
+def container_bits(entries: list[tuple[str, int, int]]) -> int:
+    """Size in bits of a laid out container."""
+    return max((bitpos + bits for _, bitpos, bits in entries), default=0)
+
+
+def field_kind(name: str, encodings: dict[str, dict[str, Any]]) -> tuple[str, bool]:
+    """Wire encoding and signedness of a layout entry."""
+    if name in encodings:
+        encoding = encodings[name]["encoding"]
+        return encoding, encoding == "int"
+    # Header entries are not sheet parameters
+    return ("bool" if name.endswith("_flag") else "uint"), False
+
+
+def build_layout(
+    param_rows: list[dict[str, Any]], atomic_columns: dict[str, list[Any]]
+) -> dict[str, Any]:
+    """
+    Build the full frame description from the parsed parameter rows and atomic
+    columns: every parameter encoding, the header and each atomic's entries.
+    """
+    encodings = {}
+    for row in param_rows:
+        encoding = param_encoding(row)
+        encodings[encoding["name"]] = encoding
+    atomic_names = list(atomic_columns)
+    return {
+        "parameters": encodings,
+        "header": header_layout(atomic_names),
+        "atomics": {
+            name: atomic_layout(name, params, encodings)
+            for name, params in atomic_columns.items()
+        },
+    }
+
+
+def layout_hash(layout: dict[str, Any]) -> str:
+    """
+    Stable sha256 of a layout. Parameters and atomics keep their sheet order,
+    since that order is what ends up in the generated XML.
+    """
+    canonical = json.dumps(layout, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _container_diff(
+    kind: str,
+    name: str,
+    old: list[tuple[str, int, int]],
+    new: list[tuple[str, int, int]],
+) -> list[str]:
+    old_entries = {entry[0]: tuple(entry[1:]) for entry in old}
+    new_entries = {entry[0]: tuple(entry[1:]) for entry in new}
+    moved = [
+        f"{param} {old_entries[param][0]}+{old_entries[param][1]}"
+        f" -> {new_entries[param][0]}+{new_entries[param][1]}"
+        for param in new_entries
+        if param in old_entries and old_entries[param] != new_entries[param]
+    ]
+    changes = []
+    added = [param for param in new_entries if param not in old_entries]
+    removed = [param for param in old_entries if param not in new_entries]
+    if added:
+        changes.append(f"~ {kind} {name}: added {', '.join(added)}")
+    if removed:
+        changes.append(f"~ {kind} {name}: removed {', '.join(removed)}")
+    if moved:
+        changes.append(f"~ {kind} {name}: layout moved ({'; '.join(moved)})")
+    return changes
+
+
+def diff_layouts(old: dict[str, Any], new: dict[str, Any]) -> list[str]:
+    """
+    Structural difference between two layouts, one line per change: parameters
+    added, removed or re-encoded, and containers whose bit layout moved.
+    """
+    changes = []
+    old_params, new_params = old["parameters"], new["parameters"]
+    for name in new_params:
+        if name not in old_params:
+            changes.append(
+                f"+ parameter {name} ({new_params[name]['encoding']}"
+                f"{new_params[name]['bits']})"
+            )
+    for name in old_params:
+        if name not in new_params:
+            changes.append(f"- parameter {name}")
+    for name, encoding in new_params.items():
+        previous = old_params.get(name)
+        if previous is None or previous == encoding:
+            continue
+        fields = sorted(k for k in encoding if encoding[k] != previous.get(k))
+        changes.append(f"~ parameter {name}: {', '.join(fields)} changed")
+
+    changes += _container_diff("container", "header", old["header"], new["header"])
+    old_atomics, new_atomics = old["atomics"], new["atomics"]
+    for name in new_atomics:
+        if name not in old_atomics:
+            changes.append(f"+ container {name}")
+    for name in old_atomics:
+        if name not in new_atomics:
+            changes.append(f"- container {name}")
+    for name, entries in new_atomics.items():
+        if name in old_atomics:
+            changes += _container_diff("container", name, old_atomics[name], entries)
+    return changes
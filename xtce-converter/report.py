@@ -0,0 +1,86 @@
+"""
+Packing report for the FlightComputer frame layout.
+
+Lists, for each atomic, how many bits carry values and how many are padding,
+and the size of a frame for every combination of atomic flags, to size the
+radio link budget.
+"""
+
+from typing import Any
+from itertools import combinations
+from layout import atomic_layout, container_bits
+from structplan import is_padding
+
+# Above this many atomics, frame sizes are summarized instead of listing
+# every flag combination
+MAX_LISTED_ATOMICS = 8
+
+
+def packing(entries: list[tuple[str, int, int]]) -> tuple[int, int]:
+    """Bits carrying values and bits of padding in a laid out container."""
+    used = sum(bits for name, _, bits in entries if not is_padding(name))
+    return used, -(-container_bits(entries) // 8) * 8 - used
+
+
+def layout_report(
+    layout: dict[str, Any], atomic_data: dict[str, list[Any]] | None = None
+) -> str:
+    """
+    Markdown packing report of a layout.
+
+    If ``atomic_data`` is given with the optimized parameter order, the report
+    also shows what each atomic would cost laid out that way.
+    """
+    encodings = layout["parameters"]
+    header_bytes = container_bits(layout["header"]) // 8
+    sizes = {}
+
+    lines = ["# FlightComputer frame packing", ""]
+    header = "| Atomic | Fields | Bytes | Value bits | Padding bits | Padding |"
+    rule = "|---|---:|---:|---:|---:|---:|"
+    if atomic_data is not None:
+        header += " Optimized bytes |"
+        rule += "---:|"
+    lines += [header, rule]
+
+    total_used = total_padding = 0
+    for name, entries in layout["atomics"].items():
+        used, padding = packing(entries)
+        total_used += used
+        total_padding += padding
+        sizes[name] = (used + padding) // 8
+        fields = sum(1 for entry in entries if not is_padding(entry[0]))
+        row = (
+            f"| {name} | {fields} | {sizes[name]} | {used} | {padding} "
+            f"| {100 * padding / max(used + padding, 1):.1f}% |"
+        )
+        if atomic_data is not None:
+            optimized = atomic_layout(name, atomic_data[name], encodings)
+            row += f" {-(-container_bits(optimized) // 8)} |"
+        lines.append(row)
+
+    lines += [
+        "",
+        f"Header: {header_bytes} bytes. All atomics: {total_used} value bits, "
+        f"{total_padding} padding bits.",
+        "",
+        "## Frame size by atomic flags",
+        "",
+    ]
+
+    names = list(sizes)
+    if len(names) <= MAX_LISTED_ATOMICS:
+        lines += ["| Atomics present | Bytes |", "|---|---:|"]
+        for count in range(len(names) + 1):
+            for present in combinations(names, count):
+                total = header_bytes + sum(sizes[name] for name in present)
+                lines.append(f"| {', '.join(present) or '(none)'} | {total} |")
+    else:
+        # Frame size is the header plus each present atomic, so the
+        # per-atomic sizes above are enough to work out any combination
+        lines.append(
+            f"{2 ** len(names)} combinations; smallest {header_bytes} bytes, "
+            f"largest {header_bytes + sum(sizes.values())} bytes."
+        )
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,466 @@
+"""
+Round-trip harness tying the generated MDB to real bytes.
+
+For the given sheets, an atomic of integers straddling bytes and synthetic
+sheets of 10, 1,000 and 10,000 parameters, each in sheet order and as
+``--optimize-layout`` reorders it:
+
+1. builds the pymdb system with converter.py and checks that every entry sits
+   at the bit position layout.py computes (pymdb places an entry without a
+   bit position right after the entry before it) and that no two entries
+   share a bit,
+2. encodes random values for every combination of atomic flags (or a sample
+   of them when there are too many) with a bit-level reference encoder,
+3. decodes them again with the generated struct decoder and the NumPy bulk
+   decoder and checks that every value comes back exactly,
+4. reports encoder and decoder throughput.
+
+Exits with status 1 if anything does not round-trip.
+"""
+
+from typing import Any
+from itertools import combinations
+import math
+from time import perf_counter
+import argparse
+import random
+import struct
+import sys
+import yamcs.pymdb as Y
+import bulk_decode
+import converter
+from calibration import calibration_source, compile_calibration, parse_calibration
+from codegen import generate_decoder
+from layout import build_layout, container_bits, layout_hash, optimize_atomic_order
+from structplan import is_padding
+
+# Synthetic sheet sizes checked by default
+DEFAULT_SIZES = (10, 1000, 10000)
+# Up to this many atomics every flag combination is encoded
+MAX_EXHAUSTIVE_ATOMICS = 10
+# Bound on the fields encoded per sheet, so large sheets get fewer packets
+FIELD_BUDGET = 2_000_000
+# Mismatches printed per sheet before giving up on the details
+MAX_REPORTED_ERRORS = 10
+
+# Parameter types of the synthetic sheets: (GUI Type, Encoding, calibration)
+SYNTHETIC_TYPES = [
+    ("Boolean", "bool", ""),
+    ("Boolean", "bool", ""),
+    ("Boolean", "bool", ""),
+    ("Enumerated", "uint8", ""),
+    ("Float", "float32", ""),
+    ("Float", "float64", ""),
+    ("Float", "int16", "x/100"),
+    ("Float", "uint16", "x*0.5+3"),
+    ("Integer", "int8", ""),
+    ("Integer", "uint16", ""),
+    ("Integer", "int32", ""),
+    ("Integer", "uint32", ""),
+    ("Integer", "int64", ""),
+    ("Integer", "uint24", ""),
+    ("Integer", "uint4", ""),
+    ("Integer", "int12", ""),
+    ("String", "char6", ""),
+]
+
+# Fields completing the bytes a sub-byte field starts, so that the floats and
+# strings after them stay byte aligned
+BYTE_COMPLETIONS = {
+    "uint4": [("Integer", "int12", "")],
+    "int12": [("Enumerated", "uint4", "")],
+}
+
+# An atomic of integers that straddle bytes, in sheet order and optimized
+ODD_WIDTH_TYPES = [
+    ("Integer", "uint4", ""),
+    ("Integer", "uint12", ""),
+    ("Boolean", "bool", ""),
+    ("Integer", "int12", ""),
+    ("Enumerated", "uint4", ""),
+]
+
+FLOAT_FORMATS = {16: "<e", 32: "<f", 64: "<d"}
+
+# Calibrations MathOperation understands, with a raw value and its result
+ACCEPTED_CALIBRATIONS = [
+    ("x/100", 250, 2.5),
+    ("x*0.5+3", 4, 5.0),
+    ("x^2", 3, 9.0),
+    ("-x^2", 3, -9.0),
+    ("2^-x", 1, 0.5),
+    ("2^3^2", 0, 512.0),
+    ("(x-1)*(x+1)", 3, 8.0),
+    ("log(x)", 1000, 3.0),
+    ("ln(x)", math.e, 1.0),
+    ("abs(x)+1e2", -1, 101.0),
+]
+
+# Python syntax MathOperation would reject or compute differently
+REJECTED_CALIBRATIONS = [
+    "x//2",
+    "x%2",
+    "x**2",
+    "sqrt(x)",
+    "exp(x)",
+    "log10(x)",
+    "min(x, 1)",
+    "pi*x",
+    "x+",
+]
+
+
+def sheet_row(n: int, gui_type: str, encoding: str, calibration: str) -> dict[str, Any]:
+    return {
+        "Variable Name": f"p{n}",
+        "UI Name": f"Parameter {n}",
+        "GUI Type": gui_type,
+        "Encoding": encoding,
+        "Units": "",
+        "Description (optional)": "",
+        "Metadata/Notes": (
+            "0=IDLE\n1=ARMED\n7=FIRED" if gui_type == "Enumerated" else ""
+        ),
+        "Calibration Function f(x)": calibration,
+    }
+
+
+def synthetic_sheet(
+    num_params: int, rng: random.Random
+) -> tuple[list[dict[str, Any]], dict[str, list[Any]]]:
+    """
+    Parameter rows and atomic columns, as parse_sheet_rows() and
+    parse_sheet_columns() return them, for a random sheet. Parameter types
+    are mixed so that boolean runs are interrupted at random places, and
+    integers that are not whole bytes come in pairs straddling a byte.
+    """
+    num_atomics = min(32, 3 + num_params // 60)
+    rows: list[dict[str, Any]] = []
+    columns: dict[str, list[Any]] = {}
+    for n in range(num_atomics):
+        column = columns[f"atomic{n}"] = []
+        while len(rows) < (n + 1) * num_params // num_atomics:
+            types = rng.choice(SYNTHETIC_TYPES)
+            for row_types in (types, *BYTE_COMPLETIONS.get(types[1], ())):
+                rows.append(sheet_row(len(rows), *row_types))
+                column.append(rows[-1]["Variable Name"])
+    return rows, columns
+
+
+def odd_width_sheet() -> tuple[list[dict[str, Any]], dict[str, list[Any]]]:
+    """A sheet whose only atomic has integers that are not whole bytes."""
+    rows = [sheet_row(n, *types) for n, types in enumerate(ODD_WIDTH_TYPES)]
+    return rows, {"odd": [row["Variable Name"] for row in rows]}
+
+
+def optimized_columns(
+    rows: list[dict[str, Any]], columns: dict[str, list[Any]]
+) -> dict[str, list[Any]]:
+    """Atomic columns in the order --optimize-layout gives them."""
+    encodings = build_layout(rows, columns)["parameters"]
+    return {
+        name: optimize_atomic_order(params, encodings)
+        for name, params in columns.items()
+    }
+
+
+def system_layout(container: Y.Container) -> list[tuple[str, int, int]]:
+    """``(name, bitpos, bits)`` of the entries of a pymdb container."""
+    entries = []
+    position = 0
+    for entry in container.entries:
+        bits = entry.parameter.encoding.bits
+        start = entry.bitpos if entry.bitpos is not None else position
+        start += entry.offset
+        entries.append((entry.parameter.name, start, bits))
+        position = start + bits
+    return entries
+
+
+def check_system(
+    rows: list[dict[str, Any]],
+    columns: dict[str, list[Any]],
+    layout: dict[str, Any],
+) -> list[str]:
+    """Compares the containers converter.py builds with the layout."""
+    system = Y.System("FlightComputer")
+    params = {}
+    for row in rows:
+        param = converter.make_param(system, row)
+        params[param.name] = param
+    header, flags = converter.make_header(system, list(columns))
+    atomics = converter.make_atomic_containers(system, columns, params, flags)
+
+    errors = []
+    built = [("header", header)] + [(e.container.name, e.container) for e in atomics]
+    expected = {"header": layout["header"], **layout["atomics"]}
+    for name, container in built:
+        actual = sorted(system_layout(container), key=lambda entry: entry[1])
+        wanted = sorted(map(tuple, expected[name]), key=lambda entry: entry[1])
+        if actual != wanted:
+            moved = [
+                f"{a[0]} at {a[1]}+{a[2]} instead of {w[1]}+{w[2]}"
+                for a, w in zip(actual, wanted)
+                if a != w
+            ]
+            errors.append(f"container {name}: {'; '.join(moved[:3])}")
+    return errors
+
+
+def layout_overlaps(layout: dict[str, Any]) -> list[str]:
+    """Entries of the layout sharing bits with an entry before them."""
+    errors = []
+    for name, entries in {"header": layout["header"], **layout["atomics"]}.items():
+        end, last = 0, None
+        for entry, bitpos, bits in sorted(entries, key=lambda entry: entry[1]):
+            if bitpos < end:
+                errors.append(f"container {name}: {entry} at {bitpos} overlaps {last}")
+            if bitpos + bits > end:
+                end, last = bitpos + bits, entry
+    return errors
+
+
+def random_value(encoding: dict[str, Any], rng: random.Random):
+    kind, bits = encoding["encoding"], encoding["bits"]
+    if kind == "bool":
+        return rng.random() < 0.5
+    if encoding["choices"]:
+        return rng.choice(encoding["choices"])[0]
+    if kind == "float":
+        # only values the encoding can represent exactly
+        fmt = FLOAT_FORMATS[bits]
+        return struct.unpack(fmt, struct.pack(fmt, rng.uniform(-1e4, 1e4)))[0]
+    if kind == "string":
+        length = rng.randint(1, bits // 8)
+        return "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(length))
+    low = -(1 << (bits - 1)) if kind == "int" else 0
+    return low + rng.getrandbits(bits)
+
+
+def encode_container(
+    entries: list[tuple[str, int, int]],
+    encodings: dict[str, dict[str, Any]],
+    values: dict[str, Any],
+) -> bytearray:
+    """
+    Reference encoder: writes each value at its bit position, one field at a
+    time, with XTCE bit numbering (bit 0 is the most significant bit of the
+    first byte) and little-endian multi-byte fields. Fields that are not whole
+    aligned bytes are split byte by byte, least significant bits first.
+    """
+    data = bytearray(container_bits(entries) // 8)
+    for name, bitpos, bits in entries:
+        if is_padding(name):
+            continue
+        value = values[name]
+        kind = encodings[name]["encoding"] if name in encodings else "uint"
+        byte, shift = divmod(bitpos, 8)
+        if shift or bits % 8:
+            # Little endian by byte, whatever the field's alignment
+            value = int(value) & ((1 << bits) - 1)
+            position, end = bitpos, bitpos + bits
+            while position < end:
+                part_byte, offset = divmod(position, 8)
+                width = min(8 - offset, end - position)
+                data[part_byte] |= (value & ((1 << width) - 1)) << (8 - offset - width)
+                value >>= width
+                position += width
+        elif kind == "float":
+            data[byte : byte + bits // 8] = struct.pack(FLOAT_FORMATS[bits], value)
+        elif kind == "string":
+            data[byte : byte + len(value)] = value.encode()
+        else:
+            data[byte : byte + bits // 8] = value.to_bytes(
+                bits // 8, "little", signed=kind == "int"
+            )
+    return data
+
+
+def flag_combinations(names: list[str], rng: random.Random, count: int):
+    """Every combination of atomics when there are few, else a sample."""
+    if len(names) <= MAX_EXHAUSTIVE_ATOMICS:
+        return [
+            set(present)
+            for n in range(len(names) + 1)
+            for present in combinations(names, n)
+        ]
+    chosen = [set(), set(names)]
+    chosen += [{name} for name in names]
+    chosen += [set(names) - {name} for name in names]
+    while len(chosen) < count:
+        chosen.append({name for name in names if rng.random() < 0.5})
+    return chosen
+
+
+def check_calibrations() -> bool:
+    """Checks which calibrations are accepted and what they compute."""
+    errors = []
+    for expression, x, expected in ACCEPTED_CALIBRATIONS:
+        try:
+            scalar = compile_calibration(expression)(x)
+            source = eval(calibration_source(expression), {"math": math}, {"x": x})
+        except ValueError as e:
+            errors.append(str(e))
+            continue
+        if not (math.isclose(scalar, expected) and math.isclose(source, expected)):
+            errors.append(f"'{expression}' gives {scalar} and {source}, not {expected}")
+    for expression in REJECTED_CALIBRATIONS:
+        try:
+            parse_calibration(expression)
+            errors.append(f"'{expression}' is accepted")
+        except ValueError:
+            pass
+
+    status = "ok" if not errors else f"{len(errors)} FAILURES"
+    print(
+        f"calibrations: {len(ACCEPTED_CALIBRATIONS)} accepted, "
+        f"{len(REJECTED_CALIBRATIONS)} rejected: {status}"
+    )
+    for error in errors:
+        print(f"  ✗ {error}")
+    return not errors
+
+
+def roundtrip(
+    label: str,
+    rows: list[dict[str, Any]],
+    columns: dict[str, list[Any]],
+    packets: int,
+    rng: random.Random,
+) -> bool:
+    start = perf_counter()
+    layout = build_layout(rows, columns)
+    errors = check_system(rows, columns, layout) + layout_overlaps(layout)
+    build_time = perf_counter() - start
+
+    encodings = layout["parameters"]
+    namespace: dict[str, Any] = {}
+    exec(
+        compile(generate_decoder(layout, layout_hash(layout)), label, "exec"), namespace
+    )
+
+    atomics = list(layout["atomics"])
+    packets = min(packets, max(20, FIELD_BUDGET // max(len(rows), 1)))
+    combos = flag_combinations(atomics, rng, packets)
+    packets = max(packets, len(combos))
+
+    expected = []
+    encoded = []
+    fields = 0
+    encode_time = 0.0
+    for n in range(packets):
+        present = combos[n % len(combos)]
+        values = {"seq": n & 0xFFFF, "flags": rng.getrandbits(8)}
+        values.update({f"{name}_flag": name in present for name in atomics})
+        for name in atomics:
+            if name in present:
+                for param, _, _ in layout["atomics"][name]:
+                    if not is_padding(param):
+                        values[param] = random_value(encodings[param], rng)
+        start = perf_counter()
+        packet = encode_container(layout["header"], encodings, values)
+        for name in atomics:
+            if name in present:
+                packet += encode_container(layout["atomics"][name], encodings, values)
+        encode_time += perf_counter() - start
+        expected.append((values, present))
+        encoded.append(bytes(packet))
+        fields += len(values)
+    capture = b"".join(encoded)
+
+    start = perf_counter()
+    decoded = list(namespace["iter_decode"](capture))
+    decode_time = perf_counter() - start
+    if len(decoded) != packets:
+        errors.append(f"struct decoder found {len(decoded)} of {packets} packets")
+    for n, (values, _) in enumerate(expected[: len(decoded)]):
+        if decoded[n] != values:
+            wrong = [k for k in values if decoded[n].get(k) != values[k]]
+            errors.append(f"struct decoder, packet {n}: {', '.join(wrong[:5])}")
+            if len(errors) >= MAX_REPORTED_ERRORS:
+                break
+
+    start = perf_counter()
+    columns_out = bulk_decode.decode_capture(capture, layout, calibrate=False)
+    bulk_time = perf_counter() - start
+    for name in atomics:
+        rows_of = [n for n, (_, present) in enumerate(expected) if name in present]
+        index = columns_out.get(f"{name}.index")
+        if list(index if index is not None else []) != rows_of:
+            errors.append(f"bulk decoder, {name}: wrong packets")
+            continue
+        for param, _, _ in layout["atomics"][name]:
+            if is_padding(param):
+                continue
+            column = columns_out[f"{name}.{param}"].tolist()
+            if isinstance(column[0] if column else None, bytes):
+                column = [value.decode() for value in column]
+            if column != [expected[n][0][param] for n in rows_of]:
+                errors.append(f"bulk decoder, {name}.{param}: values differ")
+                if len(errors) >= MAX_REPORTED_ERRORS:
+                    break
+
+    status = "ok" if not errors else f"{len(errors)} FAILURES"
+    print(
+        f"{label}: {len(rows)} parameters, {len(atomics)} atomics, "
+        f"{packets} packets ({len(combos)} flag combinations), {len(capture)} bytes: {status}"
+    )
+    print(
+        f"  layout {build_time * 1e3:.0f} ms"
+        f" | encode {packets / encode_time:,.0f} packets/s ({fields / encode_time:,.0f} fields/s)"
+        f" | struct decode {packets / decode_time:,.0f} packets/s"
+        f" | bulk decode {packets / bulk_time:,.0f} packets/s"
+    )
+    for error in errors[:MAX_REPORTED_ERRORS]:
+        print(f"  ✗ {error}")
+    return not errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Round-trip and benchmark the FlightComputer frame layout"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=list(DEFAULT_SIZES),
+        help="Parameter counts of the synthetic sheets (default: 10 1000 10000)",
+    )
+    parser.add_argument(
+        "--from-csv",
+        nargs=2,
+        metavar=("PARAMETERS_CSV", "ATOMICS_CSV"),
+        help="Also check the sheets exported to these CSV files",
+    )
+    parser.add_argument(
+        "--packets", type=int, default=2000, help="Packets encoded per sheet"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    ok = check_calibrations()
+    sheets = []
+    if args.from_csv:
+        raw_params, raw_atomics = (
+            converter.read_csv_file(path) for path in args.from_csv
+        )
+        rows = converter.parse_sheet_rows(raw_params)
+        columns = converter.parse_sheet_columns(raw_atomics)
+        sheets.append(("sheet", rows, columns))
+    sheets.append(("odd-widths", *odd_width_sheet()))
+    for size in args.sizes:
+        sheets.append((f"synthetic-{size}", *synthetic_sheet(size, rng)))
+
+    for label, rows, columns in sheets:
+        ok &= roundtrip(label, rows, columns, args.packets, rng)
+        # The same sheet as converter.py --optimize-layout lays it out
+        optimized = optimized_columns(rows, columns)
+        ok &= roundtrip(f"{label}-optimized", rows, optimized, args.packets, rng)
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
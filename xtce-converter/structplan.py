@@ -0,0 +1,124 @@
+"""
+How an A.S.T.R.A. container maps onto one little-endian ``struct.Struct``.
+
+The decoder generator unpacks containers with this plan and the simulator
+packs synthetic packets with it, so both agree on every bit. It only needs
+the standard library, so the simulator can import it without the
+converter's dependencies.
+"""
+
+import re
+
+# struct codes for the little-endian fields the sheet can declare
+STRUCT_CODES = {
+    ("uint", 8): "B",
+    ("uint", 16): "H",
+    ("uint", 32): "I",
+    ("uint", 64): "Q",
+    ("int", 8): "b",
+    ("int", 16): "h",
+    ("int", 32): "i",
+    ("int", 64): "q",
+    ("float", 16): "e",
+    ("float", 32): "f",
+    ("float", 64): "d",
+}
+
+
+def is_padding(name: str) -> bool:
+    """Whether a layout entry only fills space and carries no value."""
+    return re.fullmatch(r"padding|.*_pad(_\d+)?", name) is not None
+
+
+def bit_segments(bitpos: int, bits: int) -> list[tuple[int, int, int]]:
+    """
+    Split a field into the parts each byte holds, as ``(byte, low, width)``:
+    ``width`` bits of the byte, ``low`` bits up from its least significant bit.
+
+    Integers that are not whole aligned bytes are little endian by byte, so
+    the first part holds the least significant bits of the value.
+    """
+    segments = []
+    end = bitpos + bits
+    for byte in range(bitpos // 8, (end - 1) // 8 + 1):
+        stop = min(end, 8 * byte + 8)
+        segments.append((byte, 8 * byte + 8 - stop, stop - max(bitpos, 8 * byte)))
+    return segments
+
+
+def container_plan(entries, kinds) -> tuple[str, int, list]:
+    """
+    Plan the struct format of a container laid out as ``(name, bitpos, bits)``
+    entries, with ``kinds(name)`` giving each entry's wire encoding.
+
+    Returns the format, the size in bytes and one slot per struct value:
+
+    - a name, for a field the struct code converts as is,
+    - ``(name, length, signed)``, for an odd width integer held as ``length``
+      little-endian bytes,
+    - a list of ``(name, low, mask, offset)`` parts, for a byte shared by bit
+      fields: ``(byte >> low) & mask`` are the value's bits from ``offset`` up.
+    """
+    size_bits = max((bitpos + bits for _, bitpos, bits in entries), default=0)
+    if size_bits % 8:
+        raise ValueError(f"Container is {size_bits} bits, not a whole number of bytes")
+
+    codes: list[str] = []
+    slots: list = []
+    # Slot of each byte shared by bit fields
+    byte_slots: dict[int, list] = {}
+    next_byte = 0
+
+    def byte_slot(byte: int, name: str) -> list:
+        nonlocal next_byte
+        if byte not in byte_slots:
+            if byte < next_byte:
+                raise ValueError(f"'{name}' overlaps a previous field")
+            codes.append("x" * (byte - next_byte) + "B")
+            byte_slots[byte] = []
+            slots.append(byte_slots[byte])
+            next_byte = byte + 1
+        return byte_slots[byte]
+
+    for name, bitpos, bits in sorted(entries, key=lambda entry: entry[1]):
+        kind = kinds(name)
+        byte, shift = divmod(bitpos, 8)
+
+        if shift or bits % 8:
+            if kind not in ("bool", "uint", "int"):
+                raise ValueError(
+                    f"'{name}' ({bits} bits at bit {bitpos}) is not byte aligned"
+                )
+            offset = 0
+            for part_byte, low, width in bit_segments(bitpos, bits):
+                # XTCE numbers bits from the most significant bit of each byte
+                slot = byte_slot(part_byte, name)
+                if not is_padding(name):
+                    slot.append((name, low, (1 << width) - 1, offset))
+                offset += width
+            continue
+
+        if byte < next_byte:
+            raise ValueError(f"'{name}' overlaps a previous field")
+        codes.append("x" * (byte - next_byte))
+        next_byte = byte + bits // 8
+
+        if is_padding(name):
+            codes.append("x" * (bits // 8))
+            continue
+
+        code = STRUCT_CODES.get((kind, bits))
+        if code:
+            codes.append(code)
+            slots.append(name)
+        elif kind in ("uint", "int"):
+            codes.append(f"{bits // 8}s")
+            slots.append((name, bits // 8, kind == "int"))
+        elif kind == "string":
+            codes.append(f"{bits // 8}s")
+            slots.append(name)
+        else:
+            raise ValueError(f"No struct code for {bits}-bit {kind} field '{name}'")
+
+    codes.append("x" * (size_bits // 8 - next_byte))
+    return "<" + "".join(codes), size_bits // 8, slots